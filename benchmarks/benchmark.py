@@ -0,0 +1,212 @@
+""" Benchmark intmux end to end, against stub tmux, ssh, scp, docker, docker-compose
+and kubectl.
+
+The stubs (see stub.py) are put first on PATH, so no tmux server, SSH host or
+docker daemon is needed, and every command intmux spawns is recorded. For
+each subcommand and number of hosts, intmux is run once and its wall time,
+spawned commands and peak RSS are reported as JSON:
+
+    python -m benchmarks.benchmark --hosts 10 100 1000 5000 --output after.json
+
+Two results files can be compared to look for regressions:
+
+    python -m benchmarks.benchmark --compare before.json after.json
+"""
+import argparse
+import json
+import os
+import platform
+import pty
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STUB = os.path.join(ROOT, 'benchmarks', 'stub.py')
+STUBS = ('tmux', 'ssh', 'scp', 'docker', 'docker-compose', 'kubectl')
+SUBCOMMANDS = ('ssh', 'docker', 'compose', 'ssh-docker', 'kube')
+# the number of containers on each SSH host, for ssh-docker:
+CONTAINERS_PER_SSH_HOST = 10
+
+
+def install_stubs(directory):
+    """ Write the stub to 'directory' under the name of each command it stands in for """
+    with open(STUB) as f:
+        source = f.read().split('\n', 1)[1]
+    for name in STUBS:
+        path = os.path.join(directory, name)
+        with open(path, 'w') as f:
+            f.write('#!{}\n{}'.format(sys.executable, source))
+        os.chmod(path, 0o755)
+
+
+def scenario(subcommand, hosts, directory):
+    """ The intmux arguments and stub settings that make 'hosts' hosts for 'subcommand' """
+    if subcommand == 'ssh':
+        inventory = os.path.join(directory, 'hosts.txt')
+        with open(inventory, 'w') as f:
+            f.writelines('host{}\n'.format(i) for i in range(hosts))
+        return ['--input', inventory, 'ssh'], {}
+    if subcommand == 'ssh-docker':
+        ssh_hosts = max(1, hosts // CONTAINERS_PER_SSH_HOST)
+        return (
+            ['ssh-docker'] + ['host{}'.format(i) for i in range(ssh_hosts)],
+            {'INTMUX_BENCH_CONTAINERS': str(min(hosts, CONTAINERS_PER_SSH_HOST))})
+    return [subcommand], {'INTMUX_BENCH_CONTAINERS': str(hosts)}
+
+
+def run(subcommand, hosts, latency=0.0, intmux_arguments=()):
+    """ Run intmux once, returning what it cost """
+    directory = tempfile.mkdtemp(prefix='intmux-bench-')
+    try:
+        bin_directory = os.path.join(directory, 'bin')
+        os.mkdir(bin_directory)
+        install_stubs(bin_directory)
+        arguments, settings = scenario(subcommand, hosts, directory)
+        log = os.path.join(directory, 'commands.log')
+        environment = dict(os.environ)
+        environment.pop('TMUX', None)
+        environment.update(settings)
+        environment.update({
+            'PATH': bin_directory + os.pathsep + environment.get('PATH', ''),
+            'PYTHONPATH': ROOT,
+            'INTMUX_BENCH_LOG': log,
+            'INTMUX_BENCH_LATENCY': str(latency),
+            'XDG_CACHE_HOME': os.path.join(directory, 'cache'),
+            'COMPOSE_PROJECT_NAME': 'bench',
+            # a terminal large enough for the default --tmux-panes:
+            'COLUMNS': '200',
+            'LINES': '50',
+        })
+        command = [sys.executable, '-c', 'from scripts.intmux import main; main()']
+        command += list(intmux_arguments) + arguments
+
+        # a terminal for STDIN, so that intmux doesn't read hosts from it:
+        master, slave = pty.openpty()
+        output = open(os.path.join(directory, 'output.txt'), 'w+')
+        try:
+            start = time.monotonic()
+            process = subprocess.Popen(
+                command, stdin=slave, stdout=output, stderr=subprocess.STDOUT, env=environment,
+                cwd=directory)
+            _, status, usage = os.wait4(process.pid, 0)
+            wall_time = time.monotonic() - start
+            process.returncode = os.waitstatus_to_exitcode(status)
+            output.seek(0)
+            printed = output.read()
+        finally:
+            output.close()
+            os.close(master)
+            os.close(slave)
+
+        spawned = Counter()
+        if os.path.exists(log):
+            with open(log) as f:
+                spawned.update(json.loads(line)['name'] for line in f)
+        result = {
+            'subcommand': subcommand,
+            'hosts': hosts,
+            'arguments': list(intmux_arguments),
+            'exit_status': process.returncode,
+            'wall_time': round(wall_time, 4),
+            'spawns': sum(spawned.values()),
+            'spawns_by_command': dict(sorted(spawned.items())),
+            # the largest of intmux and the commands it waited for, in KiB on Linux:
+            'max_rss': usage.ru_maxrss,
+        }
+        if process.returncode != 0:
+            result['output'] = printed[-2000:]
+        return result
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, stderr=subprocess.DEVNULL,
+            universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(subcommands, hosts, latency=0.0, intmux_arguments=()):
+    """ Run every scenario, returning the results document """
+    results = []
+    for subcommand in subcommands:
+        for count in hosts:
+            result = run(subcommand, count, latency, intmux_arguments)
+            print('{subcommand:>10} {hosts:>6} hosts: {wall_time:8.3f}s {spawns:>6} spawns '
+                  '{max_rss:>8} KiB exit {exit_status}'.format(**result), file=sys.stderr)
+            results.append(result)
+    return {
+        'revision': revision(),
+        'python': platform.python_version(),
+        'latency': latency,
+        'results': results,
+    }
+
+
+def compare(before, after, threshold):
+    """ Print how each scenario changed, returning whether any got worse than 'threshold' """
+    def key(result):
+        return result['subcommand'], result['hosts'], tuple(result['arguments'])
+    previous = {key(r): r for r in before['results']}
+    regressed = False
+    print('{:>10} {:>6} {:>10} {:>10} {:>8} {:>8}'.format(
+        'subcommand', 'hosts', 'wall', 'before', 'spawns', 'before'))
+    for result in after['results']:
+        old = previous.get(key(result))
+        if old is None:
+            continue
+        worse = (result['spawns'] > old['spawns'] or
+                 result['wall_time'] > old['wall_time'] * threshold)
+        regressed = regressed or worse
+        print('{:>10} {:>6} {:>9.3f}s {:>9.3f}s {:>8} {:>8}{}'.format(
+            result['subcommand'], result['hosts'], result['wall_time'], old['wall_time'],
+            result['spawns'], old['spawns'], '  <- regression' if worse else ''))
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark intmux against stub tmux/ssh/docker commands.")
+    parser.add_argument(
+        '--hosts', nargs='+', type=int, default=[10, 100, 1000, 5000], metavar='HOSTS',
+        help="Numbers of hosts to benchmark with (default: 10 100 1000 5000)")
+    parser.add_argument(
+        '--subcommands', nargs='+', choices=SUBCOMMANDS, default=list(SUBCOMMANDS),
+        help="intmux subcommands to benchmark (default: all of them)")
+    parser.add_argument(
+        '--latency', type=float, default=0.0, metavar='SECONDS',
+        help="How long each stub command takes (default: 0)")
+    parser.add_argument(
+        '--intmux-args', default='', metavar='ARGUMENTS',
+        help="Extra intmux options to benchmark with, for instance '--tmux-control'")
+    parser.add_argument(
+        '--output', '-o', type=argparse.FileType('w'), default=sys.stdout,
+        help="Write the JSON results here (default: STDOUT)")
+    parser.add_argument(
+        '--compare', nargs=2, type=argparse.FileType('r'), metavar=('BEFORE', 'AFTER'),
+        help="Compare two results files instead of benchmarking")
+    parser.add_argument(
+        '--threshold', type=float, default=1.25,
+        help="With --compare, how much slower a scenario may get before it is a regression (default: 1.25)")
+    args = parser.parse_args()
+
+    if args.compare:
+        before, after = (json.load(f) for f in args.compare)
+        sys.exit(1 if compare(before, after, args.threshold) else 0)
+
+    results = benchmark(args.subcommands, args.hosts, args.latency, shlex.split(args.intmux_args))
+    json.dump(results, args.output, indent=2)
+    args.output.write('\n')
+    if any(r['exit_status'] != 0 for r in results['results']):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
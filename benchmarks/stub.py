@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+""" A stand-in for tmux, ssh, scp, docker, docker-compose and kubectl (see benchmark.py).
+
+It is installed under each of those names. Every invocation is appended to
+$INTMUX_BENCH_LOG as a JSON line, then it waits $INTMUX_BENCH_LATENCY seconds
+and answers just enough for intmux to carry on:
+
+- docker ps prints $INTMUX_BENCH_CONTAINERS containers in the requested --format
+- kubectl get pods prints $INTMUX_BENCH_CONTAINERS pods as JSON
+- ssh runs the remote command with this stub (so 'ssh host docker ps' works)
+- tmux -C speaks enough of control mode for one client
+- everything else succeeds without printing anything
+"""
+import json
+import os
+import re
+import sys
+import time
+
+
+def record(name, arguments):
+    line = json.dumps({'name': name, 'arguments': arguments, 'time': time.time()}) + '\n'
+    # O_APPEND writes of one short line are not interleaved with other stubs':
+    descriptor = os.open(os.environ['INTMUX_BENCH_LOG'], os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+    try:
+        os.write(descriptor, line.encode('utf-8'))
+    finally:
+        os.close(descriptor)
+
+
+def docker_ps(arguments):
+    """ Print containers like 'docker ps --format ...' """
+    template = '{{.ID}}'
+    if '--format' in arguments:
+        template = arguments[arguments.index('--format') + 1].replace('\\t', '\t')
+    count = int(os.environ.get('INTMUX_BENCH_CONTAINERS', '10'))
+    for i in range(count):
+        fields = {
+            '.Names': 'container{}'.format(i),
+            '.ID': '{:012x}'.format(i),
+            '.Image': 'image{}'.format(i % 4),
+            '.Label "com.docker.compose.service"': 'service{}'.format(i),
+            '.Label "com.docker.compose.container-number"': '1',
+        }
+        print(re.sub(r'{{\s*([^}]*?)\s*}}', lambda m: fields.get(m.group(1), ''), template))
+
+
+def docker(arguments):
+    if 'ps' in arguments:
+        docker_ps(arguments)
+    return 0
+
+
+def kubectl(arguments):
+    if 'get' in arguments and 'pods' in arguments:
+        count = int(os.environ.get('INTMUX_BENCH_CONTAINERS', '10'))
+        json.dump({'items': [
+            {'metadata': {'name': 'pod{}'.format(i), 'namespace': 'bench'},
+             'spec': {'nodeName': 'node{}'.format(i % 10)}}
+            for i in range(count)]}, sys.stdout)
+    return 0
+
+
+def ssh(arguments):
+    # skip the options (and their values) to find the host and remote command:
+    remaining = list(arguments)
+    while len(remaining) > 0 and remaining[0].startswith('-'):
+        option = remaining.pop(0)
+        if option in ('-o', '-p', '-i', '-l', '-F', '-O', '-S', '-J') and len(remaining) > 0:
+            remaining.pop(0)
+    command = remaining[1:]
+    if 'docker' in command and 'ps' in command:
+        docker_ps(command)
+    return 0
+
+
+def control_mode(arguments):
+    """ Answer each command read on stdin with an empty reply (tmux -C) """
+    number = 0
+
+    def reply(error=False):
+        print('%begin {} {} 0'.format(int(time.time()), number))
+        print('%{} {} {} 0'.format('error' if error else 'end', int(time.time()), number))
+        sys.stdout.flush()
+
+    if 'attach-session' in arguments:
+        # there are never any sessions to attach to:
+        reply(error=True)
+        print('%exit')
+        return 0
+    reply()
+    for line in sys.stdin:
+        number += 1
+        reply()
+    print('%exit')
+    return 0
+
+
+def tmux(arguments):
+    if '-C' in arguments:
+        return control_mode(arguments)
+    if 'list-sessions' in arguments:
+        # no server is running yet
+        return 1
+    if 'show-options' in arguments:
+        print('0')
+    return 0
+
+
+def main():
+    name = os.path.basename(sys.argv[0])
+    arguments = sys.argv[1:]
+    record(name, arguments)
+    time.sleep(float(os.environ.get('INTMUX_BENCH_LATENCY', '0')))
+    if name == 'tmux':
+        return tmux(arguments)
+    if name == 'ssh':
+        return ssh(arguments)
+    if name == 'kubectl':
+        return kubectl(arguments)
+    if name in ('docker', 'docker-compose'):
+        return docker(arguments)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,239 @@
+""" Send keys to the pane of every host in a session, whichever window it is in (see 'intmux send').
+
+Only the panes that intmux made (those with a HOST_OPTION) are sent keys.
+All of the keys for a tmux server are sent with one batch of commands: when
+every pane of a synchronized window is to get them, they are sent to one
+pane of it and synchronize-panes passes them on, and otherwise the window is
+unsynchronized while each pane is sent them.
+
+Run as a script (as the console of --tmux-shards and the --broadcast-key
+window do), it sends what is typed to the sessions until C-] is typed.
+"""
+import argparse
+import collections
+import logging
+import os
+import posix
+import queue
+import sys
+import termios
+import threading
+import tty
+
+from . import connections, matching, shard, tmux
+
+logger = logging.getLogger('broadcast')
+
+# Stop broadcasting when this is typed (C-], like telnet):
+ESCAPE = b'\x1d'
+# The most keys sent with one send-keys command:
+CHUNK = 256
+# The fields listed for each pane of the session (see select):
+PANE_FORMAT = '#{window_id}\t#{pane_id}\t#{synchronize-panes}\t#{' + tmux.HOST_OPTION + '}'
+
+# The panes of a window to send keys to. When 'unsynchronize' is set,
+# synchronize-panes is turned off while they are sent:
+Target = collections.namedtuple('Target', ['window', 'unsynchronize', 'panes'])
+
+
+def select(lines, matcher=None):
+    """ The Targets for the panes listed with PANE_FORMAT whose hosts match 'matcher' (all hosts if None) """
+    windows = collections.OrderedDict()
+    for line in lines:
+        window, pane, synchronized, host = line.split('\t', 3)
+        synchronized, panes, total = windows.get(window, (synchronized == '1', [], 0))
+        if host != '' and (matcher is None or matcher.match(host) is not None):
+            panes.append(pane)
+        windows[window] = (synchronized, panes, total + 1)
+    targets = []
+    for window, (synchronized, panes, total) in windows.items():
+        if len(panes) == 0:
+            continue
+        if synchronized and len(panes) == total:
+            targets.append(Target(window, False, panes[:1]))
+        else:
+            targets.append(Target(window, synchronized, panes))
+    return targets
+
+
+def batch(targets, keys):
+    """ The tmux commands that send 'keys' (a list of send-keys arguments) to the targets """
+    commands = tmux.TmuxBatch()
+    for target in targets:
+        if target.unsynchronize:
+            commands.add('set-option', '-w', '-t', target.window, 'synchronize-panes', 'off')
+        for pane in target.panes:
+            for arguments in keys:
+                commands.add('send-keys', '-t', pane, *arguments)
+        if target.unsynchronize:
+            commands.add('set-option', '-w', '-t', target.window, 'synchronize-panes', 'on')
+    return commands
+
+
+def hexadecimal(keys):
+    """ send-keys arguments that type the bytes 'keys' """
+    return [['-H'] + ['{:02x}'.format(b) for b in keys[i:i + CHUNK]] for i in range(0, len(keys), CHUNK)]
+
+
+def targets(client, session, matcher=None):
+    return select(client.run('list-panes', '-s', '-t', '={}'.format(session), '-F', PANE_FORMAT), matcher)
+
+
+class Broadcaster(object):
+    """ Send keys to the session on each of several tmux servers.
+
+    Each server has its own control mode client and thread, so a server that
+    is slow to take the keys does not hold up the others. Keys that arrive
+    while a server is busy are sent to it together.
+    """
+
+    def __init__(self, sockets, session, matcher=None):
+        self.session = session
+        self.matcher = matcher
+        self.clients = []
+        for socket in sockets:
+            client = tmux.ControlClient(socket)
+            if client.has_session(session):
+                self.clients.append(client)
+            else:
+                logger.warning("No session '{}' on tmux server {}".format(session, socket or 'default'))
+        self.queues = [queue.Queue() for _ in self.clients]
+        self.threads = [
+            threading.Thread(target=self._forward, args=(c, q), daemon=True)
+            for c, q in zip(self.clients, self.queues)]
+        for thread in self.threads:
+            thread.start()
+
+    def send(self, keys):
+        for keys_queue in self.queues:
+            keys_queue.put(keys)
+
+    def _forward(self, client, keys_queue):
+        panes = targets(client, self.session, self.matcher)
+        closed = False
+        while not closed:
+            keys = keys_queue.get()
+            if keys is None:
+                return
+            while not keys_queue.empty():
+                more = keys_queue.get()
+                if more is None:
+                    closed = True
+                    break
+                keys += more
+            try:
+                client.apply(batch(panes, hexadecimal(keys)))
+            except tmux.TmuxError as e:
+                # a pane or window was closed since the panes were listed:
+                logger.debug('sending keys to {} failed: {}'.format(client.socket, e))
+                try:
+                    panes = targets(client, self.session, self.matcher)
+                except tmux.TmuxError:
+                    return
+
+    def close(self):
+        self.send(None)
+        for thread in self.threads:
+            thread.join()
+        for client in self.clients:
+            client.close()
+
+
+def interactive(sockets, session, matcher=None):
+    """ Send what is typed on the terminal to the session on each server, until C-] """
+    broadcaster = Broadcaster(sockets, session, matcher)
+    print('Typing here is sent to every host of {} (C-] to stop).'.format(session))
+    sys.stdout.flush()
+    descriptor = sys.stdin.fileno()
+    settings = termios.tcgetattr(descriptor)
+    try:
+        tty.setraw(descriptor)
+        while True:
+            keys = os.read(descriptor, 4096)
+            if len(keys) == 0:
+                break
+            if ESCAPE in keys:
+                if keys.index(ESCAPE) > 0:
+                    broadcaster.send(keys[:keys.index(ESCAPE)])
+                break
+            broadcaster.send(keys)
+    finally:
+        termios.tcsetattr(descriptor, termios.TCSADRAIN, settings)
+        broadcaster.close()
+
+
+def run(args):
+    """ Send the keys of 'intmux send' to the session, returning the exit status """
+    session = args.tmux_session
+    if args.tmux_shards > 1:
+        sockets = shard.sockets(args.tmux_socket, session, args.tmux_shards)
+    else:
+        sockets = [args.tmux_socket]
+    try:
+        matcher = matching.Matcher(args.hosts.split(','), args.approximate) if args.hosts else None
+    except ValueError as e:
+        print(e)
+        return posix.EX_USAGE
+    if len(args.text) == 0:
+        if not sys.stdin.isatty():
+            print('Provide the TEXT to send (or run it in a terminal, to send what is typed)')
+            return posix.EX_USAGE
+        interactive(sockets, session, matcher)
+        return 0
+
+    if args.keys:
+        keys = [args.text]
+    else:
+        keys = [['-l', ' '.join(args.text)]]
+        if not args.no_enter:
+            keys.append(['Enter'])
+
+    def send(socket):
+        client = tmux.ControlClient(socket) if args.tmux_control else tmux.TmuxClient(socket)
+        try:
+            if not client.has_session(session):
+                print("No session '{}' on tmux server {}".format(session, socket or 'default'))
+                return 0
+            panes = targets(client, session, matcher)
+            client.apply(batch(panes, keys))
+            return sum(len(t.panes) for t in panes)
+        finally:
+            client.close()
+
+    try:
+        sent = connections.map_in_parallel(send, sockets, len(sockets))
+    except tmux.TmuxError as e:
+        print(e)
+        return posix.EX_SOFTWARE
+    if sum(sent) == 0:
+        print("No panes of session '{}' matched".format(session))
+        return posix.EX_USAGE
+    return 0
+
+
+def pane_session(socket, pane):
+    """ The name of the session that 'pane' is in """
+    return tmux.TmuxClient(socket).run('display-message', '-p', '-t', pane, '#{session_name}')[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Send what is typed to every host of a session.")
+    parser.add_argument(
+        '--session', default=None,
+        help="tmux session name (default: the session of the pane it runs in)")
+    parser.add_argument(
+        '--socket', dest='sockets', action='append', default=None,
+        help="tmux socket name (tmux -L) of a server with the session (default: tmux's default server)")
+    args = parser.parse_args()
+    sockets = args.sockets or [None]
+    session = args.session
+    if session is None:
+        if 'TMUX_PANE' not in os.environ:
+            print('Provide the --session (or run it in a tmux pane)')
+            sys.exit(posix.EX_USAGE)
+        session = pane_session(sockets[0], os.environ['TMUX_PANE'])
+    interactive(sockets, session)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+import hashlib
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+from . import trace
+
+logger = logging.getLogger('cache')
+
+
+def cache_directory():
+    return os.path.join(
+        os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'intmux')
+
+
+def cache_path(key):
+    digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+    return os.path.join(cache_directory(), 'hosts-{}.json'.format(digest))
+
+
+def read(key):
+    """ Return the cached (time, hosts) for 'key', or None """
+    try:
+        with open(cache_path(key)) as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if entry.get('key') != key:
+        return None
+    return entry['time'], entry['hosts']
+
+
+def write(key, hosts):
+    """ Replace the cached hosts for 'key'.
+
+    The entry is written to a temporary file that is then renamed over the old
+    one, so concurrent intmux processes never read a partial entry.
+    """
+    os.makedirs(cache_directory(), exist_ok=True)
+    handle, temporary = tempfile.mkstemp(dir=cache_directory(), prefix='.hosts-')
+    try:
+        with os.fdopen(handle, 'w') as f:
+            json.dump({'key': key, 'time': time.time(), 'hosts': hosts}, f)
+        os.replace(temporary, cache_path(key))
+    except OSError:
+        os.remove(temporary)
+        raise
+
+
+def revalidate(connection_type, parsed_args, key):
+    """ Discover the hosts again, updating the cache """
+    try:
+        write(key, connection_type.hosts(parsed_args))
+    except (ValueError, OSError) as e:
+        logger.debug('revalidating {} failed: {}'.format(key, e))
+
+
+def revalidate_in_background(connection_type, parsed_args, key):
+    """ Run revalidate in a detached process, so that intmux doesn't wait for it """
+    pid = os.fork()
+    if pid > 0:
+        os.waitpid(pid, 0)
+        return
+    # fork again so the process doing the work is not left as a zombie:
+    if os.fork() == 0:
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        try:
+            revalidate(connection_type, parsed_args, key)
+        finally:
+            os._exit(0)
+    os._exit(0)
+
+
+def hosts(connection_type, parsed_args):
+    """ connection_type.hosts(parsed_args), served from the cache when possible.
+
+    A cached entry younger than --cache-ttl seconds is returned immediately and
+    refreshed in the background for next time. --refresh ignores the cache.
+    """
+    key = connection_type.discovery_key(parsed_args)
+    if key is None or not parsed_args.cache_ttl:
+        with trace.span('discover hosts', connection=connection_type.__name__):
+            return connection_type.hosts(parsed_args)
+
+    entry = read(key)
+    if entry is not None and not parsed_args.refresh and time.time() - entry[0] < parsed_args.cache_ttl:
+        logger.debug('cached hosts = {}'.format(entry[1]))
+        sys.stdout.flush()
+        sys.stderr.flush()
+        revalidate_in_background(connection_type, parsed_args, key)
+        return entry[1]
+
+    with trace.span('discover hosts', connection=connection_type.__name__):
+        found = connection_type.hosts(parsed_args)
+    try:
+        write(key, found)
+    except OSError as e:
+        logger.warning('Could not cache hosts: {}'.format(e))
+    return found
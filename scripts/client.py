@@ -0,0 +1,132 @@
+""" The intmux command, as a client of intmuxd when it is running (see daemon.py).
+
+The daemon builds the session, and this only sends it the command line and
+the piped hosts, prints what it replies, and attaches the terminal. So that
+this stays quick, nothing of intmux is imported unless the daemon isn't
+running (or can't run the command), when the command runs here instead.
+"""
+import json
+import os
+import socket
+import struct
+import sys
+
+from . import terminal
+
+
+def socket_path():
+    """ Where intmuxd listens ($INTMUX_DAEMON_SOCKET, or a socket of the user's in $XDG_RUNTIME_DIR or /tmp) """
+    if os.environ.get('INTMUX_DAEMON_SOCKET'):
+        return os.environ['INTMUX_DAEMON_SOCKET']
+    directory = os.environ.get('XDG_RUNTIME_DIR') or '/tmp'
+    return os.path.join(directory, 'intmuxd-{}.sock'.format(os.getuid()))
+
+
+def send(stream, message):
+    stream.write(json.dumps(message) + '\n')
+    stream.flush()
+
+
+def receive(stream):
+    line = stream.readline()
+    if line == '':
+        raise ConnectionError('intmuxd closed the connection')
+    return json.loads(line)
+
+
+def _environment():
+    """ The environment to run the command with, including the size of the terminal """
+    environment = dict(os.environ)
+    try:
+        columns, lines = os.get_terminal_size(sys.__stdout__.fileno())
+    except (AttributeError, ValueError, OSError):
+        columns, lines = 80, 24
+    environment.setdefault('COLUMNS', str(columns))
+    environment.setdefault('LINES', str(lines))
+    return environment
+
+
+def _owner(connection, path):
+    """ The user id of the daemon at the other end of 'connection' (or, failing that, of its socket) """
+    if hasattr(socket, 'SO_PEERCRED'):
+        credentials = connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+        return struct.unpack('3i', credentials)[1]
+    return os.stat(path).st_uid
+
+
+def request(arguments, path=None):
+    """ Run the command line 'arguments' in intmuxd, returning its reply.
+
+    None is returned when the daemon isn't running, or can't run the command.
+    The daemon is sent the environment (SSH_AUTH_SOCK, tokens...), so it is
+    only used when it runs as the same user.
+    """
+    path = path or socket_path()
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        if os.stat(path).st_uid != os.getuid():
+            raise PermissionError('{} is owned by another user'.format(path))
+        connection.connect(path)
+        if _owner(connection, path) != os.getuid():
+            raise PermissionError('intmuxd at {} runs as another user'.format(path))
+    except PermissionError as e:
+        connection.close()
+        print('{}, running intmux without it'.format(e), file=sys.stderr)
+        return None
+    except OSError:
+        connection.close()
+        return None
+    stdin = sys.stdin
+    with connection, connection.makefile('rw') as stream:
+        terminal = stdin.isatty()
+        send(stream, {
+            'arguments': arguments, 'directory': os.getcwd(), 'environment': _environment(),
+            'terminal': terminal})
+        if receive(stream).get('fallback'):
+            return None
+        # only read piped hosts once the daemon is to run the command (a
+        # command run here may --stream them):
+        send(stream, {'input': None if terminal else stdin.read()})
+        return receive(stream)
+
+
+def attach(socket_name, target):
+    """ Replace this process with the tmux client that attaches the terminal to 'target' """
+    steps, nest = terminal.attach_commands(socket_name, target, os.environ)
+    prefix = ['tmux'] + (['-L', socket_name] if socket_name else [])
+    for arguments in steps[:-1]:
+        os.spawnvp(os.P_WAIT, 'tmux', prefix + arguments)
+    environment = dict(os.environ)
+    if nest:
+        # a different tmux server, so nest it:
+        environment.pop('TMUX')
+    if 'TMUX' not in environment and not sys.stdin.isatty():
+        # hosts were piped in on stdin, so attach with the terminal instead:
+        try:
+            os.dup2(os.open('/dev/tty', os.O_RDONLY), 0)
+        except OSError:
+            pass
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.execvpe('tmux', prefix + steps[-1], environment)
+
+
+def main():
+    reply = None
+    if not os.environ.get('INTMUX_NO_DAEMON'):
+        try:
+            reply = request(sys.argv[1:])
+        except (OSError, ValueError) as e:
+            print('intmuxd failed ({}), running intmux without it'.format(e), file=sys.stderr)
+    if reply is None:
+        from . import intmux
+        return intmux.main()
+    sys.stdout.write(reply['stdout'])
+    sys.stderr.write(reply['stderr'])
+    if reply['status'] == 0 and reply.get('attach') is not None:
+        attach(*reply['attach'])
+    sys.exit(reply['status'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+""" Wait for the --command or --script of every pane to finish, and summarize how it went (see --wait).
+
+Once a pane's task has finished (see connections.then_connect) REPORT writes
+its exit status and timings to a file named after the pane, and wakes intmux
+with 'tmux wait-for -S'. intmux blocks in 'tmux wait-for' until it is woken,
+and then reads the files again. The pane carries on (to the interactive
+connection) whether or not intmux is waiting.
+"""
+import collections
+import logging
+import os
+import shlex
+import shutil
+import subprocess
+import tempfile
+import time
+
+logger = logging.getLogger('completion')
+
+REPORT = """# Record the exit status ($1) of the pane's task, which started at $2
+# A pane that failed before it was connected is retried (see launch.py), and
+# only the attempt that isn't reports:
+if [ "$1" -ne 0 ] && [ "$INTMUX_RETRY" = 1 ] && [ "$(tmux display-message -p -t "$TMUX_PANE" '#{{@intmux_up}}')" != 1 ]
+then
+    exit "$1"
+fi
+echo "$1 $2 $(date +%s)" > {directory}/"${{TMUX_PANE#%}}"
+tmux wait-for -S {channel}
+exit "$1"
+"""
+# The longest wait for a report before checking for panes that were closed:
+WAKE = 5
+
+# How a host's task went. 'status' is None while it is running, and
+# 'seconds' is how long it took (or has taken so far):
+Result = collections.namedtuple('Result', ['host', 'status', 'seconds'])
+
+
+class Completion(object):
+
+    def __init__(self, session, socket=None):
+        self.socket = socket
+        self.channel = 'intmux-done-{}-{}'.format(session, os.getpid())
+        self.directory = tempfile.mkdtemp(prefix='intmux-wait-', dir='/tmp')
+        self.script = os.path.join(self.directory, 'report.sh')
+        with open(self.script, 'w') as f:
+            f.write(REPORT.format(directory=shlex.quote(self.directory), channel=shlex.quote(self.channel)))
+        self.started = time.time()
+
+    def report_command(self):
+        """ The command that a pane runs with its task's exit status and start time (see connections.then_connect) """
+        return 'sh {}'.format(shlex.quote(self.script))
+
+    def reports(self):
+        """ The reports written so far: {pane id: (status, started, finished)} """
+        reports = {}
+        for name in os.listdir(self.directory):
+            if not name.isdigit():
+                continue
+            with open(os.path.join(self.directory, name)) as f:
+                fields = f.read().split()
+            if len(fields) == 3:
+                reports['%' + name] = tuple(int(field) for field in fields)
+        return reports
+
+    def _sleep(self, timeout):
+        """ Block until a pane reports, or 'timeout' seconds pass """
+        command = ['tmux'] + (['-L', self.socket] if self.socket else []) + ['wait-for', self.channel]
+        process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            pass
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+
+    def wait(self, panes, timeout=None, list_panes=None):
+        """ Wait for the panes ({pane id: host}) to report, returning a Result for each host.
+
+        Waiting ends after 'timeout' seconds (if not None), when it is
+        interrupted (C-c), or once the panes that haven't reported are all
+        closed ('list_panes' returns the pane ids that are still open).
+        """
+        deadline = None if timeout is None else self.started + timeout
+        reports = self.reports()
+        try:
+            while True:
+                waiting = [p for p in panes if p not in reports]
+                logger.debug('waiting for {} of {} panes'.format(len(waiting), len(panes)))
+                if len(waiting) == 0:
+                    break
+                if list_panes is not None and not set(waiting) & set(list_panes()):
+                    break
+                remaining = WAKE if deadline is None else min(WAKE, deadline - time.time())
+                if remaining <= 0:
+                    break
+                self._sleep(remaining)
+                reports = self.reports()
+        except KeyboardInterrupt:
+            pass
+        now = time.time()
+        results = []
+        for pane, host in panes.items():
+            if pane in reports:
+                status, started, finished = reports[pane]
+                results.append(Result(host, status, finished - started))
+            else:
+                results.append(Result(host, None, now - self.started))
+        return results
+
+    def close(self):
+        """ Remove the reports (only once every pane has reported: the others still run REPORT) """
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def summarize(results, out):
+    """ Print the hosts that failed, are still running and succeeded, with their timings.
+
+    Returns the exit status for intmux: 0 when every task succeeded, or the
+    largest exit status otherwise (255 for tasks that are still running).
+    """
+    failed = sorted((r for r in results if r.status not in (None, 0)), key=lambda r: r.host)
+    running = sorted((r for r in results if r.status is None), key=lambda r: r.host)
+    succeeded = sorted((r for r in results if r.status == 0), key=lambda r: r.host)
+    out.write('{} succeeded, {} failed, {} still running\n'.format(len(succeeded), len(failed), len(running)))
+    width = max([len(r.host) for r in results] or [0])
+    for state, group in (('failed', failed), ('running', running), ('succeeded', succeeded)):
+        for result in group:
+            detail = '{}s'.format(int(result.seconds))
+            if state == 'failed':
+                detail = 'exit {}, {}'.format(result.status, detail)
+            out.write('  {:<10} {}  {}\n'.format(state, result.host.ljust(width), detail))
+    out.flush()
+    if len(running) > 0:
+        return 255
+    return max([r.status for r in failed] or [0])
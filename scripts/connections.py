@@ -1,8 +1,19 @@
+import hashlib
+import json
 import logging
+import os
+import re
+import shlex
 import subprocess
+import sys
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+from functools import lru_cache
 from os import path
 
+from . import docker_api, matching, trace
+
 logger = logging.getLogger('connections')
 
 
@@ -16,9 +27,10 @@ def set_argument(parsed_args, name, value):
         setattr(parsed_args, name, old_value)
 
 
-def check_output_as_list(command):
+def check_output_as_list(command, timeout=None):
     logger.debug(command)
-    output = subprocess.check_output([command], shell=True)
+    with trace.command(command):
+        output = subprocess.check_output([command], shell=True, timeout=timeout)
     logger.debug(output)
     lines = output.decode('utf-8').split('\n')
     lines = [line for line in lines if len(line) > 0]
@@ -26,6 +38,80 @@ def check_output_as_list(command):
     return lines
 
 
+@lru_cache(maxsize=None)
+def _content_hash(script, mtime, size):
+    """ The hash of a script's content, cached for as long as the file is unchanged (see staged_path) """
+    with open(script, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def staged_path(script):
+    """ Where a script is copied to on a remote host.
+
+    The name is a hash of the script's content, so a script that is already
+    there (see staged_test) does not need to be copied again.
+    """
+    script = path.realpath(script)
+    status = os.stat(script)
+    return '/tmp/intmux-{}'.format(_content_hash(script, status.st_mtime_ns, status.st_size))
+
+
+def staged_test(staged):
+    """ The test for a script that is already at 'staged' (see staged_path).
+
+    /tmp is shared, so the script must be the connecting user's own as well
+    as executable: then no one else can have written it. A file of someone
+    else's there is copied over (when it can be), but can't be made
+    executable by chmod, so it isn't run.
+    """
+    return 'test -O {0} -a -x {0}'.format(staged)
+
+
+def map_in_parallel(function, items, workers):
+    """ Call function on every item using at most 'workers' threads.
+
+    Results are returned in the same order as items.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        return list(executor.map(function, items))
+
+
+# The docker ps filters that --filter passes on to docker:
+DOCKER_FILTERS = ('label', 'status', 'ancestor', 'health')
+
+
+def docker_filters(parsed_args):
+    """ The --filter options as docker ps filters ({name: [values]}, see DockerClient.containers) """
+    filters = {}
+    for setting in getattr(parsed_args, 'docker_filters', None) or []:
+        name, value = setting.split('=', 1)
+        filters.setdefault(name, []).append(value)
+    return filters
+
+
+def then_connect(task, connect, parsed_args):
+    """ The shell command that runs 'task' (for --command or --script), and then 'connect' if it succeeded.
+
+    When 'connect' is None the pane's shell is left once 'task' finishes. With
+    --wait, the task's exit status is reported in between (see completion.py).
+    """
+    report = getattr(parsed_args, 'report_status', None)
+    if report is not None:
+        task = 'intmux_started=$(date +%s); {}; {} $? "$intmux_started"'.format(task, report)
+    if connect is None:
+        return task
+    return '{} && {}'.format(task, connect)
+
+
+def describe_error(error):
+    """ A short, one line description of a failed discovery command """
+    if isinstance(error, subprocess.TimeoutExpired):
+        return 'timed out after {}s'.format(error.timeout)
+    if isinstance(error, subprocess.CalledProcessError):
+        return 'exited with status {}'.format(error.returncode)
+    return str(error).strip()
+
+
 class Connection(object):
     @classmethod
     def hosts(cls, parsed_args):
@@ -35,6 +121,21 @@ class Connection(object):
         """
         raise NotImplementedError()
 
+    @classmethod
+    def discovery_key(cls, parsed_args):
+        """ What the result of hosts() depends on, to cache it by (None: don't cache it) """
+        return None
+
+    @classmethod
+    def ssh_host(cls, host):
+        """ The SSH host that 'host' is reached through (None when SSH isn't used) """
+        return None
+
+    @classmethod
+    def stage(cls, hosts, parsed_args):
+        """ Copy --script to the hosts before any pane is created, if needed """
+        pass
+
     @classmethod
     def copy(cls, host, parsed_args):
         raise NotImplementedError()
@@ -47,6 +148,11 @@ class Connection(object):
     def connect(cls, host, parsed_args):
         raise NotImplementedError()
 
+    @classmethod
+    def execute(cls, host, parsed_args):
+        """ The command that runs --command on host without a terminal (see --exec) """
+        raise NotImplementedError()
+
 
 class SSHConnection(Connection):
     @classmethod
@@ -55,82 +161,130 @@ class SSHConnection(Connection):
             raise ValueError("At least one host must be specified!\n")
         return parsed_args.hosts
 
+    @classmethod
+    def ssh_host(cls, host):
+        return host
+
     @classmethod
     def copy(cls, host, parsed_args, and_execute=True):
-        script_path, script_name = path.split(parsed_args.script)
-        copy = 'scp {} {} {}:/tmp'.format(parsed_args.ssh_options, parsed_args.script, host)
+        staged = staged_path(parsed_args.script)
         connect = cls.connect(host, parsed_args)
-        chmod = connect + ' chmod u+x /tmp/{}'.format(script_name)
+        copy = 'scp {} {} {}:{}'.format(parsed_args.ssh_options, parsed_args.script, host, staged)
+        chmod = connect + ' chmod u+x {}'.format(staged)
+        stage = '{} {} || ({} && {})'.format(connect, staged_test(staged), copy, chmod)
         if and_execute:
-            execute = connect + ' /tmp/{}'.format(script_name)
-            return '{} && {} && {} && {}'.format(copy, chmod, execute, connect)
-        return '{} && {}'.format(copy, chmod)
+            execute = connect + ' {}'.format(staged)
+            return then_connect('{} && {}'.format(stage, execute), connect, parsed_args)
+        return stage
 
     @classmethod
     def command(cls, host, parsed_args):
-        return '{} {} {} {}'.format(parsed_args.ssh_command, parsed_args.ssh_options, host, parsed_args.command)
+        command = '{} {} {} {}'.format(parsed_args.ssh_command, parsed_args.ssh_options, host, parsed_args.command)
+        return then_connect(command, None, parsed_args)
 
     @classmethod
     def connect(cls, host, parsed_args):
         return '{} {} {}'.format(parsed_args.ssh_command, parsed_args.ssh_options, host)
 
+    @classmethod
+    def execute(cls, host, parsed_args):
+        return cls.command(host, parsed_args)
+
 
 class DockerConnection(Connection):
     @classmethod
-    def hosts(cls, parsed_args, prepend_command=''):
+    def hosts(cls, parsed_args, prepend_command='', timeout=None):
         host_names = parsed_args.hosts
-        matched_host_names = {}
-        for name in host_names:
-            matched_host_names[name] = False
+        # names, IDs, globs and re: patterns (see matching.expression):
+        matcher = matching.Matcher(host_names, parsed_args.approximate)
+        group_by = parsed_args.docker_group_by
+        labels = [group_by[len('label='):]] if group_by and group_by.startswith('label=') else []
+        containers = cls.containers(
+            docker_filters(parsed_args), labels, image=group_by == 'image', prepend_command=prepend_command,
+            timeout=timeout)
+
+        def group(container):
+            if not group_by:
+                return ''
+            return container.image if group_by == 'image' else container.labels.get(labels[0], '')
+
+        matched = [
+            c for c in containers if len(host_names) == 0 or matcher.match(c.name, c.id) is not None]
         hosts = []
-        names_and_ids = check_output_as_list(
-            prepend_command + "docker ps --format '{{.Names}},{{.ID}}'")
-        if len(host_names) == 0:
-            hosts.extend(n_and_i.split(',')[1] for n_and_i in names_and_ids)
-        else:
-            for n_and_i in names_and_ids:
-                n, i = n_and_i.split(',')
-                if n in host_names:
-                    hosts.append(i)
-                    matched_host_names[n] = True
-                elif i in host_names:
-                    hosts.append(i)
-                    matched_host_names[n] = True
-                elif parsed_args.approximate and any(name in n for name in host_names):
-                    hosts.append(i)
-                elif parsed_args.approximate and any(name in i for name in host_names):
-                    hosts.append(i)
+        previous = None
+        for container in sorted(matched, key=group):
+            # each image or label value (--group-by) gets windows of its own:
+            if len(hosts) > 0 and group(container) != previous:
+                hosts.append('\n')
+            previous = group(container)
+            hosts.append(container.id)
 
         logger.debug("hosts = {0}".format(hosts))
 
         if len(hosts) == 0:
             raise ValueError("No docker containers detected to connect to!")
         if not parsed_args.approximate:
-            for name in host_names:
-                if not matched_host_names[name]:
-                    raise ValueError("No container named '{}' found!".format(name))
+            for name in matcher.unmatched(n for c in containers for n in (c.name, c.id)):
+                raise ValueError("No container named '{}' found!".format(name))
 
         return hosts
 
     @classmethod
-    def _execute(cls, host, parsed_args, command, prepend_command=''):
-        with set_argument(parsed_args, 'docker_command', 'exec -it {}'.format('{} ' + command)) as parsed_args:
+    def discovery_key(cls, parsed_args):
+        return [
+            cls.__name__, os.environ.get('DOCKER_HOST'), parsed_args.hosts, parsed_args.approximate,
+            docker_filters(parsed_args), getattr(parsed_args, 'docker_group_by', None)]
+
+    @classmethod
+    def containers(cls, filters=None, labels=(), image=False, prepend_command='', timeout=None):
+        """ List the running containers with 'docker ps', as docker_api.Container records.
+
+        'filters' are passed to 'docker ps --filter' (see DockerClient.containers),
+        and only the 'labels' asked for (and the image, if 'image') are read.
+        """
+        command = prepend_command + 'docker ps'
+        for name, values in sorted((filters or {}).items()):
+            for value in values:
+                command += ' --filter {}'.format(shlex.quote('{}={}'.format(name, value)))
+        if len(labels) == 0 and not image:
+            command += " --format '{{.Names}},{{.ID}}'"
+            return [
+                docker_api.Container(name=n, id=i, image='', labels={}, state='running')
+                for n, i in (line.split(',') for line in check_output_as_list(command, timeout=timeout))]
+
+        # label values may contain commas, so separate the fields with tabs:
+        fields = ['{{.Names}}', '{{.ID}}'] + (['{{.Image}}'] if image else [])
+        command += " --format '{}'".format('\\t'.join(
+            fields + ['{{{{.Label "{}"}}}}'.format(label) for label in labels]))
+        containers = []
+        for line in check_output_as_list(command, timeout=timeout):
+            values = line.split('\t')
+            container_labels = values[len(fields):]
+            containers.append(docker_api.Container(
+                name=values[0], id=values[1], image=values[2] if image else '',
+                labels=dict(zip(labels, container_labels)), state='running'))
+        return containers
+
+    @classmethod
+    def _execute(cls, host, parsed_args, command, prepend_command='', options='-it '):
+        with set_argument(parsed_args, 'docker_command', 'exec {}{}'.format(options, '{} ' + command)) as parsed_args:
             return cls.connect(host, parsed_args, prepend_command)
 
     @classmethod
-    def copy(cls, host, parsed_args, prepend_command=''):
-        script_path, script_name = path.split(parsed_args.script)
-        copy = '{}docker cp {} {}:/tmp'.format(prepend_command, parsed_args.script, host)
-        chmod = cls._execute(host, parsed_args, 'chmod u+x /tmp/' + script_name, prepend_command)
-        execute = cls._execute(host, parsed_args, '/tmp/' + script_name, prepend_command)
+    def copy(cls, host, parsed_args, prepend_command='', source=None):
+        staged = staged_path(parsed_args.script)
+        exists = '{}docker exec {} {}'.format(prepend_command, host, staged_test(staged))
+        copy = '{}docker cp {} {}:{}'.format(prepend_command, source or parsed_args.script, host, staged)
+        chmod = cls._execute(host, parsed_args, 'chmod u+x ' + staged, prepend_command)
+        execute = cls._execute(host, parsed_args, staged, prepend_command)
         connect = cls.connect(host, parsed_args, prepend_command)
-        return '{} && {} && {} && {}'.format(copy, chmod, execute, connect)
+        return then_connect('{} || ({} && {}) && {}'.format(exists, copy, chmod, execute), connect, parsed_args)
 
     @classmethod
     def command(cls, host, parsed_args, prepend_command=''):
         command = cls._execute(host, parsed_args, parsed_args.command, prepend_command)
         connect = cls.connect(host, parsed_args, prepend_command)
-        return '{} && {}'.format(command, connect)
+        return then_connect(command, connect, parsed_args)
 
     @classmethod
     def connect(cls, host, parsed_args, prepend_command=''):
@@ -147,18 +301,104 @@ class DockerConnection(Connection):
         else:
             return '{}docker exec -it {} bash'.format(prepend_command, host)
 
+    @classmethod
+    def execute(cls, host, parsed_args, prepend_command=''):
+        return cls._execute(host, parsed_args, parsed_args.command, prepend_command, options='')
+
+
+class DockerAPIConnection(DockerConnection):
+    """ List containers with the Docker Engine API rather than the docker CLI """
+
+    @classmethod
+    def containers(cls, filters=None, labels=(), image=False, prepend_command='', timeout=None):
+        return docker_api.DockerClient(timeout=timeout).containers(filters)
+
+
+COMPOSE_SERVICE = 'com.docker.compose.service'
+COMPOSE_NUMBER = 'com.docker.compose.container-number'
+
+
+# The files that docker-compose looks for, in the current directory and its parents:
+COMPOSE_FILES = ('compose.yaml', 'compose.yml', 'docker-compose.yml', 'docker-compose.yaml')
+
+
+def read_env(filename):
+    """ The variables set in a docker-compose .env file ({} when there isn't one) """
+    variables = {}
+    try:
+        with open(filename) as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return variables
+    for line in lines:
+        line = line.strip()
+        if line.startswith('export '):
+            line = line[len('export '):]
+        if line.startswith('#') or '=' not in line:
+            continue
+        name, value = line.split('=', 1)
+        value = value.strip()
+        if len(value) > 1 and value[0] == value[-1] and value[0] in '"\'':
+            value = value[1:-1]
+        variables[name.strip()] = value
+    return variables
+
 
 class DockerComposeConnection(DockerConnection):
+    @classmethod
+    def project_directory(cls):
+        """ The directory of the compose file, found as docker-compose finds it ($COMPOSE_FILE, or a parent directory) """
+        if os.environ.get('COMPOSE_FILE'):
+            return path.dirname(path.abspath(os.environ['COMPOSE_FILE'].split(os.pathsep)[0]))
+        directory = os.getcwd()
+        while True:
+            if any(path.isfile(path.join(directory, name)) for name in COMPOSE_FILES):
+                return directory
+            parent = path.dirname(directory)
+            if parent == directory:
+                # no compose file: docker-compose would fail, so use the current directory
+                return os.getcwd()
+            directory = parent
+
+    @classmethod
+    def project(cls):
+        """ The docker-compose project name of the current directory.
+
+        As with docker-compose, it is $COMPOSE_PROJECT_NAME (also read from the
+        .env file next to the compose file), or the name of the directory of
+        the compose file.
+        """
+        if os.environ.get('COMPOSE_PROJECT_NAME'):
+            return os.environ['COMPOSE_PROJECT_NAME']
+        directory = cls.project_directory()
+        name = read_env(path.join(directory, '.env')).get('COMPOSE_PROJECT_NAME') or path.basename(directory)
+        return re.sub(r'[^-_a-z0-9]', '', name.lower())
+
+    @classmethod
+    def discovery_key(cls, parsed_args):
+        return super().discovery_key(parsed_args) + [cls.project()]
+
     @classmethod
     def hosts(cls, parsed_args):
-        containers = check_output_as_list('docker-compose ps --filter="status=running" --services')
+        # Find every running container of the project, and its service, with one
+        # query:
+        services = {}
+        for container in cls.containers(
+                filters={
+                    'label': ['com.docker.compose.project={}'.format(cls.project())],
+                    'status': ['running']},
+                labels=[COMPOSE_SERVICE, COMPOSE_NUMBER]):
+            if not container.labels.get(COMPOSE_SERVICE):
+                continue
+            number = int(container.labels.get(COMPOSE_NUMBER) or 0)
+            services.setdefault(container.labels[COMPOSE_SERVICE], []).append((number, container.id))
+        containers = sorted(services)
         logger.debug('containers = "{}"'.format(containers))
 
+        matcher = matching.Matcher(parsed_args.hosts, parsed_args.approximate)
         filtered_hosts = []
         for container_name in containers:
-            if container_name in parsed_args.hosts:
-                filtered_hosts.append(container_name)
-            elif parsed_args.approximate and any(h in container_name for h in parsed_args.hosts):
+            if len(parsed_args.hosts) == 0 or matcher.match(container_name) is not None:
                 filtered_hosts.append(container_name)
 
         logger.debug('filtered_hosts = "{}"'.format(filtered_hosts))
@@ -166,12 +406,9 @@ class DockerComposeConnection(DockerConnection):
             raise ValueError("No service found in {}".format(containers))
 
         hosts = []
-        for name in containers:
-            if len(filtered_hosts) > 0 and name not in filtered_hosts:
-                continue
-            container = check_output_as_list('docker-compose ps -q {}'.format(name))
-            if len(container) == 1:
-                hosts.append(container[0])
+        for name in filtered_hosts:
+            # scaled services have one container per instance:
+            hosts.extend(container for number, container in sorted(services[name]))
 
         if len(hosts) == 0:
             raise ValueError("No running docker containers detected to connect to!")
@@ -179,6 +416,10 @@ class DockerComposeConnection(DockerConnection):
         return hosts
 
 
+class DockerComposeAPIConnection(DockerComposeConnection, DockerAPIConnection):
+    pass
+
+
 class SSHDockerConnection(DockerConnection):
     @classmethod
     def hosts(cls, parsed_args):
@@ -186,27 +427,81 @@ class SSHDockerConnection(DockerConnection):
             raise ValueError("At least one host must be specified!\n")
 
         ssh_hosts = parsed_args.hosts
+        # no --docker-containers means every container:
+        containers = parsed_args.docker_containers.split(',') if parsed_args.docker_containers else []
+
+        with set_argument(parsed_args, 'hosts', containers) as parsed_args:
+            def discover(ssh_host):
+                try:
+                    with trace.span('discover containers', host=ssh_host):
+                        return cls._host_containers(ssh_host, parsed_args), None
+                except (ValueError, subprocess.SubprocessError) as e:
+                    return [], describe_error(e)
+
+            results = map_in_parallel(discover, ssh_hosts, parsed_args.discovery_workers)
+
+        hosts = []
+        failures = []
+        for ssh_host, (more_hosts, error) in zip(ssh_hosts, results):
+            if error is not None:
+                failures.append('  {}: {}'.format(ssh_host, error))
+            if len(hosts) > 0 and len(more_hosts) > 0:
+                hosts.append('\n')
+            hosts.extend(more_hosts)
+
+        if len(failures) > 0:
+            summary = "Container discovery failed on {} of {} hosts:\n{}".format(
+                len(failures), len(ssh_hosts), '\n'.join(failures))
+            if len(hosts) == 0:
+                raise ValueError(summary)
+            print(summary, file=sys.stderr)
+
+        return hosts
+
+    @classmethod
+    def discovery_key(cls, parsed_args):
+        return super().discovery_key(parsed_args) + [parsed_args.docker_containers]
+
+    @classmethod
+    def _host_containers(cls, ssh_host, parsed_args):
+        """ Discover the containers on one SSH host """
+        ssh_command = ' '.join(option for option in ['ssh', parsed_args.ssh_options, ssh_host] if option)
+        found_containers = super().hosts(
+            parsed_args, ssh_command + ' ', timeout=parsed_args.discovery_timeout)
+        # window breaks between groups (see --group-by) are kept:
+        return [
+            c if c == '\n' else '{},{}'.format(ssh_host, c) for c in found_containers]
 
-        with set_argument(parsed_args, 'hosts', parsed_args.docker_containers.split(',')) as parsed_args:
-            hosts = []
-            for ssh_host in ssh_hosts:
-                found_containers = super().hosts(parsed_args, 'ssh {} '.format(ssh_host))
-                more_hosts = ['{},{}'.format(ssh_host, container) for container in found_containers]
-                if len(hosts) > 0 and len(more_hosts) > 0:
-                    hosts.append('\n')
-                hosts.extend(more_hosts)
+    @classmethod
+    def ssh_host(cls, host):
+        return host.split(',')[0]
 
-            return hosts
+    @classmethod
+    def stage(cls, hosts, parsed_args):
+        """ Copy --script to each SSH host once, rather than once per container """
+        ssh_hosts = list(dict.fromkeys(cls.ssh_host(host) for host in hosts))
+
+        def stage_host(ssh_host):
+            try:
+                check_output_as_list(SSHConnection.copy(ssh_host, parsed_args, and_execute=False))
+            except subprocess.CalledProcessError as e:
+                return describe_error(e)
+
+        errors = map_in_parallel(stage_host, ssh_hosts, parsed_args.discovery_workers)
+        failures = ['  {}: {}'.format(h, e) for h, e in zip(ssh_hosts, errors) if e is not None]
+        if len(failures) > 0:
+            print("Copying {} failed on {} of {} hosts:\n{}".format(
+                parsed_args.script, len(failures), len(ssh_hosts), '\n'.join(failures)), file=sys.stderr)
 
     @classmethod
     def copy(cls, host, parsed_args):
+        """ Copy --script from the SSH host (see stage) into the container """
         ssh_host, container = host.split(',')
-        ssh_copy = SSHConnection.copy(ssh_host, parsed_args, and_execute=False)
         with set_argument(parsed_args, 'ssh_options', '-t ' + parsed_args.ssh_options) as parsed_args:
             ssh_command = SSHConnection.connect(ssh_host, parsed_args)
-        with set_argument(parsed_args, 'script', '/tmp/' + parsed_args.script) as parsed_args:
-            docker_copy = DockerConnection.copy(container, parsed_args, prepend_command=ssh_command + ' ')
-        return '{} && {}'.format(ssh_copy, docker_copy)
+            return DockerConnection.copy(
+                container, parsed_args, prepend_command=ssh_command + ' ',
+                source=staged_path(parsed_args.script))
 
     @classmethod
     def command(cls, host, parsed_args, prepend_command=''):
@@ -221,3 +516,122 @@ class SSHDockerConnection(DockerConnection):
         with set_argument(parsed_args, 'ssh_options', '-t ' + parsed_args.ssh_options) as parsed_args:
             ssh_command = SSHConnection.connect(ssh_host, parsed_args)
             return DockerConnection.connect(container, parsed_args, prepend_command=ssh_command + ' ')
+
+    @classmethod
+    def execute(cls, host, parsed_args):
+        ssh_host, container = host.split(',')
+        ssh_command = SSHConnection.connect(ssh_host, parsed_args)
+        return DockerConnection.execute(container, parsed_args, prepend_command=ssh_command + ' ')
+
+
+# A pod listed by 'kubectl get pods':
+Pod = namedtuple('Pod', ['namespace', 'name', 'node'])
+
+
+class KubeConnection(Connection):
+    """ Connect to Kubernetes pods with 'kubectl exec'.
+
+    Hosts are 'namespace/pod' names.
+    """
+
+    @classmethod
+    def kubectl(cls, parsed_args):
+        command = parsed_args.kubectl_command
+        if parsed_args.kube_context:
+            command += ' --context {}'.format(shlex.quote(parsed_args.kube_context))
+        return command
+
+    @classmethod
+    def pods(cls, parsed_args, timeout=None):
+        """ List the pods matching the namespace and selectors, with one 'kubectl get pods' """
+        command = cls.kubectl(parsed_args) + ' get pods --output json'
+        if parsed_args.all_namespaces:
+            command += ' --all-namespaces'
+        elif parsed_args.namespace:
+            command += ' --namespace {}'.format(shlex.quote(parsed_args.namespace))
+        if parsed_args.selector:
+            command += ' --selector {}'.format(shlex.quote(parsed_args.selector))
+        if parsed_args.field_selector:
+            command += ' --field-selector {}'.format(shlex.quote(parsed_args.field_selector))
+        try:
+            items = json.loads('\n'.join(check_output_as_list(command, timeout=timeout)) or '{}').get('items', [])
+        except ValueError:
+            raise ValueError("Could not read the pods listed by '{}'".format(command))
+        return [
+            Pod(namespace=item['metadata'].get('namespace', 'default'), name=item['metadata']['name'],
+                node=item.get('spec', {}).get('nodeName') or '')
+            for item in items]
+
+    @classmethod
+    def discovery_key(cls, parsed_args):
+        return [
+            cls.__name__, os.environ.get('KUBECONFIG'), parsed_args.kube_context, parsed_args.namespace,
+            parsed_args.all_namespaces, parsed_args.selector, parsed_args.field_selector, parsed_args.hosts,
+            parsed_args.approximate, parsed_args.group_by]
+
+    @classmethod
+    def hosts(cls, parsed_args):
+        # names, namespace/names, globs and re: patterns (see matching.expression):
+        matcher = matching.Matcher(parsed_args.hosts, parsed_args.approximate)
+
+        def group(pod):
+            return getattr(pod, parsed_args.group_by) if parsed_args.group_by else ''
+
+        pods = cls.pods(parsed_args)
+        hosts = []
+        previous = None
+        for pod in sorted(pods, key=lambda p: (group(p), p.namespace, p.name)):
+            host = '{}/{}'.format(pod.namespace, pod.name)
+            if len(parsed_args.hosts) > 0 and matcher.match(pod.name, host) is None:
+                continue
+            # each namespace or node (--group-by) gets windows of its own:
+            if len(hosts) > 0 and group(pod) != previous:
+                hosts.append('\n')
+            previous = group(pod)
+            hosts.append(host)
+
+        logger.debug("hosts = {0}".format(hosts))
+
+        if len(hosts) == 0:
+            raise ValueError("No pods detected to connect to!")
+        if not parsed_args.approximate:
+            names = [n for p in pods for n in (p.name, '{}/{}'.format(p.namespace, p.name))]
+            for name in matcher.unmatched(names):
+                raise ValueError("No pod named '{}' found!".format(name))
+
+        return hosts
+
+    @classmethod
+    def _exec(cls, host, parsed_args, options='-it '):
+        """ 'kubectl exec' in the pod, up to the '--' that the command to run follows """
+        namespace, pod = host.split('/', 1)
+        command = '{} exec {}--namespace {} {}'.format(
+            cls.kubectl(parsed_args), options, shlex.quote(namespace), shlex.quote(pod))
+        if parsed_args.kube_container:
+            command += ' --container {}'.format(shlex.quote(parsed_args.kube_container))
+        return command + ' --'
+
+    @classmethod
+    def copy(cls, host, parsed_args):
+        staged = staged_path(parsed_args.script)
+        exists = '{} {}'.format(cls._exec(host, parsed_args, options=''), staged_test(staged))
+        copy = '{} cp {} {}:{}'.format(cls.kubectl(parsed_args), parsed_args.script, host, staged)
+        if parsed_args.kube_container:
+            copy += ' --container {}'.format(shlex.quote(parsed_args.kube_container))
+        chmod = '{} chmod u+x {}'.format(cls._exec(host, parsed_args), staged)
+        execute = '{} {}'.format(cls._exec(host, parsed_args), staged)
+        connect = cls.connect(host, parsed_args)
+        return then_connect('{} || ({} && {}) && {}'.format(exists, copy, chmod, execute), connect, parsed_args)
+
+    @classmethod
+    def command(cls, host, parsed_args):
+        command = '{} {}'.format(cls._exec(host, parsed_args), parsed_args.command)
+        return then_connect(command, cls.connect(host, parsed_args), parsed_args)
+
+    @classmethod
+    def connect(cls, host, parsed_args):
+        return '{} {}'.format(cls._exec(host, parsed_args), parsed_args.kube_shell)
+
+    @classmethod
+    def execute(cls, host, parsed_args):
+        return '{} {}'.format(cls._exec(host, parsed_args, options=''), parsed_args.command)
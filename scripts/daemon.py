@@ -0,0 +1,276 @@
+""" intmuxd: build intmux sessions in a resident process, so that what is slow to start stays warm.
+
+intmux (see client.py) hands each command line to the daemon over a UNIX
+socket, and the daemon builds the session much as intmux would, except that:
+
+- each tmux server is driven by a control mode client that stays open from
+  one command to the next (see WarmClient), rather than a new one per command
+- the shared SSH connections of --ssh-multiplex are kept for the next
+  command, rather than being closed along with the session
+- discovered hosts are cached for CACHE_TTL seconds when --cache-ttl isn't
+  given
+
+The client attaches the terminal itself. Commands that need the terminal
+while they run (--stream, --exec, --wait, restore and send) or that --trace
+are run by the client instead. Commands are run one at a time: each one has
+the current directory, environment and standard streams of its client.
+"""
+import argparse
+import contextlib
+import io
+import logging
+import os
+import posix
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+from . import client, intmux, multiplex, tmux
+
+logger = logging.getLogger('daemon')
+
+# How long discovered hosts are reused for when the command doesn't say (see --cache-ttl):
+CACHE_TTL = 60
+# The longest wait for a client to send its command (and hosts):
+TIMEOUT = 60
+# The subcommands that build a session:
+SUBCOMMANDS = ('ssh', 'docker', 'compose', 'ssh-docker', 'kube')
+
+
+def runs_here(args):
+    """ Whether the daemon can run the command (otherwise the client does) """
+    return args.subcommand in SUBCOMMANDS and not (args.stream or args.execute or args.trace or args.wait)
+
+
+def exit_status(code):
+    """ The exit status of a SystemExit 'code', printing it when it is a message """
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    print(code, file=sys.stderr)
+    return 1
+
+
+class Input(io.StringIO):
+    """ The standard input of a command: the hosts piped to its client, if any """
+
+    def __init__(self, text, terminal):
+        super().__init__(text or '')
+        self.terminal = terminal
+
+    def isatty(self):
+        return self.terminal
+
+
+class WarmClient(tmux.ControlClient):
+    """ A control mode client that stays open from one command to the next.
+
+    When the session it is attached to is closed tmux detaches it, so a new
+    one is started the next time it is used.
+    """
+
+    def _check(self):
+        if self.process is not None and self.process.poll() is not None:
+            logger.debug('control mode client of {} exited'.format(self.socket or 'default'))
+            self.process = None
+
+    def run(self, *arguments):
+        self._check()
+        return super().run(*arguments)
+
+    def apply(self, batch):
+        self._check()
+        return super().apply(batch)
+
+    def has_session(self, session):
+        self._check()
+        return super().has_session(session)
+
+    def new_session(self, session, size=None):
+        self._check()
+        return super().new_session(session, size)
+
+    def close(self):
+        # kept for the next command (see shutdown)
+        pass
+
+    def shutdown(self):
+        super().close()
+
+
+class DaemonSession(tmux.TmuxSession):
+    """ A TmuxSession built with the daemon's warm clients and SSH connections.
+
+    Rather than attaching, the target is kept in 'attached' for the client.
+    """
+
+    def __init__(self, args, daemon):
+        self.daemon = daemon
+        self.attached = None
+        super().__init__(args)
+
+    def make_client(self, socket):
+        return self.daemon.client(socket)
+
+    def make_multiplexer(self):
+        return self.daemon.multiplexer(self.args.ssh_command, self.args.ssh_multiplex_persist)
+
+    def attach(self, target):
+        self.attached = [self.client.socket, target]
+
+
+class Daemon(object):
+
+    def __init__(self, path, cache_ttl=CACHE_TTL):
+        self.path = path
+        self.cache_ttl = cache_ttl
+        self.clients = {}
+        self.multiplexers = {}
+        # the ControlPaths of the shared SSH connections, which are left to exit
+        # on their own (ControlPersist) since panes may still be using them:
+        self.directory = tempfile.mkdtemp(prefix='intmuxd-', dir='/tmp')
+
+    def client(self, socket):
+        if socket not in self.clients:
+            self.clients[socket] = WarmClient(socket)
+        return self.clients[socket]
+
+    def multiplexer(self, ssh_command, persist):
+        key = (ssh_command, persist)
+        if key not in self.multiplexers:
+            directory = os.path.join(self.directory, str(len(self.multiplexers)))
+            shared = multiplex.Multiplexer('intmuxd', ssh_command, persist, directory)
+            shared.shared = True
+            self.multiplexers[key] = (shared, time.monotonic())
+        shared, started = self.multiplexers[key]
+        if time.monotonic() - started > persist:
+            # idle masters may have exited, so check them again (connecting
+            # to a master that is still up is quick):
+            shared.hosts = []
+            self.multiplexers[key] = (shared, time.monotonic())
+        return shared
+
+    @contextlib.contextmanager
+    def _context(self, request, stdout, stderr):
+        """ Run with the current directory, environment and standard streams of the client's command """
+        directory = os.getcwd()
+        environment = dict(os.environ)
+        streams = (sys.stdin, sys.stdout, sys.stderr)
+        try:
+            os.chdir(request['directory'])
+            os.environ.clear()
+            os.environ.update(request['environment'])
+            sys.stdin = Input(None, request['terminal'])
+            sys.stdout, sys.stderr = stdout, stderr
+            yield
+        finally:
+            sys.stdin, sys.stdout, sys.stderr = streams
+            os.environ.clear()
+            os.environ.update(environment)
+            os.chdir(directory)
+
+    def handle(self, stream):
+        """ Run the command sent on 'stream' (see client.request) """
+        request = client.receive(stream)
+        stdout, stderr = io.StringIO(), io.StringIO()
+        session = None
+        with self._context(request, stdout, stderr):
+            try:
+                args = intmux.make_parser().parse_args(request['arguments'])
+            except SystemExit:
+                # the client prints the usage
+                args = None
+            if args is None or not runs_here(args):
+                client.send(stream, {'fallback': True})
+                return
+            client.send(stream, {'fallback': False})
+            sys.stdin = Input(client.receive(stream)['input'], request['terminal'])
+            if args.cache_ttl is None:
+                # only when it is not given: --cache-ttl 0 turns caching off
+                args.cache_ttl = self.cache_ttl
+            logger.info('running intmux {}'.format(' '.join(request['arguments'])))
+            try:
+                session = DaemonSession(args, self)
+                session.connect()
+                status = 0
+            except SystemExit as e:
+                status = exit_status(e.code)
+            except Exception as e:
+                logger.exception('intmux {} failed'.format(' '.join(request['arguments'])))
+                print('intmuxd: {}'.format(e), file=sys.stderr)
+                status = posix.EX_SOFTWARE
+            finally:
+                if args.input is not None:
+                    args.input.close()
+        client.send(stream, {
+            'status': status, 'stdout': stdout.getvalue(), 'stderr': stderr.getvalue(),
+            'attach': session.attached if session is not None else None})
+
+    def _listen(self):
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if os.path.exists(self.path):
+            try:
+                listener.connect(self.path)
+            except OSError:
+                # left behind by a daemon that didn't exit cleanly
+                os.remove(self.path)
+            else:
+                listener.close()
+                print('intmuxd is already running at {}'.format(self.path))
+                sys.exit(posix.EX_USAGE)
+            listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o077)
+        try:
+            listener.bind(self.path)
+        finally:
+            os.umask(umask)
+        listener.listen()
+        return listener
+
+    def serve(self):
+        """ Run commands until the daemon is interrupted or terminated """
+        listener = self._listen()
+        logger.info('listening at {}'.format(self.path))
+        try:
+            while True:
+                connection, _ = listener.accept()
+                connection.settimeout(TIMEOUT)
+                with connection, connection.makefile('rw') as stream:
+                    try:
+                        self.handle(stream)
+                    except (OSError, ValueError) as e:
+                        logger.warning('dropped a command: {}'.format(e))
+        finally:
+            listener.close()
+            os.remove(self.path)
+            for warm in self.clients.values():
+                warm.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Keep intmux's tmux clients, shared SSH connections and discovered hosts warm between runs.")
+    parser.add_argument(
+        '--socket', default=None, metavar='PATH',
+        help="UNIX socket to listen at (default: {})".format(client.socket_path()))
+    parser.add_argument(
+        '--cache-ttl', default=CACHE_TTL, type=float, metavar='SECONDS',
+        help="Reuse discovered hosts for SECONDS when a command has no --cache-ttl (default: {})".format(
+            CACHE_TTL))
+    parser.add_argument(
+        '--log', '-l', default="INFO",
+        help="Log level (default: INFO)")
+    args = parser.parse_args()
+    logging.basicConfig(level=getattr(logging, args.log))
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        Daemon(args.socket or client.socket_path(), args.cache_ttl).serve()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
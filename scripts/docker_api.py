@@ -0,0 +1,86 @@
+import http.client
+import json
+import logging
+import os
+import socket
+from collections import namedtuple
+from urllib.parse import urlencode, urlparse
+
+logger = logging.getLogger('docker_api')
+
+# A container as listed by 'docker ps' (IDs are shortened the same way):
+Container = namedtuple('Container', ['name', 'id', 'image', 'labels', 'state'])
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """ An HTTP connection over a UNIX socket """
+
+    def __init__(self, socket_path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class DockerClient(object):
+    """ A minimal Docker Engine API client.
+
+    'host' is a DOCKER_HOST style URL (unix:///var/run/docker.sock or
+    tcp://host:2375), and defaults to $DOCKER_HOST or the local socket.
+    """
+
+    def __init__(self, host=None, timeout=None):
+        self.host = host or os.environ.get('DOCKER_HOST') or 'unix:///var/run/docker.sock'
+        self.timeout = timeout
+
+    def _connection(self):
+        url = urlparse(self.host)
+        if url.scheme == 'unix':
+            return UnixHTTPConnection(url.path, timeout=self.timeout)
+        if url.scheme in ('tcp', 'http'):
+            return http.client.HTTPConnection(url.hostname, url.port or 2375, timeout=self.timeout)
+        raise ValueError("Unsupported docker host '{}'".format(self.host))
+
+    def get(self, path, **parameters):
+        """ GET an API path, returning the decoded JSON response """
+        if parameters:
+            path = '{}?{}'.format(path, urlencode(parameters))
+        logger.debug('GET {}{}'.format(self.host, path))
+        connection = self._connection()
+        try:
+            connection.request('GET', path)
+            response = connection.getresponse()
+            body = response.read()
+        except (OSError, http.client.HTTPException) as e:
+            raise ValueError("Could not connect to docker at {}: {}".format(self.host, e))
+        finally:
+            connection.close()
+        if response.status != 200:
+            try:
+                message = json.loads(body.decode('utf-8'))['message']
+            except (ValueError, KeyError):
+                message = body.decode('utf-8', 'replace').strip()
+            raise ValueError("Docker API error ({}): {}".format(response.status, message))
+        return json.loads(body.decode('utf-8'))
+
+    def containers(self, filters=None):
+        """ List the running containers matching 'filters' (the docker ps --filter options).
+
+        'filters' maps a filter name to a list of values, for instance:
+        {'label': ['com.docker.compose.project=app'], 'status': ['running']}
+        """
+        parameters = {}
+        if filters:
+            parameters['filters'] = json.dumps(filters)
+        return [
+            Container(
+                name=c['Names'][0].lstrip('/') if c.get('Names') else '',
+                id=c['Id'][:12],
+                image=c.get('Image', ''),
+                labels=c.get('Labels') or {},
+                state=c.get('State', ''))
+            for c in self.get('/containers/json', **parameters)]
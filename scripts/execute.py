@@ -0,0 +1,106 @@
+import logging
+import selectors
+import subprocess
+import sys
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from . import trace
+
+logger = logging.getLogger('execute')
+
+# What a command printed and how it exited. 'status' is None when the command
+# was stopped after --exec-timeout:
+Result = namedtuple('Result', ['host', 'status', 'stdout', 'stderr'])
+
+# Read this much of a command's output at a time:
+CHUNK = 65536
+
+
+def run(host, command, timeout=None, limit=None):
+    """ Run a shell command for host, returning its Result.
+
+    At most 'limit' bytes of stdout and of stderr are kept (the rest is read
+    and discarded), so the memory used per command is bounded.
+    """
+    logger.debug('{}: {}'.format(host, command))
+    process = subprocess.Popen(
+        [command], shell=True, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        bufsize=0)
+    output = {process.stdout: bytearray(), process.stderr: bytearray()}
+    deadline = None if timeout is None else time.monotonic() + timeout
+    timed_out = False
+    with selectors.DefaultSelector() as selector:
+        for stream in output:
+            selector.register(stream, selectors.EVENT_READ)
+        while len(selector.get_map()) > 0:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                process.kill()
+                timed_out = True
+                break
+            for key, _ in selector.select(remaining):
+                chunk = key.fileobj.read(CHUNK)
+                if len(chunk) == 0:
+                    selector.unregister(key.fileobj)
+                    continue
+                kept = output[key.fileobj]
+                if limit is None or len(kept) < limit:
+                    kept.extend(chunk if limit is None else chunk[:limit - len(kept)])
+    process.stdout.close()
+    process.stderr.close()
+    status = process.wait()
+    return Result(host, None if timed_out else status, bytes(output[process.stdout]), bytes(output[process.stderr]))
+
+
+def run_all(commands, workers, timeout=None, limit=None):
+    """ Run every (host, command), at most 'workers' at a time.
+
+    Returns an OrderedDict mapping each distinct (status, stdout, stderr) to the
+    hosts that produced it, in the order they finished. Identical output is
+    only kept once, no matter how many hosts printed it.
+    """
+    groups = OrderedDict()
+    lock = threading.Lock()
+
+    def execute(item):
+        with trace.command(item[1], host=item[0]):
+            result = run(item[0], item[1], timeout, limit)
+        with lock:
+            groups.setdefault(result[1:], []).append(result.host)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for future in [executor.submit(execute, item) for item in commands]:
+            future.result()
+    return groups
+
+
+def describe(status):
+    if status is None:
+        return 'timed out'
+    if status < 0:
+        return 'killed by signal {}'.format(-status)
+    return 'exit status {}'.format(status)
+
+
+def report(groups, out=sys.stdout):
+    """ Print each group of hosts with the output they share (like clush -b).
+
+    Returns the exit status for intmux: 0 when every command succeeded, or the
+    largest exit status otherwise.
+    """
+    worst = 0
+    for (status, stdout, stderr), hosts in groups.items():
+        header = '{} ({})'.format(','.join(hosts), len(hosts))
+        if status != 0:
+            header += ' - {}'.format(describe(status))
+        rule = '-' * min(len(header), 79)
+        out.write('{}\n{}\n{}\n'.format(rule, header, rule))
+        for data in (stdout, stderr):
+            text = data.decode('utf-8', 'replace')
+            out.write(text if text.endswith('\n') or len(text) == 0 else text + '\n')
+        worst = max(worst, 255 if status is None or status < 0 else status)
+    out.flush()
+    return worst
@@ -2,8 +2,9 @@ import argparse
 import logging
 import posix
 import sys
+import time
 
-from . import tmux
+from . import broadcast, connections, panelog, tmux, trace
 
 logger = logging.getLogger('intmux')
 
@@ -22,7 +23,81 @@ def add_docker_options(subparser, include_hosts=True):
     if include_hosts:
         subparser.add_argument(
             'hosts', nargs='*',
-            help=('List of docker containers to connect to (default: connect to all containers)'))
+            help=(
+                "List of docker containers to connect to: names, IDs, globs or 're:' regular "
+                "expressions (default: connect to all containers)"))
+
+
+def docker_filter(value):
+    name, _, setting = value.partition('=')
+    if name not in connections.DOCKER_FILTERS or setting == '':
+        raise argparse.ArgumentTypeError(
+            "expected NAME=VALUE, with NAME one of {}".format(', '.join(connections.DOCKER_FILTERS)))
+    return value
+
+
+def docker_group(value):
+    if value != 'image' and not (value.startswith('label=') and len(value) > len('label=')):
+        raise argparse.ArgumentTypeError("expected 'image' or 'label=NAME'")
+    return value
+
+
+def add_docker_filter_options(subparser):
+    subparser.add_argument(
+        '--filter', dest='docker_filters', action='append', type=docker_filter, default=None,
+        metavar='NAME=VALUE',
+        help=(
+            "Only connect to containers matching this 'docker ps --filter', applied by docker: "
+            "label=KEY[=VALUE], status=, ancestor= or health= (may be repeated)"))
+    subparser.add_argument(
+        '--group-by', dest='docker_group_by', type=docker_group, default=None, metavar='KEY',
+        help="Give the containers of each image ('image') or label value ('label=NAME') windows of their own")
+
+
+def add_docker_api_options(subparser):
+    subparser.add_argument(
+        '--docker-api', action='store_true',
+        help=(
+            "List containers with the Docker Engine API ($DOCKER_HOST or "
+            "/var/run/docker.sock) rather than the docker command."))
+
+
+def add_kube_options(subparser):
+    subparser.add_argument(
+        '--kubectl-command', '-kc', default='kubectl',
+        help="kubectl command (default: kubectl)")
+    subparser.add_argument(
+        '--context', dest='kube_context', default=None,
+        help="kubeconfig context to use (default: the current context)")
+    subparser.add_argument(
+        '--namespace', '-n', default=None,
+        help="Namespace of the pods (default: the context's namespace)")
+    subparser.add_argument(
+        '--all-namespaces', '-A', action='store_true',
+        help="Connect to pods in every namespace")
+    subparser.add_argument(
+        '--selector', '-l', default=None,
+        help="Only connect to pods with these labels (kubectl --selector, for instance 'app=web')")
+    subparser.add_argument(
+        '--field-selector', default='status.phase=Running',
+        help="Only connect to pods matching this kubectl --field-selector (default: status.phase=Running)")
+    subparser.add_argument(
+        '--container', dest='kube_container', default=None,
+        help="Container of each pod to connect to (default: the pod's default container)")
+    subparser.add_argument(
+        '--shell', dest='kube_shell', default='sh',
+        help="Shell to run in each pod (default: sh)")
+    subparser.add_argument(
+        '--group-by', choices=['namespace', 'node'], default=None,
+        help="Give the pods of each namespace or node windows of their own")
+    subparser.add_argument(
+        '--approximate', '-a', action='store_true',
+        help='Include any pods whose names only partially match hosts.')
+    subparser.add_argument(
+        'hosts', nargs='*',
+        help=(
+            "Pods to connect to: names, namespace/names, globs or 're:' regular expressions "
+            "(default: connect to all pods)"))
 
 
 def add_ssh_options(subparser):
@@ -30,10 +105,33 @@ def add_ssh_options(subparser):
         '--ssh-command', '-sc', default="ssh", help="SSH command (default: ssh)")
     subparser.add_argument(
         '--ssh-options', '-so', default="", help="Options to pass to SSH connection.")
+    subparser.add_argument(
+        '--ssh-multiplex', '-m', action='store_true',
+        help=(
+            "Open one shared SSH connection (ControlMaster) per host before creating "
+            "panes, and reuse it for every ssh/scp command."))
+    subparser.add_argument(
+        '--ssh-multiplex-persist', default=600, type=int, metavar='SECONDS',
+        help="Close shared SSH connections after they are idle for SECONDS (default: 600)")
+    subparser.add_argument(
+        '--preflight', choices=['tcp', 'ssh'], default=None,
+        help=(
+            "Check that every host can be reached before creating panes, by connecting to "
+            "its SSH port (tcp; hosts behind a ProxyJump or ProxyCommand are not checked) or "
+            "logging in without prompting (ssh)"))
+    subparser.add_argument(
+        '--preflight-timeout', default=3, type=float, metavar='SECONDS',
+        help="Consider hosts that don't answer within SECONDS unreachable (default: 3)")
+    subparser.add_argument(
+        '--preflight-ttl', default=60, type=float, metavar='SECONDS',
+        help="Reuse pre-flight results from the last SECONDS (default: 60, 0 to always check)")
+    subparser.add_argument(
+        '--unreachable', choices=['drop', 'window'], default='drop',
+        help="Leave unreachable hosts out (drop), or put them in a window of their own (default: drop)")
     subparser.add_argument('hosts', nargs='*', help="SSH hosts to connect to.")
 
 
-def main():
+def make_parser():
     parser = argparse.ArgumentParser(
         description="Connect to several hosts in a tmux session."
     )
@@ -41,15 +139,97 @@ def main():
     parser.add_argument(
         '--log', '-l', default="WARN",
         help="Log level (default: WARN)")
+    parser.add_argument(
+        '--trace', default=None, metavar='FILE',
+        help=(
+            "Write how long each phase and command took to FILE (a Chrome trace, "
+            "for chrome://tracing or ui.perfetto.dev), and print a summary"))
     parser.add_argument(
         '--command', '-c', default="",
         help="Command to execute when connecting to a remote host")
     parser.add_argument(
         '--input', '-i', type=argparse.FileType('r'), default=None,
         help="Read list of hosts from input file when provided.")
+    parser.add_argument(
+        '--stream', action='store_true',
+        help=(
+            "Add hosts read from STDIN or --input as they arrive, rather than after "
+            "all of them have been read"))
     parser.add_argument(
         '--script', '-s', default="",
         help="Execute commands in local file remotely (executes over --command option)")
+    parser.add_argument(
+        '--wait', action='store_true',
+        help=(
+            "Wait for the --command or --script of every pane to finish (the panes stay connected), "
+            "then print which hosts succeeded, failed or are still running, rather than attaching"))
+    parser.add_argument(
+        '--wait-timeout', default=0, type=float, metavar='SECONDS',
+        help="Stop waiting (see --wait) after SECONDS (default: 0, no limit)")
+
+    parser.add_argument(
+        '--cache-ttl', default=None, type=float, metavar='SECONDS',
+        help=(
+            "Reuse docker, compose and ssh-docker hosts discovered less than SECONDS ago, "
+            "refreshing them in the background (default: no caching, or intmuxd --cache-ttl)"))
+    parser.add_argument(
+        '--refresh', action='store_true',
+        help="Discover hosts again, ignoring any cached hosts (see --cache-ttl)")
+
+    parser.add_argument(
+        '--exec', '-x', dest='execute', action='store_true',
+        help=(
+            "Run --command on every host without tmux, and print the output of hosts "
+            "that printed the same thing together"))
+    parser.add_argument(
+        '--exec-workers', default=32, type=int, metavar='WORKERS',
+        help="Number of hosts to run --exec commands on at once (default: 32)")
+    parser.add_argument(
+        '--exec-timeout', default=None, type=float, metavar='SECONDS',
+        help="Stop --exec commands that run for longer than SECONDS (default: no limit)")
+    parser.add_argument(
+        '--exec-output-limit', default=1024 * 1024, type=int, metavar='BYTES',
+        help="Keep at most BYTES of each host's stdout and stderr with --exec (default: 1MiB)")
+
+    parser.add_argument(
+        '--max-parallel-connects', default=0, type=int, metavar='CONNECTIONS',
+        help=(
+            "Have at most CONNECTIONS panes connecting at once: the panes are created straight "
+            "away, and each waits for a turn to connect (default: 0, no limit)"))
+    parser.add_argument(
+        '--connect-rate', default=0, type=float, metavar='PER_SECOND',
+        help="Start at most PER_SECOND pane connections a second (default: 0, no limit)")
+    parser.add_argument(
+        '--connect-retries', default=3, type=int, metavar='RETRIES',
+        help=(
+            "With --max-parallel-connects or --connect-rate, retry connections that fail before "
+            "they are connected RETRIES times, waiting 1, 2, 4... seconds in between (default: 3)"))
+
+    parser.add_argument(
+        '--reconcile', '-r', action='store_true',
+        help=(
+            "When the tmux session already exists, add panes for the hosts it has no "
+            "pane for, rather than exiting"))
+    parser.add_argument(
+        '--prune', action='store_true',
+        help="With --reconcile, also close the panes of hosts that are no longer listed")
+
+    parser.add_argument(
+        '--save-plan', default=None, metavar='FILE',
+        help=(
+            "Save the hosts, windows and pane commands of the new session to FILE, so that "
+            "'intmux restore FILE' can rebuild it without discovering the hosts again"))
+    parser.add_argument(
+        '--pane-logs', default=None, metavar='DIR',
+        help=(
+            "Record everything each pane shows to DIR/SESSION/HOST (tmux pipe-pane), for "
+            "'intmux grep' to search"))
+    parser.add_argument(
+        '--pane-log-size', default=10 * 1024 * 1024, type=int, metavar='BYTES',
+        help="Start a new log once a pane's reaches BYTES, compressing the old one (default: 10MB)")
+    parser.add_argument(
+        '--pane-log-keep', default=10, type=int, metavar='LOGS',
+        help="Keep the newest LOGS compressed logs of each host (default: 10)")
 
     parser.add_argument(
         '--tmux-panes', '-p', default=6, type=int, metavar="PANES",
@@ -60,6 +240,22 @@ def main():
     parser.add_argument(
         '--tmux-session', '-t', default='intmux', metavar="SESSION",
         help="tmux session name (default: intmux)")
+    parser.add_argument(
+        '--tmux-socket', '-L', default=None, metavar="SOCKET",
+        help="tmux server socket name (tmux -L; default: tmux's default server)")
+    parser.add_argument(
+        '--broadcast-key', default=None, metavar='KEY',
+        help=(
+            "Bind KEY (after the tmux prefix) to open a window that sends what is typed "
+            "in it to every host of the session (see also 'intmux send')"))
+    parser.add_argument(
+        '--tmux-shards', default=1, type=int, metavar='SHARDS',
+        help=(
+            "Spread the panes over SHARDS tmux servers, with a console session that shows "
+            "each of them and sends what is typed to all of them (default: 1)"))
+    parser.add_argument(
+        '--tmux-control', '-C', action='store_true',
+        help="Send tmux commands over one control mode (tmux -C) client instead of a tmux process per command")
 
     subparsers = parser.add_subparsers(help='sub-command help', dest='subcommand')
 
@@ -72,6 +268,8 @@ def main():
         'docker', help="Connect to docker containers via 'docker exec'",
         description='Connect to the provided running containers (or read from STDIN).')
     add_docker_options(docker_parser)
+    add_docker_filter_options(docker_parser)
+    add_docker_api_options(docker_parser)
 
     ssh_docker_parser = subparsers.add_parser(
         'ssh-docker', help="Connect to docker containers on remote SSH hosts",
@@ -82,7 +280,14 @@ def main():
         help=(
             'Comma separated list of docker containers to connect to '
             '(default: connect to all containers)'))
+    ssh_docker_parser.add_argument(
+        '--discovery-workers', default=16, type=int, metavar='WORKERS',
+        help='Number of SSH hosts to discover containers on at once (default: 16)')
+    ssh_docker_parser.add_argument(
+        '--discovery-timeout', default=30, type=float, metavar='SECONDS',
+        help='Give up discovering containers on an SSH host after SECONDS (default: 30)')
     add_docker_options(ssh_docker_parser, include_hosts=False)
+    add_docker_filter_options(ssh_docker_parser)
 
     composer_parser = subparsers.add_parser(
         'compose', help="Connect to docker containers associated with current docker-compose via 'docker exec'",
@@ -90,13 +295,80 @@ def main():
             'Connect to containers associated with the docker-compose '
             'in the current directory.'))
     add_docker_options(composer_parser)
+    add_docker_api_options(composer_parser)
+
+    kube_parser = subparsers.add_parser(
+        'kube', help="Connect to Kubernetes pods via 'kubectl exec'",
+        description='Connect to the running pods in a namespace (or all of them) matching the provided names.')
+    add_kube_options(kube_parser)
+
+    restore_parser = subparsers.add_parser(
+        'restore', help="Rebuild a session saved with --save-plan",
+        description='Rebuild the tmux session saved in PLAN by --save-plan, without discovering hosts again.')
+    restore_parser.add_argument('plan', metavar='PLAN', help="A plan file written by --save-plan")
+
+    send_parser = subparsers.add_parser(
+        'send', help="Send keys to every host of a session, in every window",
+        description=(
+            'Type TEXT (followed by Enter) in the pane of every host of the session, or with '
+            'no TEXT, send what is typed until C-].'))
+    send_parser.add_argument(
+        '--hosts', default=None, metavar='PATTERNS',
+        help="Comma separated names, globs or 're:' regular expressions of the only hosts to send to")
+    send_parser.add_argument(
+        '--approximate', '-a', action='store_true',
+        help='Include any hosts whose names only partially match --hosts.')
+    send_parser.add_argument(
+        '--keys', '-k', action='store_true',
+        help="TEXT is tmux key names (for instance C-c) rather than text to type")
+    send_parser.add_argument(
+        '--no-enter', '-n', action='store_true', help="Don't press Enter after typing TEXT")
+    send_parser.add_argument('text', nargs='*', metavar='TEXT', help="Text to type")
 
-    args = parser.parse_args()
+    grep_parser = subparsers.add_parser(
+        'grep', help="Search the pane logs of a session (see --pane-logs)",
+        description=(
+            'Print the lines of the --pane-logs of every host of the session that match PATTERN '
+            '(a regular expression), searching the hosts in parallel.'))
+    grep_parser.add_argument(
+        '--hosts', default=None, metavar='PATTERNS',
+        help="Comma separated names, globs or 're:' regular expressions of the only hosts to search")
+    grep_parser.add_argument(
+        '--approximate', '-a', action='store_true',
+        help='Include any hosts whose names only partially match --hosts.')
+    grep_parser.add_argument(
+        '--ignore-case', '-i', action='store_true', help="Match PATTERN regardless of case")
+    grep_parser.add_argument(
+        '--fixed-strings', '-F', action='store_true', help="PATTERN is text rather than a regular expression")
+    grep_parser.add_argument(
+        '--workers', default=8, type=int, help="Number of hosts to search at once (default: 8)")
+    grep_parser.add_argument('pattern', metavar='PATTERN', help="Regular expression to search for")
+    return parser
+
+
+def main():
+    started = time.monotonic()
+    args = make_parser().parse_args()
     logging.basicConfig(level=getattr(logging, args.log))
+    if args.trace:
+        trace.enable(args.trace)
+        trace.record('parse arguments', started, time.monotonic())
 
     if not args.subcommand:
         print('You must supply a subcommand.')
         sys.exit(posix.EX_USAGE)
 
-    session = tmux.TmuxSession(args)
-    session.connect()
+    try:
+        if args.subcommand == 'restore':
+            tmux.restore(args)
+            return
+        if args.subcommand == 'send':
+            sys.exit(broadcast.run(args))
+        if args.subcommand == 'grep':
+            sys.exit(panelog.run(args))
+        session = tmux.TmuxSession(args)
+        if args.execute:
+            sys.exit(session.execute())
+        session.connect()
+    finally:
+        trace.finish()
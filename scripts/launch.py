@@ -0,0 +1,143 @@
+import itertools
+import logging
+import os
+import random
+import shlex
+
+logger = logging.getLogger('launch')
+
+# The pane option that is set once the pane's connection is up:
+UP_OPTION = '@intmux_up'
+# How long a command that can't say when it is connected (it isn't an ssh
+# with a LocalCommand) holds its slot:
+SETTLE = 2
+# The longest wait between retries, in seconds:
+MAX_BACKOFF = 30
+
+# The launchers made by this process so far (intmuxd makes one per session):
+_launchers = itertools.count()
+
+
+class Launcher(object):
+    """ Start the connections of the panes gradually (see --max-parallel-connects and --connect-rate).
+
+    The panes are all created at once, but each one's command is wrapped in a
+    shell script (see wrap) that waits its turn:
+
+    - the n-th pane waits n / 'rate' seconds, so that connections start at
+      'rate' a second
+    - it then takes one of 'parallel' slots until it is connected: ssh says
+      so with a LocalCommand (see ssh_options), and other commands are taken
+      to be connected after SETTLE seconds. The slots in use are counted in
+      a session option that is changed under a tmux wait-for lock, and the
+      panes waiting for a slot are woken whenever one is freed
+    - a command that fails before it is connected is run again after 1, 2,
+      4... seconds (and some jitter), up to 'retries' times
+
+    Everything is coordinated by the tmux server, so nothing is left running
+    once the panes are connected.
+    """
+
+    def __init__(self, parallel=0, rate=0, retries=3):
+        self.parallel = parallel
+        self.rate = rate
+        self.retries = retries
+        self.launched = 0
+        # the lock (and option) of this launcher's slots. wait-for locks
+        # outlive the panes that take them, so each launcher has its own:
+        self.channel = 'intmux_launch_{}_{}'.format(os.getpid(), next(_launchers))
+
+    def _release(self):
+        """ The shell command that frees the pane's slot, if it holds one """
+        return (
+            'set -- $(tmux wait-for -L "$INTMUX_CHANNEL" \\; display-message -p -t "$INTMUX_SESSION" '
+            '"#{@$INTMUX_CHANNEL} #{$INTMUX_SLOT}"); '
+            'if [ "$2" = 1 ]; then tmux set-option -u -t "$INTMUX_SESSION" "$INTMUX_SLOT" \\; '
+            'set-option -t "$INTMUX_SESSION" "@$INTMUX_CHANNEL" $(($1 - 1)) \\; '
+            'wait-for -S "$INTMUX_CHANNEL-free" \\; wait-for -U "$INTMUX_CHANNEL"; '
+            'else tmux wait-for -U "$INTMUX_CHANNEL"; fi')
+
+    def _acquire(self):
+        """ The shell steps that wait for a free slot, and take it """
+        return [
+            'while :',
+            'do used=$(tmux wait-for -L "$INTMUX_CHANNEL" \\; display-message -p -t "$INTMUX_SESSION" '
+            '"#{@$INTMUX_CHANNEL}")',
+            '[ "${{used:-0}}" -lt {} ] && break'.format(self.parallel),
+            # every slot is taken: wait until one is freed (the lock is only
+            # given up once this is waiting, so that isn't missed):
+            'tmux wait-for -U "$INTMUX_CHANNEL" \\; wait-for "$INTMUX_CHANNEL-free"',
+            'done',
+            'tmux set-option -t "$INTMUX_SESSION" "@$INTMUX_CHANNEL" $((${used:-0} + 1)) \\; '
+            'set-option -t "$INTMUX_SESSION" "$INTMUX_SLOT" 1 \\; wait-for -U "$INTMUX_CHANNEL"',
+        ]
+
+    def _connected(self):
+        """ The shell command that marks the pane connected, and frees its slot """
+        return '{{ tmux set-option -p -t "$TMUX_PANE" {} 1; {}; }}'.format(UP_OPTION, self._release())
+
+    def _is_connected(self):
+        return 'test "$(tmux display-message -p -t "$TMUX_PANE" \'#{{{}}}\')" = 1'.format(UP_OPTION)
+
+    def ssh_options(self, ssh_options=''):
+        """ Return ssh_options with a LocalCommand that says when a pane's ssh is connected.
+
+        It does nothing outside of the panes that wrap() launches, or when the
+        pane is already connected (by an earlier scp, for instance).
+        """
+        local = 'test -z "$INTMUX_CHANNEL" || {} || {}'.format(self._is_connected(), self._connected())
+        options = '-o PermitLocalCommand=yes -o {}'.format(shlex.quote('LocalCommand=' + local))
+        if ssh_options:
+            return '{} {}'.format(options, ssh_options)
+        return options
+
+    def wrap(self, command, reports=True):
+        """ Wrap a pane's command so that it waits its turn, and is retried when it fails.
+
+        'reports' is whether the command is an ssh that runs the LocalCommand
+        of ssh_options once it is connected. INTMUX_RETRY is 1 while a failure
+        would be retried (see completion.REPORT).
+        """
+        launched = self.launched
+        self.launched += 1
+        steps = [
+            'INTMUX_CHANNEL={}'.format(shlex.quote(self.channel)),
+            # the slots in use are counted in a session option, and the slot
+            # that a pane holds is marked in another (so that it can be freed
+            # once the pane is closed):
+            'INTMUX_SLOT="@${INTMUX_CHANNEL}_${TMUX_PANE#%}"',
+            'INTMUX_SESSION=$(tmux display-message -p -t "$TMUX_PANE" \'#{session_id}\')',
+            'export INTMUX_CHANNEL INTMUX_SLOT INTMUX_SESSION',
+            # a pane that is closed while it connects frees its slot:
+            'trap {} EXIT'.format(shlex.quote(self._release())),
+            "trap 'exit 129' HUP INT TERM",
+        ]
+        if self.rate and launched > 0:
+            steps.append('sleep {:.3f}'.format(launched / self.rate))
+        steps += [
+            'n=0',
+            'while :',
+            'do tmux set-option -p -u -t "$TMUX_PANE" {}'.format(UP_OPTION),
+            'INTMUX_RETRY=$((n < {}))'.format(self.retries),
+            'export INTMUX_RETRY',
+        ]
+        if self.parallel:
+            steps += self._acquire()
+        if not reports:
+            steps.append('(sleep {}; {}) & settle=$!'.format(SETTLE, self._connected()))
+        steps += [command, 'status=$?']
+        if not reports:
+            steps.append('kill $settle 2>/dev/null')
+        steps += [
+            '{} && exit $status'.format(self._is_connected()),
+            # it failed before it was connected, so free the slot and try again:
+            self._release(),
+            '[ $status -ne 0 ] && [ $n -lt {} ] || exit $status'.format(self.retries),
+            'n=$((n + 1))',
+            'backoff=$((1 << (n - 1)))',
+            '[ $backoff -gt {0} ] && backoff={0}'.format(MAX_BACKOFF),
+            'echo "intmux: connecting failed (status $status), retrying in $backoff seconds" >&2',
+            'sleep "$backoff.{:02d}"'.format(random.randint(0, 99)),
+            'done',
+        ]
+        return 'sh -c {}'.format(shlex.quote('; '.join(steps)))
@@ -0,0 +1,147 @@
+import logging
+from collections import namedtuple
+
+logger = logging.getLogger('layout')
+
+# The smallest pane tmux will create, in cells (tmux's PANE_MINIMUM):
+PANE_MINIMUM = 1
+
+# Where a host's pane goes. 'split' is the index of the pane in 'window' that
+# is split to make room for it ('direction' is the split-window flag, -h or
+# -v), or None when the host gets the first pane of the window. When 'tile' is
+# set the window is tiled before the split, to make room for it:
+Pane = namedtuple('Pane', ['host', 'window', 'split', 'direction', 'tile'])
+
+
+class LayoutError(ValueError):
+    """ The panes do not fit in the window """
+
+
+def split(size):
+    """ The sizes of the two panes made by splitting 'size' cells (one is lost to the border).
+
+    As in tmux's layout_split_pane, the new (second) pane gets the smaller half.
+    """
+    second = (size + 1) // 2 - 1
+    return size - 1 - second, second
+
+
+def fits(size):
+    return min(split(size)) >= PANE_MINIMUM
+
+
+def grid(count):
+    """ The (columns, rows) that 'select-layout tiled' arranges 'count' panes in """
+    rows = columns = 1
+    while rows * columns < count:
+        rows += 1
+        if rows * columns < count:
+            columns += 1
+    return columns, rows
+
+
+def fits_tiled(count, size):
+    """ Whether 'count' panes fit in a window of 'size' once it is tiled """
+    columns, rows = grid(count)
+    width, height = size
+    return (width - (columns - 1)) // columns >= PANE_MINIMUM and (height - (rows - 1)) // rows >= PANE_MINIMUM
+
+
+def tiled(count, size):
+    """ The sizes of 'count' panes after 'select-layout tiled', in the order tmux numbers them.
+
+    The panes are laid out in rows of equal cells, and the last cell of each
+    row (and the cells of the last row) get what is left over, as in tmux's
+    layout_set_tiled.
+    """
+    width, height = size
+    columns, rows = grid(count)
+    cell_width = (width - (columns - 1)) // columns
+    cell_height = (height - (rows - 1)) // rows
+    panes = []
+    for index in range(count):
+        row, column = divmod(index, columns)
+        pane_width, pane_height = cell_width, cell_height
+        if column == columns - 1 or index == count - 1:
+            pane_width = width - column * (cell_width + 1)
+        if row == rows - 1:
+            pane_height = height - row * (cell_height + 1)
+        panes.append((pane_width, pane_height))
+    return panes
+
+
+class Window(object):
+    """ The sizes of the panes in a window, in the order tmux numbers them """
+
+    def __init__(self, index, size):
+        self.index = index
+        self.size = size
+        self.panes = [size]
+
+    def __len__(self):
+        return len(self.panes)
+
+    def tile(self):
+        self.panes = tiled(len(self.panes), self.size)
+
+    def add(self):
+        """ Split the last pane, returning (its index, the split-window direction, whether to tile first).
+
+        tmux numbers the new pane after the one that is split, so splitting the
+        last pane keeps the panes in the order of the hosts. When it is too
+        small to split, the window is tiled first to give it its share.
+        """
+        tile = not (fits(self.panes[-1][0]) or fits(self.panes[-1][1]))
+        if tile:
+            self.tile()
+        index = len(self.panes) - 1
+        width, height = self.panes[index]
+        if not (fits_tiled(len(self.panes) + 1, self.size) and (fits(width) or fits(height))):
+            raise LayoutError(
+                "{} panes do not fit in a {}x{} window (see --tmux-panes)".format(len(self.panes) + 1, *self.size))
+        # cells are about twice as tall as they are wide:
+        if width > 2 * height and fits(width) or not fits(height):
+            left, right = split(width)
+            self.panes[index:] = [(left, height), (right, height)]
+            return index, '-h', tile
+        top, bottom = split(height)
+        self.panes[index:] = [(width, top), (width, bottom)]
+        return index, '-v', tile
+
+
+class Plan(object):
+    """ Place each host in a window, yielding a Pane for each as it is iterated.
+
+    'panes' is the maximum number of panes in a window (0 for no limit), and
+    'size' the (width, height) of a window. A '\\n' host starts a new window
+    for the hosts after it. Hosts are read as they are needed, so 'hosts' may
+    be a stream. Windows are numbered from 'first_window'.
+    """
+
+    def __init__(self, hosts, panes, size, first_window=0):
+        self.hosts = hosts
+        self.panes = panes
+        self.size = size
+        self.window = Window(first_window, size)
+
+    def tiled(self):
+        """ The current window was tiled since its last pane was added (see --stream) """
+        self.window.tile()
+
+    def __iter__(self):
+        separator = False
+        first = True
+        for host in self.hosts:
+            if host == '\n':
+                separator = not first
+                continue
+            if first:
+                first = False
+                yield Pane(host, self.window.index, None, None, False)
+            elif separator or len(self.window) == self.panes:
+                separator = False
+                self.window = Window(self.window.index + 1, self.size)
+                yield Pane(host, self.window.index, None, None, False)
+            else:
+                index, direction, tile = self.window.add()
+                yield Pane(host, self.window.index, index, direction, tile)
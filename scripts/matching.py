@@ -0,0 +1,161 @@
+import collections
+import fnmatch
+import logging
+import re
+
+logger = logging.getLogger('matching')
+
+# Patterns starting with this are regular expressions:
+REGEX_PREFIX = 're:'
+# Container names never contain these, so patterns that do are globs:
+GLOB_CHARACTERS = '*?['
+
+
+def expression(pattern, approximate=False):
+    """ The regular expression (for re.search) that 'pattern' stands for, or None for an exact name.
+
+    're:...' patterns are regular expressions, found anywhere in a name unless
+    they are anchored. Patterns with *, ? or [ are globs, matching the whole
+    name. Other patterns are names, which match a part of a name when
+    'approximate' (see --approximate).
+    """
+    if pattern.startswith(REGEX_PREFIX):
+        return pattern[len(REGEX_PREFIX):]
+    if any(c in pattern for c in GLOB_CHARACTERS):
+        return r'\A' + fnmatch.translate(pattern)
+    if approximate:
+        return re.escape(pattern)
+    return None
+
+
+class Automaton(object):
+    """ Find any of several substrings in a string in a single pass (Aho-Corasick) """
+
+    def __init__(self, words):
+        # each state is a dict of character -> next state, its fallback state
+        # when a character does not continue it, and the word it completes:
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [None]
+        for word in words:
+            state = 0
+            for character in word:
+                if character not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(None)
+                    self.goto[state][character] = len(self.goto) - 1
+                state = self.goto[state][character]
+            if self.output[state] is None:
+                self.output[state] = word
+
+        queue = collections.deque(self.goto[0].values())
+        while len(queue) > 0:
+            state = queue.popleft()
+            for character, following in self.goto[state].items():
+                queue.append(following)
+                fallback = self.fail[state]
+                while fallback and character not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[following] = self.goto[fallback].get(character, 0)
+                if self.output[following] is None:
+                    self.output[following] = self.output[self.fail[following]]
+
+    def search(self, text):
+        """ The first word found in 'text' (None if there are none) """
+        goto, fail, output = self.goto, self.fail, self.output
+        state = 0
+        for character in text:
+            while state and character not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(character, 0)
+            if output[state] is not None:
+                return output[state]
+        return None
+
+
+class Matcher(object):
+    """ Match names against many patterns at once.
+
+    Exact names are looked up in a set, names that may match part of a name
+    (--approximate) are found with one Automaton, and globs and regular
+    expressions are compiled into one regular expression. Matching a name then
+    costs one lookup and two searches however many patterns there are.
+    """
+
+    def __init__(self, patterns, approximate=False):
+        self.patterns = list(patterns)
+        self.exact = set()
+        self.expressions = {}
+        substrings = []
+        alternatives = []
+        for pattern in self.patterns:
+            regex = expression(pattern, approximate)
+            if regex is None:
+                self.exact.add(pattern)
+                continue
+            if expression(pattern) is None:
+                # a name that may be part of a name (approximate):
+                substrings.append(pattern)
+                self.expressions[pattern] = re.compile(regex)
+                continue
+            try:
+                self.expressions[pattern] = re.compile(regex)
+            except re.error as e:
+                raise ValueError("Invalid pattern '{}': {}".format(pattern, e))
+            alternatives.append('(?P<p{}>{})'.format(len(alternatives), regex))
+        self.substrings = Automaton(substrings) if len(substrings) > 0 else None
+        self.alternatives = [p for p in self.patterns if p in self.expressions and p not in substrings]
+        self.regex = None
+        if len(alternatives) > 0:
+            try:
+                self.regex = re.compile('|'.join(alternatives))
+            except re.error:
+                # a regex that only works on its own (a numbered backreference,
+                # for instance): search them one at a time instead
+                logger.debug('patterns could not be combined: {}'.format(self.alternatives))
+        self.matched = set()
+
+    def match(self, *names):
+        """ The first pattern that matches any of 'names' (None if none do) """
+        for name in names:
+            if name in self.exact:
+                self.matched.add(name)
+                return name
+        for name in names:
+            pattern = self._search(name)
+            if pattern is not None:
+                self.matched.add(pattern)
+                return pattern
+        return None
+
+    def _search(self, name):
+        if self.substrings is not None:
+            found = self.substrings.search(name)
+            if found is not None:
+                return found
+        if self.regex is not None:
+            found = self.regex.search(name)
+            if found is None:
+                return None
+            return self.alternatives[int(found.lastgroup[1:])]
+        for pattern in self.alternatives:
+            if self.expressions[pattern].search(name):
+                return pattern
+        return None
+
+    def unmatched(self, names):
+        """ The patterns that match none of 'names', in order.
+
+        Only the first pattern that matches a name is remembered by match(), so
+        the others are checked against 'names' here.
+        """
+        names = list(names)
+        missing = []
+        for pattern in self.patterns:
+            if pattern in self.matched:
+                continue
+            regex = self.expressions.get(pattern)
+            if regex is None or not any(regex.search(n) for n in names):
+                missing.append(pattern)
+        return missing
@@ -0,0 +1,110 @@
+import itertools
+import logging
+import os
+import shlex
+import shutil
+import subprocess
+import tempfile
+
+from . import connections, trace
+
+logger = logging.getLogger('multiplex')
+
+# The cleanup hooks added by this process so far. intmuxd adds one for each
+# session it builds, so the pid alone doesn't tell them apart:
+_hooks = itertools.count()
+
+
+def hook_name():
+    """ A session-closed hook index of its own, for cleaning up after one session """
+    # tmux hook indexes are at most 2^32 - 1, and pids at most 2^22:
+    return 'session-closed[{}]'.format(os.getpid() * 1000 + next(_hooks) % 1000)
+
+
+class Multiplexer(object):
+    """ Share one SSH connection per host between every ssh and scp command.
+
+    A ControlMaster is opened for each host up front (in parallel), and the
+    generated commands reuse it through a ControlPath in a private directory.
+    The masters exit on their own after being idle for 'persist' seconds, and
+    are closed when the tmux session is (see cleanup_hook).
+    """
+
+    def __init__(self, session, ssh_command='ssh', persist=600, directory=None):
+        self.session = session
+        self.ssh_command = ssh_command
+        self.persist = persist
+        if directory is None:
+            # keep the path short: UNIX socket paths are limited to ~100 characters
+            directory = tempfile.mkdtemp(prefix='intmux-', dir='/tmp')
+        else:
+            # the directory of a restored session (see 'intmux restore'):
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+        self.directory = directory
+        self.hosts = []
+        # outlives the session (see intmuxd), so it isn't closed along with it:
+        self.shared = False
+        self.hook_name = hook_name()
+
+    def control_path(self):
+        return os.path.join(self.directory, '%C')
+
+    def options(self, ssh_options=''):
+        """ Return ssh_options with the options to reuse the shared connections """
+        options = '-o ControlMaster=auto -o ControlPath={} -o ControlPersist={}'.format(
+            shlex.quote(self.control_path()), self.persist)
+        if ssh_options:
+            return '{} {}'.format(options, ssh_options)
+        return options
+
+    def _start_master(self, host, ssh_options, timeout):
+        command = '{} {} {} true'.format(self.ssh_command, self.options(ssh_options), host)
+        logger.debug(command)
+        try:
+            # the master stays in the background (ControlPersist), so don't
+            # wait for its output:
+            with trace.command(command):
+                subprocess.run(
+                    [command], shell=True, timeout=timeout, check=True, stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except subprocess.SubprocessError as e:
+            return connections.describe_error(e)
+
+    def start(self, hosts, ssh_options='', workers=32, timeout=30):
+        """ Open a master connection to each of the (unique) hosts in parallel """
+        hosts = [h for h in dict.fromkeys(hosts) if h not in self.hosts]
+        self.hosts.extend(hosts)
+        with trace.span('open shared ssh connections', hosts=len(hosts)):
+            errors = connections.map_in_parallel(
+                lambda host: self._start_master(host, ssh_options, timeout), hosts, workers)
+        for host, error in zip(hosts, errors):
+            if error is not None:
+                # the first pane to connect will become the master instead:
+                logger.warning('Could not open a shared SSH connection to {}: {}'.format(host, error))
+
+    def cleanup_script(self):
+        """ Write a script that closes the masters and removes the ControlPath directory """
+        script = os.path.join(self.directory, 'cleanup.sh')
+        with open(script, 'w') as f:
+            f.write('[ "$1" = {} ] || exit 0\n'.format(shlex.quote(self.session)))
+            f.write('tmux -S "$2" set-hook -gu {}\n'.format(shlex.quote(self.hook_name)))
+            for host in self.hosts:
+                f.write('{} -o ControlPath={} -O exit {} 2>/dev/null\n'.format(
+                    self.ssh_command, shlex.quote(self.control_path()), host))
+            f.write('rm -rf {}\n'.format(shlex.quote(self.directory)))
+        return script
+
+    def cleanup_hook(self):
+        """ The tmux set-hook arguments that run cleanup_script when the session closes """
+        command = "run-shell -b \"sh {} '#{{hook_session_name}}' '#{{socket_path}}'\"".format(
+            shlex.quote(self.cleanup_script()))
+        return ('set-hook', '-g', self.hook_name, command)
+
+    def stop(self):
+        """ Close the masters now (when no session was created to use them) """
+        for host in self.hosts:
+            subprocess.call(
+                ['{} -o ControlPath={} -O exit {}'.format(
+                    self.ssh_command, shlex.quote(self.control_path()), host)],
+                shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        shutil.rmtree(self.directory, ignore_errors=True)
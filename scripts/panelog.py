@@ -0,0 +1,159 @@
+""" Record what every pane shows (see --pane-logs), and search the records (see 'intmux grep').
+
+Each pane is piped (tmux pipe-pane) to ROTATE, which appends to current.log in
+a directory of the pane's host, and moves it to N.log (compressed to N.log.gz
+in the background) each time it grows to --pane-log-size bytes, keeping the
+newest --pane-log-keep of those. It is a small shell script rather than
+python, since a session may have a thousand panes.
+"""
+import collections
+import gzip
+import logging
+import os
+import posix
+import re
+import shlex
+import sys
+import threading
+
+from . import connections, matching
+
+logger = logging.getLogger('panelog')
+
+# The log that a pane is writing to:
+CURRENT = 'current.log'
+ROTATE = """# Append stdin to "$1/current.log", moving it to "$1/N.log.gz" each time it
+# grows to $2 bytes, and keeping the newest $3 of those
+mkdir -p "$1" && cd "$1" || exit 1
+size_of() { if [ -e "$1" ]; then echo $(($(wc -c < "$1"))); else echo 0; fi; }
+while :; do
+  current=$(size_of current.log)
+  if [ "$current" -ge "$2" ]; then
+    last=0
+    for segment in *.log *.log.gz; do
+      n=${segment%%.*}
+      case $n in ''|*[!0-9]*) continue ;; esac
+      [ "$n" -gt "$last" ] && last=$n
+    done
+    n=$((last + 1))
+    mv current.log "$n.log"
+    (
+      gzip -q "$n.log"
+      for segment in *.log.gz; do
+        old=${segment%%.*}
+        case $old in ''|*[!0-9]*) continue ;; esac
+        [ "$old" -le $((n - $3)) ] && rm -f "$segment"
+      done
+    ) &
+    current=0
+  fi
+  head -c $(($2 - current)) >> current.log
+  # stdin ended before the log was full:
+  [ "$(size_of current.log)" -ge "$2" ] || break
+done
+"""
+# Terminal escape sequences (colors, cursor movement, titles), left out of searches:
+ESCAPES = re.compile(r'\x1b(\[[0-?]*[ -/]*[@-~]|\][^\x07\x1b]*(\x07|\x1b\\)|[@-Z\\-_])')
+
+
+def host_directory(host):
+    """ The name of the directory of a host's logs """
+    name = re.sub(r'[^\w.@,=+-]', '_', host)
+    return '_' + name if name.startswith('.') else name
+
+
+class PaneLog(object):
+    """ The pipe-pane commands that record each pane to 'directory' """
+
+    def __init__(self, directory, size=10 * 1024 * 1024, keep=10):
+        self.directory = directory
+        self.size = size
+        self.keep = keep
+        os.makedirs(directory, exist_ok=True)
+        self.script = os.path.join(directory, '.rotate.sh')
+        with open(self.script, 'w') as f:
+            f.write(ROTATE)
+
+    def command(self, host):
+        return 'sh {} {} {} {}'.format(
+            shlex.quote(self.script), shlex.quote(os.path.join(self.directory, host_directory(host))),
+            self.size, self.keep)
+
+
+def segments(directory):
+    """ The logs of one host, oldest first.
+
+    While a segment is being compressed both N.log and a partial N.log.gz exist,
+    and the N.log is used.
+    """
+    numbered = {}
+    for name in os.listdir(directory):
+        number, _, extension = name.partition('.')
+        if number.isdigit() and extension in ('log', 'log.gz'):
+            if extension == 'log' or int(number) not in numbered:
+                numbered[int(number)] = name
+    names = [numbered[n] for n in sorted(numbered)]
+    if os.path.exists(os.path.join(directory, CURRENT)):
+        names.append(CURRENT)
+    return [os.path.join(directory, n) for n in names]
+
+
+def lines(path):
+    """ The lines of a log, without terminal escape sequences, read a little at a time """
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', errors='replace') as f:
+        for line in f:
+            yield ESCAPES.sub('', line).rstrip('\r\n').replace('\r', '')
+
+
+def search(directory, pattern, found):
+    """ Call found(line) for each line of a host's logs that matches 'pattern', returning how many did """
+    count = 0
+    for path in segments(directory):
+        try:
+            for line in lines(path):
+                if pattern.search(line) is not None:
+                    found(line)
+                    count += 1
+        except (OSError, EOFError) as e:
+            # a segment that is still being written, or was cut short:
+            logger.warning('Could not read all of {}: {}'.format(path, e))
+    return count
+
+
+def run(args):
+    """ Search the pane logs of the session for 'intmux grep', returning the exit status (like grep's) """
+    if not args.pane_logs:
+        print('Provide the --pane-logs directory to search')
+        return posix.EX_USAGE
+    directory = os.path.join(os.path.expanduser(args.pane_logs), args.tmux_session)
+    if not os.path.isdir(directory):
+        print("No logs of session '{}' in {}".format(args.tmux_session, args.pane_logs))
+        return posix.EX_USAGE
+    try:
+        pattern = re.compile(
+            re.escape(args.pattern) if args.fixed_strings else args.pattern,
+            re.IGNORECASE if args.ignore_case else 0)
+        matcher = matching.Matcher(args.hosts.split(','), args.approximate) if args.hosts else None
+    except (re.error, ValueError) as e:
+        print(e)
+        return posix.EX_USAGE
+    hosts = sorted(
+        h for h in os.listdir(directory)
+        if os.path.isdir(os.path.join(directory, h)) and (matcher is None or matcher.match(h) is not None))
+    if len(hosts) == 0:
+        print("No logs of the hosts in {}".format(directory))
+        return posix.EX_USAGE
+
+    lock = threading.Lock()
+
+    def search_host(host):
+        def found(line):
+            # lines are printed as they are found, a host's in order:
+            with lock:
+                sys.stdout.write('{}: {}\n'.format(host, line))
+        return search(os.path.join(directory, host), pattern, found)
+
+    counts = collections.Counter(dict(zip(hosts, connections.map_in_parallel(search_host, hosts, args.workers))))
+    logger.debug('matches = {}'.format(counts))
+    return 0 if sum(counts.values()) > 0 else 1
@@ -0,0 +1,126 @@
+import logging
+import shlex
+import socket
+import subprocess
+import time
+
+from . import cache, connections, trace
+
+logger = logging.getLogger('preflight')
+
+# Hosts are probed at the same time, so that the pre-flight takes about one
+# --preflight-timeout, however many hosts are unreachable:
+WORKERS = 256
+
+
+def option_address(host, ssh_options=''):
+    """ The (hostname, port) that SSH connects to for 'host' ([user@]hostname), going by its options alone """
+    hostname = host.rsplit('@', 1)[-1]
+    port = 22
+    options = shlex.split(ssh_options)
+    for i, option in enumerate(options):
+        value = None
+        if option == '-p' and i + 1 < len(options):
+            value = options[i + 1]
+        elif option.startswith('-p') and option[2:].isdigit():
+            value = option[2:]
+        elif option.lower().startswith('port='):
+            value = option.split('=', 1)[1]
+        if value is not None and value.isdigit():
+            port = int(value)
+    return hostname, port
+
+
+def address(host, ssh_options='', ssh_command='ssh', timeout=None):
+    """ The (hostname, port) that SSH connects to for 'host', or None when it connects through a proxy.
+
+    'ssh -G' reports them with ~/.ssh/config applied (HostName, Port, ProxyJump,
+    ProxyCommand). When it can't, the host and ssh options are read instead
+    (see option_address).
+    """
+    command = '{} {} -G {}'.format(ssh_command, ssh_options, shlex.quote(host))
+    try:
+        with trace.command(command):
+            output = subprocess.run(
+                [command], shell=True, timeout=timeout, check=True, stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+    except (subprocess.SubprocessError, OSError) as e:
+        logger.debug('{} failed: {}'.format(command, connections.describe_error(e)))
+        return option_address(host, ssh_options)
+    config = {}
+    for line in output.decode('utf-8', 'replace').split('\n'):
+        if ' ' in line:
+            name, value = line.split(' ', 1)
+            config.setdefault(name.lower(), value)
+    if config.get('proxyjump', 'none') != 'none' or config.get('proxycommand', 'none') != 'none':
+        return None
+    if 'hostname' not in config or not config.get('port', '').isdigit():
+        return option_address(host, ssh_options)
+    return config['hostname'], int(config['port'])
+
+
+def tcp_probe(host, ssh_options, timeout, ssh_command='ssh'):
+    """ Connect to the SSH port of host, returning why that failed (None if it didn't).
+
+    Hosts reached through a proxy are not probed: their SSH port is only
+    reachable from the proxy.
+    """
+    destination = address(host, ssh_options, ssh_command, timeout)
+    if destination is None:
+        logger.debug('not probing {}, which is reached through a proxy'.format(host))
+        return None
+    hostname, port = destination
+    try:
+        with trace.command('connect {}:{}'.format(hostname, port)):
+            socket.create_connection((hostname, port), timeout=timeout).close()
+    except OSError as e:
+        return 'timed out' if isinstance(e, socket.timeout) else str(e) or e.__class__.__name__
+    return None
+
+
+def ssh_probe(host, ssh_options, timeout, ssh_command='ssh'):
+    """ Log in to host without prompting for anything, returning why that failed (None if it didn't) """
+    command = '{} {} -o BatchMode=yes -o ConnectTimeout={} {} true'.format(
+        ssh_command, ssh_options, max(1, int(timeout)), host)
+    try:
+        with trace.command(command):
+            subprocess.run(
+                [command], shell=True, timeout=timeout + 1, check=True, stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except subprocess.SubprocessError as e:
+        return connections.describe_error(e)
+    return None
+
+
+PROBES = {'tcp': tcp_probe, 'ssh': ssh_probe}
+
+
+def unreachable(hosts, method, ssh_command, ssh_options, timeout, ttl=0):
+    """ Probe each of the hosts in parallel, returning {host: why} for the unreachable ones.
+
+    Results are cached for 'ttl' seconds (see --preflight-ttl).
+    """
+    hosts = list(dict.fromkeys(hosts))
+    key = ['preflight', method, ssh_command, ssh_options]
+    results = {}
+    if ttl:
+        entry = cache.read(key)
+        if entry is not None:
+            now = time.time()
+            results = {h: r for h, r in entry[1].items() if now - r[0] < ttl}
+
+    probe = PROBES[method]
+    unknown = [h for h in hosts if h not in results]
+    with trace.span('preflight', hosts=len(unknown)):
+        errors = connections.map_in_parallel(
+            lambda host: probe(host, ssh_options, timeout, ssh_command), unknown, WORKERS)
+    for host, error in zip(unknown, errors):
+        logger.debug('preflight {}: {}'.format(host, error or 'ok'))
+        results[host] = [time.time(), error]
+
+    if ttl and len(unknown) > 0:
+        try:
+            cache.write(key, results)
+        except OSError as e:
+            logger.warning('Could not cache pre-flight results: {}'.format(e))
+    return {h: results[h][1] for h in hosts if results[h][1] is not None}
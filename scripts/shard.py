@@ -0,0 +1,82 @@
+import os
+import shlex
+import sys
+import tempfile
+
+from . import multiplex
+
+# The height of the pane in the console session that input is typed into:
+CONSOLE_LINES = 3
+
+
+def split(hosts, count):
+    """ Split 'hosts' into at most 'count' runs of hosts of about the same length.
+
+    Window breaks ('\\n') within a run are kept, and those between runs dropped.
+    """
+    total = len([h for h in hosts if h != '\n'])
+    count = max(1, min(count, total))
+    shares = [[] for _ in range(count)]
+    current = 0
+    seen = 0
+    for host in hosts:
+        if host == '\n':
+            if len(shares[current]) > 0:
+                shares[current].append(host)
+            continue
+        index = seen * count // total
+        if index != current:
+            while len(shares[current]) > 0 and shares[current][-1] == '\n':
+                shares[current].pop()
+            current = index
+        shares[index].append(host)
+        seen += 1
+    while len(shares[current]) > 0 and shares[current][-1] == '\n':
+        shares[current].pop()
+    return shares
+
+
+def sockets(socket, session, count):
+    """ The tmux socket names (tmux -L) of the 'count' shards of 'session' """
+    return ['{}-{}-{}'.format(socket or 'intmux', session, i) for i in range(count)]
+
+
+def attach_command(socket, session):
+    """ The shell command that shows a shard in a pane of the console session """
+    return 'env -u TMUX tmux -L {} attach-session -t {}'.format(shlex.quote(socket), shlex.quote('=' + session))
+
+
+def broadcast_command(sockets, session=None):
+    """ The shell command that sends what is typed in a pane to 'session' on each of the tmux servers (see broadcast.py).
+
+    Without a 'session' it is the session of the pane the command runs in.
+    """
+    package = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    command = ['env', 'PYTHONPATH={}'.format(package), sys.executable, '-m', 'scripts.broadcast']
+    if session is not None:
+        command += ['--session', session]
+    for socket in sockets:
+        if socket:
+            command += ['--socket', socket]
+    return ' '.join(shlex.quote(a) for a in command)
+
+
+def cleanup_hook(session, sockets, then=None):
+    """ The tmux set-hook arguments that close the shards when the console 'session' closes.
+
+    'then' is a script to run afterwards, with the same arguments (see
+    Multiplexer.cleanup_script).
+    """
+    hook = multiplex.hook_name()
+    handle, script = tempfile.mkstemp(prefix='intmux-shards-', suffix='.sh', dir='/tmp')
+    with os.fdopen(handle, 'w') as f:
+        f.write('[ "$1" = {} ] || exit 0\n'.format(shlex.quote(session)))
+        f.write('tmux -S "$2" set-hook -gu {}\n'.format(shlex.quote(hook)))
+        for socket in sockets:
+            f.write('tmux -L {} kill-session -t {} 2>/dev/null\n'.format(
+                shlex.quote(socket), shlex.quote('=' + session)))
+        if then is not None:
+            f.write('sh {} "$1" "$2"\n'.format(shlex.quote(then)))
+        f.write('rm -f {}\n'.format(shlex.quote(script)))
+    command = "run-shell -b \"sh {} '#{{hook_session_name}}' '#{{socket_path}}'\"".format(shlex.quote(script))
+    return ('set-hook', '-g', hook, command)
@@ -0,0 +1,42 @@
+import json
+import logging
+import os
+import tempfile
+
+logger = logging.getLogger('snapshot')
+
+# The format of plan files (see --save-plan), bumped when it changes:
+VERSION = 1
+KEYS = ('session', 'size', 'sync', 'pane_base_index', 'windows', 'script', 'multiplex', 'commands')
+
+
+def save(path, plan):
+    """ Write 'plan' (a dict with KEYS) to 'path' as JSON.
+
+    The file is written next to 'path' and renamed over it, so a plan that is
+    being restored is never half written.
+    """
+    plan = dict(plan, version=VERSION)
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, temporary = tempfile.mkstemp(dir=directory, prefix='.intmux-plan-')
+    try:
+        with os.fdopen(handle, 'w') as f:
+            json.dump(plan, f, indent=2)
+            f.write('\n')
+        os.replace(temporary, path)
+    except OSError:
+        os.remove(temporary)
+        raise
+    logger.debug('saved plan of {} commands to {}'.format(len(plan['commands']), path))
+
+
+def load(path):
+    """ Read a plan written by save(), raising ValueError when it isn't one """
+    with open(path) as f:
+        plan = json.load(f)
+    if not isinstance(plan, dict) or plan.get('version') != VERSION:
+        raise ValueError('not an intmux plan (version {})'.format(VERSION))
+    missing = [k for k in KEYS if k not in plan]
+    if len(missing) > 0:
+        raise ValueError('missing {}'.format(', '.join(missing)))
+    return plan
@@ -0,0 +1,18 @@
+import os
+
+
+def attach_commands(socket, target, environment):
+    """ The tmux commands that attach the terminal to 'target' (or switch to it when inside tmux).
+
+    Returns the argument lists (without the -L of 'socket') to run one after
+    the other, and whether the last one needs TMUX unset, to nest a different
+    tmux server in the one the terminal is in.
+    """
+    attach = ['attach-session', '-t', target]
+    if 'TMUX' not in environment:
+        return [attach], False
+    if not socket or os.path.basename(environment['TMUX'].split(',')[0]) == socket:
+        # When quitting out of this session, just switch to some other client
+        # (since there appears to be one already)
+        return [['set-option', '-g', 'detach-on-destroy', 'off'], ['switch-client', '-t', target]], False
+    return [attach], True
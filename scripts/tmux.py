@@ -1,31 +1,286 @@
+import argparse
+import collections
+import copy
 import logging
 import os.path
+import itertools
 import posix
+import select
+import shlex
+import shutil
 import subprocess
 import sys
+import tempfile
+import threading
 
-from . import connections
+from . import (
+    cache, completion, connections, execute, launch, layout, multiplex, panelog, preflight, shard, snapshot, terminal,
+    trace)
 
 logger = logging.getLogger('tmux')
 
+# The pane option that records which host a pane is connected to (see --reconcile):
+HOST_OPTION = '@intmux_host'
 
-def tmux(command):
+
+def tmux(command, **kwargs):
     """ Run a tmux command """
     command = "tmux {}".format(command)
     logger.debug('tmux "{}"'.format(command))
-    subprocess.check_call([command], shell=True)
+    with trace.command(command):
+        subprocess.check_call([command], shell=True, **kwargs)
 
 
-def new_session(session):
-    """ Create a new tmux session"""
-    sessions = connections.check_output_as_list('tmux list-sessions -F "#S"')
-    if session in sessions:
-        print("Session '{}' already exists!".format(session))
-        sys.exit(posix.EX_USAGE)
+def quote(argument):
+    """ Quote an argument for use in a tmux configuration file or control mode """
+    argument = str(argument)
+    if '\n' in argument:
+        # control mode reads one command per line, so escape newlines within
+        # double quotes:
+        for character in '\\"$':
+            argument = argument.replace(character, '\\' + character)
+        return '"{}"'.format(argument.replace('\n', '\\n'))
+    return "'{}'".format(argument.replace("'", "'\\''"))
+
+
+def _size_options(size):
+    if size is None:
+        return []
+    return ['-x', str(size[0]), '-y', str(size[1])]
+
+
+class TmuxError(Exception):
+    """ A tmux command failed.
+
+    'command' is the list of arguments that were passed to tmux, and 'output'
+    the lines tmux printed about the failure.
+    """
+
+    def __init__(self, command, output):
+        self.command = list(command)
+        self.output = list(output)
+        super().__init__("tmux {} failed: {}".format(' '.join(self.command), ' '.join(self.output)))
+
+
+class TmuxBatch(object):
+    """ Collect tmux commands and apply them with a single tmux client.
+
+    The commands are applied with TmuxClient.apply, so the number of processes
+    spawned stays the same no matter how many commands are added.
+    """
+
+    def __init__(self):
+        self.commands = []
+
+    def __len__(self):
+        return len(self.commands)
+
+    def add(self, *arguments):
+        """ Add a tmux command, for instance: add('select-layout', '-t', 's:0', 'tiled') """
+        self.commands.append(arguments)
+
+    def lines(self):
+        """ Return each command in tmux configuration file syntax """
+        return [' '.join(quote(a) for a in command) for command in self.commands]
+
+    def render(self):
+        """ Return the commands as the contents of a tmux configuration file """
+        return ''.join(line + '\n' for line in self.lines())
+
+
+class TmuxClient(object):
+    """ Run tmux commands, spawning a tmux client for each one.
+
+    When 'socket' is provided the tmux server at that socket name is used (tmux -L).
+    """
+
+    def __init__(self, socket=None):
+        self.socket = socket
+
+    def _prefix(self):
+        if self.socket:
+            return '-L {} '.format(shlex.quote(self.socket))
+        return ''
+
+    def run(self, *arguments):
+        """ Run a tmux command and return its output as a list of lines """
+        command = 'tmux {}{}'.format(self._prefix(), ' '.join(shlex.quote(str(a)) for a in arguments))
+        try:
+            return connections.check_output_as_list(command)
+        except subprocess.CalledProcessError as e:
+            raise TmuxError(arguments, ['exit status {}'.format(e.returncode)])
+
+    def apply(self, batch):
+        """ Apply all the commands in a TmuxBatch with a single 'source-file' """
+        if len(batch) == 0:
+            return
+        logger.debug('batch of {} tmux commands:\n{}'.format(len(batch), batch.render()))
+        with tempfile.NamedTemporaryFile('w', prefix='intmux-', suffix='.conf') as source:
+            source.write(batch.render())
+            source.flush()
+            try:
+                tmux('{}source-file {}'.format(self._prefix(), source.name))
+            except subprocess.CalledProcessError as e:
+                raise TmuxError(['source-file', source.name], ['exit status {}'.format(e.returncode)])
+
+    def has_session(self, session):
+        try:
+            sessions = self.run('list-sessions', '-F', '#S')
+        except TmuxError:
+            # no server is running
+            return False
+        return session in sessions
+
+    def new_session(self, session, size=None):
+        """ Create 'session', with windows of 'size' (width, height) until a client attaches """
+        self.run('new-session', '-d', '-s', session, *_size_options(size))
+
+    def pane_base_index(self):
+        """ The index of the first pane in a window (the pane-base-index option) """
+        try:
+            value = self.run('show-options', '-gwv', 'pane-base-index')
+        except TmuxError:
+            return 0
+        return int(value[0]) if len(value) > 0 and value[0].isdigit() else 0
+
+    def attach(self, target):
+        """ Attach the current terminal to 'target' (or switch to it when inside tmux) """
+        prefix = self._prefix()
+        steps, nest = terminal.attach_commands(self.socket, target, os.environ)
+        for arguments in steps[:-1]:
+            self.run(*arguments)
+        command = '{}{}'.format(prefix, ' '.join(shlex.quote(a) for a in steps[-1]))
+        if nest:
+            # a different tmux server, so nest it:
+            current = os.environ.pop('TMUX')
+            try:
+                tmux(command)
+            finally:
+                os.environ['TMUX'] = current
+            return
+        if 'TMUX' in os.environ or sys.stdin.isatty():
+            tmux(command)
+            return
+        # hosts were piped in on stdin, so attach with the terminal instead:
+        try:
+            tty = open('/dev/tty')
+        except OSError:
+            tty = None
+        try:
+            tmux(command, stdin=tty)
+        finally:
+            if tty is not None:
+                tty.close()
+
+    def close(self):
+        pass
+
+
+class ControlClient(TmuxClient):
+    """ Run tmux commands over one persistent control mode (tmux -C) client.
+
+    Each command is written to the client's stdin and its reply is read back
+    from the %begin/%end (or %error) block tmux prints for it, so no process is
+    spawned per command. The control client attaches to the session it is
+    asked about (see has_session and new_session) and ignores its size so that
+    it does not affect the layout of that session.
+    """
+
+    def __init__(self, socket=None):
+        super().__init__(socket)
+        self.process = None
+        # commands may be sent from more than one thread (see --stream):
+        self.lock = threading.RLock()
+
+    def _start(self, *arguments):
+        command = ['tmux'] + (['-L', self.socket] if self.socket else []) + ['-C'] + list(arguments)
+        logger.debug('control mode "{}"'.format(command))
+        self.process = subprocess.Popen(
+            command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            universal_newlines=True)
+        try:
+            self._reply(arguments)
+        except TmuxError:
+            self.close()
+            raise
+        self.run('refresh-client', '-f', 'no-output,ignore-size')
+
+    def _send(self, arguments):
+        line = ' '.join(quote(a) for a in arguments)
+        logger.debug('control mode command "{}"'.format(line))
+        self.process.stdin.write(line + '\n')
+
+    def _reply(self, arguments):
+        """ Read the reply to one command, skipping any notifications """
+        output = None
+        for line in self.process.stdout:
+            line = line[:-1]
+            if output is None:
+                if line.startswith('%begin'):
+                    output = []
+                elif line.startswith('%exit'):
+                    break
+            elif line.startswith('%end'):
+                return output
+            elif line.startswith('%error'):
+                raise TmuxError(arguments, output)
+            else:
+                output.append(line)
+        raise TmuxError(arguments, ['control mode client exited'])
+
+    def run(self, *arguments):
+        if self.process is None:
+            return super().run(*arguments)
+        with self.lock, trace.command('tmux ' + ' '.join(arguments), via='control mode'):
+            self._send(arguments)
+            self.process.stdin.flush()
+            return self._reply(arguments)
+
+    def apply(self, batch):
+        """ Write every command in the batch, then read all of the replies """
+        if self.process is None:
+            return super().apply(batch)
+        errors = []
+        with self.lock, trace.command('tmux apply {} commands'.format(len(batch)), via='control mode'):
+            for command in batch.commands:
+                self._send(command)
+            self.process.stdin.flush()
+            for command in batch.commands:
+                try:
+                    self._reply(command)
+                except TmuxError as e:
+                    errors.append(e)
+        if len(errors) > 0:
+            raise errors[0]
+
+    def has_session(self, session):
+        """ Attach the control client to 'session', returning whether it exists """
+        if self.process is not None:
+            return super().has_session(session)
+        # list-sessions doesn't start a server (attach-session would, and that
+        # server could exit just as new_session connects to it):
+        if not super().has_session(session):
+            return False
+        try:
+            self._start('attach-session', '-t', '={}'.format(session))
+        except TmuxError:
+            return False
+        return True
+
+    def new_session(self, session, size=None):
+        if self.process is not None:
+            return super().new_session(session, size)
+        self._start('new-session', '-s', session, *_size_options(size))
 
-    command = "tmux new-session -d -s '{}'".format(session)
-    logger.debug('new_session "{}"'.format(command))
-    subprocess.check_call([command], shell=True)
+    def close(self):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.process.wait()
+        self.process = None
 
 
 class TmuxSession(object):
@@ -35,8 +290,10 @@ class TmuxSession(object):
         self.session = args.tmux_session
         self.panes = args.tmux_panes
         self.sync = not args.tmux_no_sync
+        self.broadcast_key = getattr(args, 'broadcast_key', None)
         self.command = args.command
         self.script = args.script
+        self.client = self.make_client(args.tmux_socket)
 
         if args.script and not os.path.exists(args.script):
             print("{} does not exist!".format(args.script))
@@ -44,93 +301,650 @@ class TmuxSession(object):
 
         if args.subcommand == 'ssh':
             self.connection_type = connections.SSHConnection
+        elif args.subcommand == 'docker' and args.docker_api:
+            self.connection_type = connections.DockerAPIConnection
         elif args.subcommand == 'docker':
             self.connection_type = connections.DockerConnection
+        elif args.subcommand == 'compose' and args.docker_api:
+            self.connection_type = connections.DockerComposeAPIConnection
         elif args.subcommand == 'compose':
             self.connection_type = connections.DockerComposeConnection
         elif args.subcommand == 'ssh-docker':
             self.connection_type = connections.SSHDockerConnection
+        elif args.subcommand == 'kube':
+            self.connection_type = connections.KubeConnection
         else:
             print('Unknown subcommand type!')
             sys.exit(posix.EX_USAGE)
 
-        self.hosts = []
+        self.stream = args.stream
+        self.reconcile = args.reconcile
+        self.prune = args.prune
+        if self.reconcile and self.stream:
+            print('--reconcile needs every host up front, so it cannot be used with --stream')
+            sys.exit(posix.EX_USAGE)
+        self.save_plan = getattr(args, 'save_plan', None)
+        if self.save_plan and self.reconcile:
+            print('--save-plan saves a new session, so it cannot be used with --reconcile')
+            sys.exit(posix.EX_USAGE)
+        # the panes and tmux commands that built the session (see --save-plan):
+        self.placed = []
+        self.commands = []
+        self.shards = getattr(args, 'tmux_shards', 1)
+        # which of the shards this session is (see _connect_shards):
+        self.shard = None
+        if self.shards > 1 and (self.stream or self.reconcile or self.save_plan):
+            print('--tmux-shards cannot be used with --stream, --reconcile or --save-plan')
+            sys.exit(posix.EX_USAGE)
+        self.input = None
+        self.received = collections.deque()
+        self.window = 0
+        # the terminal, less the status line:
+        columns, lines = shutil.get_terminal_size()
+        self.size = (columns, lines - 1)
+        self.built = False
+        self.applied = threading.Event()
+        self.ssh_options = getattr(args, 'ssh_options', '')
+        wait = getattr(args, 'wait', False)
+        if wait:
+            if not (self.command or self.script) or args.execute:
+                print('--wait waits for the --command or --script of each pane (and not for --exec)')
+                sys.exit(posix.EX_USAGE)
+            if self.stream or self.reconcile or self.shards > 1:
+                print('--wait cannot be used with --stream, --reconcile or --tmux-shards')
+                sys.exit(posix.EX_USAGE)
+            if self.save_plan:
+                # the pane commands report to this run, which a restored session outlives:
+                print('--wait cannot be used with --save-plan')
+                sys.exit(posix.EX_USAGE)
+        self.preflight = getattr(args, 'preflight', None)
+        if self.preflight and self.stream:
+            print('--preflight needs every host up front, so it cannot be used with --stream')
+            sys.exit(posix.EX_USAGE)
+
+        # The arguments are valid, so make what leaves files behind (until the
+        # session is closed, or it fails to be built):
+        self.multiplexer = None
+        if getattr(args, 'ssh_multiplex', False):
+            self.multiplexer = self.make_multiplexer()
+            args.ssh_options = self.multiplexer.options(args.ssh_options)
+        self.launcher = None
+        if args.max_parallel_connects or args.connect_rate:
+            self.launcher = launch.Launcher(args.max_parallel_connects, args.connect_rate, args.connect_retries)
+            if hasattr(args, 'ssh_options'):
+                args.ssh_options = self.launcher.ssh_options(args.ssh_options)
+        self.pane_log = None
+        if getattr(args, 'pane_logs', None):
+            self.pane_log = panelog.PaneLog(
+                os.path.join(os.path.expanduser(args.pane_logs), self.session), args.pane_log_size,
+                args.pane_log_keep)
+        self.completion = completion.Completion(self.session, args.tmux_socket) if wait else None
+        # the command that reports when a pane's task is done (see connections.then_connect):
+        args.report_status = self.completion.report_command() if self.completion is not None else None
+
+        try:
+            with trace.span('read hosts'):
+                self.hosts = self._read_hosts(args)
+        except SystemExit:
+            self._stop_multiplexer()
+            if self.completion is not None:
+                self.completion.close()
+            raise
+
+    def _read_hosts(self, args):
+        hosts = []
         # Read hosts from stdin
-        if not sys.stdin.isatty():
-            for line in sys.stdin.readlines():
-                self.hosts.append(line[:-1])
-            logger.debug('STDIN hosts = {}'.format(self.hosts))
-        elif args.input:
-            for line in args.input.readlines():
-                self.hosts.append(line[:-1])
-            logger.debug('--input hosts = {}'.format(self.hosts))
+        if not sys.stdin.isatty() or args.input:
+            self.input = args.input if sys.stdin.isatty() else sys.stdin
+            if self.stream:
+                return self._stream_hosts()
+            for line in self.input.readlines():
+                hosts.append(line[:-1])
+            logger.debug('input hosts = {}'.format(hosts))
+            hosts = self._preflight(hosts)
+            self._start_multiplexer(hosts)
         else:
+            # ssh-docker can't list the containers of unreachable hosts, so those
+            # are only kept in a window of their own for ssh:
+            args.hosts = self._preflight(args.hosts, self.connection_type is connections.SSHConnection)
+            # discovery may already use SSH (ssh-docker), so connect first:
+            self._start_multiplexer(args.hosts)
             try:
-                self.hosts = self.connection_type.hosts(args)
+                hosts = cache.hosts(self.connection_type, args)
             except ValueError as e:
                 print(e)
                 sys.exit(posix.EX_USAGE)
-            logger.debug('connection hosts = {}'.format(self.hosts))
+            logger.debug('connection hosts = {}'.format(hosts))
+
+        if len(hosts) == 0:
+            print("At least one host must be specified!\n")
+            sys.exit(posix.EX_USAGE)
+        return hosts
+
+    def _preflight(self, hosts, keep=True):
+        """ Leave out the hosts whose SSH host can't be reached (see --preflight).
 
-        if len(self.hosts) == 0:
+        With --unreachable window (and 'keep') they are moved to a window of
+        their own instead.
+        """
+        if not self.preflight:
+            return hosts
+        ssh_hosts = [self.connection_type.ssh_host(h) for h in hosts if h != '\n']
+        failures = preflight.unreachable(
+            [h for h in ssh_hosts if h is not None], self.preflight, self.args.ssh_command,
+            self.ssh_options, self.args.preflight_timeout, self.args.preflight_ttl)
+        if len(failures) == 0:
+            return hosts
+        print('{} of {} hosts are unreachable:\n{}'.format(
+            len(failures), len(set(ssh_hosts)),
+            '\n'.join('  {}: {}'.format(h, e) for h, e in sorted(failures.items()))), file=sys.stderr)
+        down = [h for h in hosts if h != '\n' and self.connection_type.ssh_host(h) in failures]
+        reachable = [h for h in hosts if h not in down]
+        if keep and self.args.unreachable == 'window':
+            return reachable + ['\n'] + down
+        return reachable
+
+    def _stream_hosts(self):
+        """ Read hosts from the input as they arrive (see --stream) """
+        lines = self._stream_lines()
+        # wait for the first host, so there is no empty session when there are none
+        first = next(lines, None)
+        if first is None:
             print("At least one host must be specified!\n")
             sys.exit(posix.EX_USAGE)
+        return itertools.chain([first], lines)
+
+    def _stream_lines(self):
+        # read the input directly, so that _input_waiting knows about every line
+        # that has been read but not used yet:
+        descriptor = self.input.fileno()
+        partial = b''
+        while True:
+            while len(self.received) > 0:
+                yield self.received.popleft()
+            chunk = os.read(descriptor, 65536)
+            if len(chunk) == 0:
+                break
+            lines = (partial + chunk).split(b'\n')
+            partial = lines.pop()
+            self.received.extend(line.decode('utf-8') for line in lines)
+        if len(partial) > 0:
+            yield partial.decode('utf-8')
+
+    def _input_waiting(self):
+        """ Whether reading the next streamed host would have to wait for it """
+        if not self.stream or len(self.received) > 0:
+            return False
+        readable, _, _ = select.select([self.input], [], [], 0)
+        return len(readable) == 0
+
+    def _plan(self, hosts, first_window=0):
+        """ Plan where each host goes, checking that the panes fit before tmux is touched """
+        plan = layout.Plan(hosts, self.panes, self.size, first_window)
+        if self.stream:
+            # hosts are still arriving, so they are placed as they are read
+            return plan
+        try:
+            return list(plan)
+        except layout.LayoutError as e:
+            print(e)
+            sys.exit(posix.EX_USAGE)
+
+    def make_client(self, socket):
+        """ The client that runs the tmux commands of the server at 'socket' (see --tmux-control) """
+        if self.args.tmux_control:
+            return ControlClient(socket)
+        return TmuxClient(socket)
+
+    def make_multiplexer(self):
+        return multiplex.Multiplexer(self.session, self.args.ssh_command, self.args.ssh_multiplex_persist)
+
+    def attach(self, target):
+        """ Attach the terminal to 'target', once the session is built """
+        with trace.span('attach'):
+            self.client.attach(target)
+
+    def _start_multiplexer(self, hosts):
+        if self.multiplexer is None:
+            return
+        ssh_hosts = [self.connection_type.ssh_host(h) for h in hosts if h != '\n']
+        # open no more connections at once than the panes would (see --max-parallel-connects):
+        workers = self.args.max_parallel_connects or 32
+        self.multiplexer.start([h for h in ssh_hosts if h is not None], self.ssh_options, workers)
+
+    def _stop_multiplexer(self):
+        if self.multiplexer is not None and not self.multiplexer.shared:
+            self.multiplexer.stop()
 
     def connect(self):
-        new_session(self.session)
+        try:
+            self._connect()
+        except TmuxError as e:
+            print(e)
+            sys.exit(posix.EX_SOFTWARE)
+        except layout.LayoutError as e:
+            print(e)
+            sys.exit(posix.EX_USAGE)
+        finally:
+            if not self.built:
+                self._stop_multiplexer()
+            self.client.close()
 
-        # turn on window activity notification:
-        tmux("set-window-option -t {} -g monitor-activity on".format(self.session))
-        tmux("set-option -t {} -g visual-activity on".format(self.session))
+    def _connect(self):
+        with trace.span('create session'):
+            exists = self.client.has_session(self.session)
+            if exists and not self.reconcile:
+                print("Session '{}' already exists!".format(self.session))
+                sys.exit(posix.EX_USAGE)
+        if exists:
+            self._reconcile()
+            return
+        if self.shards > 1:
+            self._connect_shards()
+            return
 
-        cnt = 0
-        wcnt = 0
-        first = 1
-        made_new_window = True
-        for host in self.hosts:
-            logger.debug('Host = {}'.format(host))
-            # if hostname is '\n' then make a new window
-            if host != '\n' and (cnt < self.panes or self.panes == 0):
-                if first == 0:
-                    tmux("split-window -t {}".format("{}:{}".format(self.session, wcnt)))
-                first = 0
-                cnt = cnt + 1
-            else:
-                if made_new_window and self.sync:
-                    tmux("set-option -t {}:{} synchronize-panes".format(self.session, wcnt))
-                    made_new_window = False
-                made_new_window = True
-                wcnt = wcnt + 1
-                cnt = 1
-                tmux("new-window -t {}".format(self.session))
-                tmux("rename-window -t {}:{} {}".format(self.session, wcnt, host))
-                tmux("set-window-option -t {}:{} allow-rename off".format(self.session, wcnt))
-
-            if self.script:
-                tmux("send-keys -t {}:{} \"{}\" C-m".format(
-                    self.session, wcnt, self.connection_type.copy(host, self.args)))
-            elif self.command:
-                tmux("send-keys -t {}:{} \"{}\" C-m".format(
-                    self.session, wcnt, self.connection_type.command(host, self.args)))
+        with trace.span('plan layout'):
+            self.plan = self._plan(self.hosts)
+        with trace.span('create session'):
+            self.client.new_session(self.session, self.size)
+
+        if not self.stream:
+            self._build()
+            self._save_plan()
+            if self.completion is not None:
+                sys.exit(self._wait())
+            self.attach('{}:{}'.format(self.session, self.window))
+            return
+
+        # Build the session in the background, so that it can be attached to as
+        # soon as the first hosts are added:
+        errors = []
+
+        def build():
+            try:
+                self._build()
+                self._save_plan()
+            except (TmuxError, layout.LayoutError) as e:
+                errors.append(e)
+            finally:
+                self.applied.set()
+
+        builder = threading.Thread(target=build, daemon=True)
+        builder.start()
+        self.applied.wait()
+        if self.built:
+            self.attach(self.session)
+        builder.join()
+        if len(errors) > 0:
+            raise errors[0]
+
+    def _host_panes(self):
+        """ The {pane id: host} of the panes that intmux made in the session """
+        panes = {}
+        try:
+            lines = self.client.run(
+                'list-panes', '-s', '-t', '={}'.format(self.session), '-F', '#{pane_id}\t#{' + HOST_OPTION + '}')
+        except TmuxError:
+            # the session was closed
+            return panes
+        for line in lines:
+            pane, host = line.split('\t', 1)
+            if host != '':
+                panes[pane] = host
+        return panes
+
+    def _wait(self):
+        """ Wait for the --command or --script of every pane, and summarize how it went (see --wait) """
+        panes = self._host_panes()
+        prefix = '-L {} '.format(shlex.quote(self.client.socket)) if self.client.socket else ''
+        print("Waiting for {} hosts (C-c to stop waiting, 'tmux {}attach -t {}' to see them)".format(
+            len(panes), prefix, shlex.quote(self.session)))
+        sys.stdout.flush()
+        with trace.span('wait for panes', panes=len(panes)):
+            results = self.completion.wait(panes, self.args.wait_timeout or None, self._host_panes)
+        status = completion.summarize(results, sys.stdout)
+        if all(r.status is not None for r in results):
+            self.completion.close()
+        return status
+
+    def _connect_shards(self):
+        """ Spread the hosts over several tmux servers, with a console session to use them (see --tmux-shards).
+
+        Each shard is a session of the same name, built as usual, on a tmux
+        server of its own (so no one tmux process handles every pane). The
+        console session shows each shard in a window, and sends what is typed
+        in its first window to all of them (see broadcast.py).
+        """
+        hosts = shard.split(self.hosts, self.shards)
+        sockets = shard.sockets(self.args.tmux_socket, self.session, len(hosts))
+        parts = []
+        for index, (socket, part_hosts) in enumerate(zip(sockets, hosts)):
+            part = copy.copy(self)
+            # the parts build their pane commands in parallel, and the
+            # connection types set arguments while they do (see set_argument):
+            part.args = copy.copy(self.args)
+            part.client = self.make_client(socket)
+            part.hosts = part_hosts
+            part.shard = index
+            part.window = 0
+            part.placed = []
+            part.commands = []
+            parts.append(part)
+        try:
+            with trace.span('create session'):
+                for part in parts:
+                    if part.client.has_session(self.session):
+                        print("Session '{}' already exists on tmux server {}!".format(self.session, part.client.socket))
+                        sys.exit(posix.EX_USAGE)
+            with trace.span('plan layout'):
+                for part in parts:
+                    part.plan = part._plan(part.hosts)
+
+            def build(part):
+                with trace.span('build shard', shard=part.shard):
+                    part.client.new_session(self.session, self.size)
+                    part._build()
+
+            try:
+                connections.map_in_parallel(build, parts, len(parts))
+            finally:
+                self.built = any(p.built for p in parts)
+        finally:
+            for part in parts:
+                part.client.close()
+
+        with trace.span('create session'):
+            self.client.new_session(self.session, self.size)
+        batch = TmuxBatch()
+        then = None
+        if self.multiplexer is not None and not self.multiplexer.shared:
+            then = self.multiplexer.cleanup_script()
+        batch.add(*shard.cleanup_hook(self.session, sockets, then))
+        for index, socket in enumerate(sockets):
+            window = '{}:{}'.format(self.session, index)
+            if index > 0:
+                batch.add('new-window', '-t', window)
+            batch.add('rename-window', '-t', window, 'shard-{}'.format(index))
+            batch.add('set-window-option', '-t', window, 'allow-rename', 'off')
+            batch.add('send-keys', '-t', window, shard.attach_command(socket, self.session), 'C-m')
+        # type into every shard from a pane below the first one:
+        first = '{}:0'.format(self.session)
+        batch.add('split-window', '-v', '-l', str(shard.CONSOLE_LINES), '-t', '{}.{}'.format(
+            first, self.client.pane_base_index()))
+        batch.add('send-keys', '-t', first, shard.broadcast_command(sockets, self.session), 'C-m')
+        with trace.span('apply tmux commands', commands=len(batch)):
+            self.client.apply(batch)
+        self.attach(first)
+
+    def _reconcile(self):
+        """ Add panes for the hosts that the existing session has none for (see --reconcile).
+
+        Panes are matched to hosts by their HOST_OPTION. Panes for hosts that are
+        no longer listed are killed with --prune, and otherwise left alone, as
+        are panes that intmux did not make.
+        """
+        with trace.span('list panes'):
+            lines = self.client.run(
+                'list-panes', '-s', '-t', '={}'.format(self.session),
+                '-F', '#{window_index}\t#{pane_id}\t#{' + HOST_OPTION + '}')
+        panes = [line.split('\t', 2) for line in lines]
+        wanted = collections.Counter(h for h in self.hosts if h != '\n')
+
+        # keep a pane for each host that is still wanted:
+        stale = []
+        for window, pane_id, host in panes:
+            if host == '':
+                continue
+            if wanted[host] > 0:
+                wanted[host] -= 1
             else:
-                tmux("send-keys -t {}:{} \"{}\" C-m".format(
-                    self.session, wcnt, self.connection_type.connect(host, self.args)))
+                stale.append((int(window), pane_id, host))
+        missing = []
+        for host in self.hosts:
+            if host == '\n' or wanted[host] > 0:
+                missing.append(host)
+                if host != '\n':
+                    wanted[host] -= 1
+        added = len([h for h in missing if h != '\n'])
 
-            tmux("select-layout -t {}:{} tiled".format(self.session, wcnt))
+        windows = collections.Counter(int(window) for window, _, _ in panes)
+        if self.prune and len(stale) > 0:
+            batch = TmuxBatch()
+            for window, pane_id, host in stale:
+                batch.add('kill-pane', '-t', pane_id)
+                windows[window] -= 1
+            for window in sorted({w for w, _, _ in stale}):
+                if windows[window] > 0:
+                    batch.add('select-layout', '-t', '{}:{}'.format(self.session, window), 'tiled')
+            with trace.span('remove panes', panes=len(stale)):
+                self.client.apply(batch)
+        print("Session '{}': {} panes kept, {} added, {} {}.".format(
+            self.session, len(panes) - len(stale), added, len(stale),
+            'removed' if self.prune else 'no longer listed (see --prune)'))
 
-        if made_new_window and self.sync:
-            logger.debug('synchronizing last window')
-            tmux("set-option -t {}:{} synchronize-panes".format(self.session, wcnt))
+        if added == 0:
+            self.built = True
+            self.attach(self.session)
+            return
+        with trace.span('plan layout'):
+            self.window = max(windows) + 1 if len(windows) > 0 else 0
+            self.plan = self._plan(missing, self.window)
+        self._build()
+        self.attach('{}:{}'.format(self.session, self.window))
 
-        # remove session 0 - which is not connected to anything
-        # TODO provide a hotkey to run in all sessions
+    def execute(self):
+        """ Run --command on every host without tmux, printing the output grouped by host (see --exec) """
+        if not self.command or self.script:
+            print("--exec runs --command on each host (--script is not supported)")
+            sys.exit(posix.EX_USAGE)
+        commands = (
+            (host, self.connection_type.execute(host, self.args)) for host in self.hosts if host != '\n')
+        try:
+            groups = execute.run_all(
+                commands, self.args.exec_workers, self.args.exec_timeout, self.args.exec_output_limit)
+        finally:
+            self._stop_multiplexer()
+        return execute.report(groups)
 
-        # Detect if we are already in a session. If we are, just switch to the other
-        # session:
-        if 'TMUX' in os.environ:
-            # When quitting out of this session, just switch to some other client
-            # (since there appears to be one already)
-            tmux("set-option -g detach-on-destroy off")
-            tmux("switch-client -t {}:{}".format(self.session, wcnt))
-        else:
-            tmux("attach-session -t {}:{}".format(self.session, wcnt))
+    def _build(self):
+        batch = TmuxBatch()
+        pending = []
+        # turn on window activity notification:
+        batch.add('set-window-option', '-t', self.session, '-g', 'monitor-activity', 'on')
+        batch.add('set-option', '-t', self.session, '-g', 'visual-activity', 'on')
+        if self.broadcast_key and self.shard is None:
+            # open a window that sends what is typed in it to every host. The key
+            # binding is global to the server, so the window finds the session
+            # it was opened in rather than naming this one:
+            batch.add(
+                'bind-key', self.broadcast_key, 'new-window', '-n', 'broadcast',
+                shard.broadcast_command([self.client.socket]))
+
+        base = self.client.pane_base_index()
+        for pane in self.plan:
+            with trace.span('pane setup', host=pane.host):
+                logger.debug('Host = {}'.format(pane.host))
+                window = '{}:{}'.format(self.session, pane.window)
+                if pane.window != self.window:
+                    self._finish_window(batch, self.window)
+                    self.window = pane.window
+                if pane.tile:
+                    batch.add('select-layout', '-t', window, 'tiled')
+                if pane.split is not None:
+                    batch.add('split-window', pane.direction, '-t', '{}.{}'.format(window, base + pane.split))
+                elif pane.window > 0:
+                    batch.add('new-window', '-t', window)
+                    batch.add('rename-window', '-t', window, pane.host)
+                    batch.add('set-window-option', '-t', window, 'allow-rename', 'off')
+                # the new pane is the active one in its window:
+                batch.add('set-option', '-p', '-t', window, HOST_OPTION, pane.host)
+                if self.pane_log is not None:
+                    # record everything the pane shows (see --pane-logs):
+                    batch.add('pipe-pane', '-o', '-t', window, self.pane_log.command(pane.host))
+
+                if self.script:
+                    command = self.connection_type.copy(pane.host, self.args)
+                elif self.command:
+                    command = self.connection_type.command(pane.host, self.args)
+                else:
+                    command = self.connection_type.connect(pane.host, self.args)
+                if self.launcher is not None:
+                    # connections through a shared SSH connection don't run LocalCommand:
+                    reports = self.multiplexer is None and self.connection_type.ssh_host(pane.host) is not None
+                    command = self.launcher.wrap(command, reports)
+                batch.add('send-keys', '-t', window, command, 'C-m')
+                pending.append(pane.host)
+                self.placed.append(pane)
+
+            if self._input_waiting():
+                # more hosts are on their way: show the ones we have so far
+                batch.add('select-layout', '-t', window, 'tiled')
+                self.plan.tiled()
+                self._apply(batch, pending)
+                batch, pending = TmuxBatch(), []
+
+        self._finish_window(batch, self.window)
+        self._apply(batch, pending)
+
+    def _save_plan(self):
+        """ Write the session that was just built to --save-plan (see 'intmux restore') """
+        if not self.save_plan:
+            return
+        windows = collections.OrderedDict()
+        for pane in self.placed:
+            windows.setdefault(pane.window, []).append(pane.host)
+        multiplexed = None
+        if self.multiplexer is not None:
+            multiplexed = {
+                'directory': self.multiplexer.directory,
+                'ssh_command': self.multiplexer.ssh_command,
+                'persist': self.multiplexer.persist,
+                'ssh_options': self.ssh_options,
+                'hosts': self.multiplexer.hosts,
+            }
+        staging = None
+        if self.script:
+            # what the connection type's stage() needs to copy --script again:
+            staging = {
+                'connection': self.connection_type.__name__,
+                'hosts': [pane.host for pane in self.placed],
+                'ssh_command': getattr(self.args, 'ssh_command', 'ssh'),
+                'ssh_options': getattr(self.args, 'ssh_options', ''),
+                'discovery_workers': getattr(self.args, 'discovery_workers', 32),
+            }
+        with trace.span('save plan'):
+            try:
+                snapshot.save(self.save_plan, {
+                    'session': self.session,
+                    'size': self.size,
+                    'sync': self.sync,
+                    'pane_base_index': self.client.pane_base_index(),
+                    'windows': [{'index': i, 'hosts': h} for i, h in windows.items()],
+                    'script': self.script,
+                    'stage': staging,
+                    'multiplex': multiplexed,
+                    'commands': [list(c) for c in self.commands],
+                })
+            except OSError as e:
+                print('Could not save the plan to {}: {}'.format(self.save_plan, e), file=sys.stderr)
+
+    def _finish_window(self, batch, index):
+        """ Lay out a window once all of its panes have been added """
+        window = '{}:{}'.format(self.session, index)
+        batch.add('select-layout', '-t', window, 'tiled')
+        if self.sync:
+            batch.add('set-option', '-t', window, 'synchronize-panes')
+
+    def _apply(self, batch, hosts):
+        """ Apply a batch of commands that adds panes for 'hosts' """
+        self._start_multiplexer(hosts)
+        if self.script:
+            with trace.span('stage script', hosts=len(hosts)):
+                self.connection_type.stage(hosts, self.args)
+        # the cleanup hook is made again when the plan is restored:
+        self.commands.extend(batch.commands)
+        if self.multiplexer is not None and self.shard is None and not self.multiplexer.shared:
+            # close the shared SSH connections along with the session (or
+            # with the console session of shards, see _connect_shards):
+            batch.add(*self.multiplexer.cleanup_hook())
+
+        with trace.span('apply tmux commands', commands=len(batch)):
+            self.client.apply(batch)
+        self.built = True
+        self.applied.set()
+
+
+def _stage(script, staging):
+    """ Copy the script of a restored session to its hosts again, when they need it before the panes do """
+    connection_type = getattr(connections, staging['connection'], None)
+    if not (isinstance(connection_type, type) and issubclass(connection_type, connections.Connection)):
+        print('Unknown connection type {} in the plan!'.format(staging['connection']))
+        sys.exit(posix.EX_USAGE)
+    args = argparse.Namespace(
+        script=script, ssh_command=staging['ssh_command'], ssh_options=staging['ssh_options'],
+        discovery_workers=staging['discovery_workers'], report_status=None)
+    with trace.span('stage script', hosts=len(staging['hosts'])):
+        connection_type.stage(staging['hosts'], args)
+
+
+def restore(args):
+    """ Rebuild a session saved with --save-plan, without discovering its hosts again.
+
+    The saved tmux commands are applied in one batch, so restoring costs the
+    same few tmux processes however many hosts the session has.
+    """
+    try:
+        plan = snapshot.load(args.plan)
+    except (OSError, ValueError) as e:
+        print('Could not read the plan {}: {}'.format(args.plan, e))
+        sys.exit(posix.EX_USAGE)
+    if plan['script'] and not os.path.exists(plan['script']):
+        print("{} does not exist!".format(plan['script']))
+        sys.exit(posix.EX_USAGE)
+    session = plan['session']
+    if args.tmux_control:
+        client = ControlClient(args.tmux_socket)
+    else:
+        client = TmuxClient(args.tmux_socket)
+
+    multiplexer = None
+    built = False
+    try:
+        with trace.span('create session'):
+            if client.has_session(session):
+                print("Session '{}' already exists!".format(session))
+                sys.exit(posix.EX_USAGE)
+        batch = TmuxBatch()
+        if plan['multiplex'] is not None:
+            saved = plan['multiplex']
+            multiplexer = multiplex.Multiplexer(
+                session, saved['ssh_command'], saved['persist'], saved['directory'])
+            multiplexer.start(saved['hosts'], saved['ssh_options'])
+        if plan.get('stage') is not None:
+            _stage(plan['script'], plan['stage'])
+        with trace.span('create session'):
+            client.new_session(session, plan['size'])
+
+        # the panes are numbered from the pane-base-index of this server:
+        offset = client.pane_base_index() - plan['pane_base_index']
+        for command in plan['commands']:
+            if offset != 0 and command[0] == 'split-window':
+                target, index = command[-1].rsplit('.', 1)
+                command = command[:-1] + ['{}.{}'.format(target, int(index) + offset)]
+            batch.add(*command)
+        if multiplexer is not None:
+            batch.add(*multiplexer.cleanup_hook())
+        with trace.span('apply tmux commands', commands=len(batch)):
+            client.apply(batch)
+        built = True
+
+        windows = [w['index'] for w in plan['windows']]
+        with trace.span('attach'):
+            client.attach('{}:{}'.format(session, max(windows) if len(windows) > 0 else 0))
+    except TmuxError as e:
+        print(e)
+        sys.exit(posix.EX_SOFTWARE)
+    finally:
+        if multiplexer is not None and not built:
+            multiplexer.stop()
+        client.close()
@@ -0,0 +1,139 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger('trace')
+
+# Spans in this category are commands intmux ran (see summary):
+COMMAND = 'command'
+PHASE = 'phase'
+
+_tracer = None
+
+
+class Tracer(object):
+    """ Record how long each phase and command takes, as Chrome trace events.
+
+    The events are written as a Chrome trace / Perfetto JSON file (open it in
+    https://ui.perfetto.dev or chrome://tracing).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.events = []
+        self.lock = threading.Lock()
+
+    def record(self, name, category, start, end, arguments=None):
+        """ Record a span that ran from 'start' to 'end' (time.monotonic() values) """
+        event = {
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': int(start * 1e6),
+            'dur': int((end - start) * 1e6),
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+        }
+        if arguments:
+            event['args'] = arguments
+        with self.lock:
+            self.events.append(event)
+
+    def write(self):
+        with open(self.path, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+
+    def summary(self, out, slowest=5):
+        """ Print the total time of each phase, and of the commands that were run """
+        phases = OrderedDict()
+        commands = []
+        for event in sorted(self.events, key=lambda e: e['ts']):
+            if event['cat'] == COMMAND:
+                commands.append(event)
+            else:
+                count, total = phases.get(event['name'], (0, 0))
+                phases[event['name']] = (count + 1, total + event['dur'])
+        out.write('{:<40} {:>6} {:>10}\n'.format('phase', 'count', 'total'))
+        for name, (count, total) in phases.items():
+            out.write('{:<40} {:>6} {:>9.3f}s\n'.format(name[:40], count, total / 1e6))
+        total = sum(e['dur'] for e in commands)
+        out.write('{} commands run, {:.3f}s in total. Slowest:\n'.format(len(commands), total / 1e6))
+        for event in sorted(commands, key=lambda e: -e['dur'])[:slowest]:
+            out.write('  {:>9.3f}s {}\n'.format(event['dur'] / 1e6, event['name'][:100]))
+        out.flush()
+
+
+class Span(object):
+    """ Time a block of code: with span('name'): ... """
+
+    def __init__(self, tracer, name, category, arguments):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.arguments = arguments
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exception):
+        self.tracer.record(self.name, self.category, self.start, time.monotonic(), self.arguments)
+        return False
+
+
+class NoSpan(object):
+    """ A Span that does nothing, for when tracing is off """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        return False
+
+
+NO_SPAN = NoSpan()
+
+
+def enable(path):
+    """ Start tracing, to write to 'path' when finish() is called (see --trace) """
+    global _tracer
+    _tracer = Tracer(path)
+    return _tracer
+
+
+def enabled():
+    return _tracer is not None
+
+
+def record(name, start, end, category=PHASE, **arguments):
+    if _tracer is not None:
+        _tracer.record(name, category, start, end, arguments)
+
+
+def span(name, category=PHASE, **arguments):
+    """ Time a phase (or with category=COMMAND, a command) when tracing is enabled """
+    if _tracer is None:
+        return NO_SPAN
+    return Span(_tracer, name, category, arguments)
+
+
+def command(name, **arguments):
+    """ Time a command that intmux runs """
+    return span(name, COMMAND, **arguments)
+
+
+def finish(out=sys.stderr):
+    """ Write the trace file and print a summary of it """
+    global _tracer
+    if _tracer is None:
+        return
+    tracer, _tracer = _tracer, None
+    try:
+        tracer.write()
+    except OSError as e:
+        logger.warning('Could not write trace {}: {}'.format(tracer.path, e))
+    tracer.summary(out)
@@ -31,7 +31,7 @@ setup(
         'scripts'
     ],
     entry_points={
-        'console_scripts': ['intmux = scripts.intmux:main']
+        'console_scripts': ['intmux = scripts.client:main', 'intmuxd = scripts.daemon:main']
     },
     setup_requires=['pytest-runner'],
     tests_require=['pytest']
@@ -0,0 +1,18 @@
+from benchmarks import benchmark
+
+
+def test_run():
+    for subcommand in benchmark.SUBCOMMANDS:
+        result = benchmark.run(subcommand, 3)
+        assert result['exit_status'] == 0, result.get('output')
+        assert result['spawns_by_command']['tmux'] > 0
+        assert result['max_rss'] > 0
+
+
+def test_compare(capsys):
+    before = {'results': [{'subcommand': 'ssh', 'hosts': 10, 'arguments': [], 'wall_time': 1.0, 'spawns': 5}]}
+    after = {'results': [{'subcommand': 'ssh', 'hosts': 10, 'arguments': [], 'wall_time': 1.1, 'spawns': 5}]}
+    assert not benchmark.compare(before, after, 1.25)
+    after['results'][0]['spawns'] = 6
+    assert benchmark.compare(before, after, 1.25)
+    assert 'regression' in capsys.readouterr().out
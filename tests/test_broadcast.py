@@ -0,0 +1,112 @@
+from mock import MagicMock, patch
+from scripts import broadcast, matching
+
+PANES = [
+    # a synchronized window with a pane the user made:
+    '@0\t%0\t1\thost1', '@0\t%1\t1\thost2', '@0\t%2\t1\t',
+    # a synchronized window of intmux panes:
+    '@1\t%3\t1\thost3', '@1\t%4\t1\thost4',
+    '@2\t%5\t0\thost5', '@2\t%6\t0\thost6',
+]
+
+
+def test_select():
+    assert broadcast.select(PANES) == [
+        broadcast.Target('@0', True, ['%0', '%1']),
+        broadcast.Target('@1', False, ['%3']),
+        broadcast.Target('@2', False, ['%5', '%6']),
+    ]
+    assert broadcast.select(PANES, matching.Matcher(['host4', 're:[56]$'])) == [
+        broadcast.Target('@1', True, ['%4']),
+        broadcast.Target('@2', False, ['%5', '%6']),
+    ]
+
+
+def test_batch():
+    keys = [['-l', 'ls'], ['Enter']]
+    assert broadcast.batch(broadcast.select(PANES[:5]), keys).commands == [
+        ('set-option', '-w', '-t', '@0', 'synchronize-panes', 'off'),
+        ('send-keys', '-t', '%0', '-l', 'ls'),
+        ('send-keys', '-t', '%0', 'Enter'),
+        ('send-keys', '-t', '%1', '-l', 'ls'),
+        ('send-keys', '-t', '%1', 'Enter'),
+        ('set-option', '-w', '-t', '@0', 'synchronize-panes', 'on'),
+        ('send-keys', '-t', '%3', '-l', 'ls'),
+        ('send-keys', '-t', '%3', 'Enter'),
+    ]
+
+
+def test_hexadecimal():
+    assert broadcast.hexadecimal(b'l\r') == [['-H', '6c', '0d']]
+    assert [len(k) for k in broadcast.hexadecimal(b'x' * 300)] == [257, 45]
+
+
+def _send_args(text, hosts=None):
+    args = MagicMock()
+    args.tmux_session = 'intmux'
+    args.tmux_socket = None
+    args.tmux_shards = 1
+    args.tmux_control = False
+    args.hosts = hosts
+    args.approximate = False
+    args.keys = False
+    args.no_enter = False
+    args.text = text
+    return args
+
+
+@patch('scripts.broadcast.tmux.TmuxClient')
+def test_run(client_class):
+    client = client_class.return_value
+    client.has_session.return_value = True
+    client.run.return_value = PANES
+    assert broadcast.run(_send_args(['uptime'], 'host5')) == 0
+    # one batch, with every key for every pane in it:
+    assert client.apply.call_count == 1
+    assert client.apply.call_args[0][0].commands == [
+        ('send-keys', '-t', '%5', '-l', 'uptime'), ('send-keys', '-t', '%5', 'Enter')]
+
+    assert broadcast.run(_send_args(['uptime'], 'missing,nope')) != 0
+
+
+@patch('scripts.broadcast.tmux.ControlClient')
+def test_broadcaster(client_class):
+    clients = [MagicMock(socket='a'), MagicMock(socket='b')]
+    client_class.side_effect = clients
+    for client in clients:
+        client.has_session.return_value = True
+        client.run.return_value = PANES[3:5]
+    clients[1].has_session.return_value = False
+
+    broadcaster = broadcast.Broadcaster(['a', 'b'], 'intmux')
+    broadcaster.send(b'l')
+    broadcaster.send(b's\r')
+    broadcaster.close()
+
+    # the keys reach the shards that have the session:
+    assert broadcaster.clients == clients[:1]
+    sent = []
+    for call in clients[0].apply.call_args_list:
+        for command in call[0][0].commands:
+            assert command[:4] == ('send-keys', '-t', '%3', '-H')
+            sent.extend(command[4:])
+    assert sent == ['6c', '73', '0d']
+    assert not clients[1].apply.called
+
+
+@patch('scripts.broadcast.interactive')
+@patch('scripts.broadcast.tmux.TmuxClient')
+def test_main_pane_session(client_class, interactive):
+    # the --broadcast-key window is bound for every session of the server, so
+    # it sends to the session it was opened in:
+    client_class.return_value.run.return_value = ['other']
+    with patch('sys.argv', ['broadcast', '--socket', 'work']), \
+            patch.dict('os.environ', {'TMUX_PANE': '%7'}):
+        broadcast.main()
+    client_class.assert_called_with('work')
+    client_class.return_value.run.assert_called_with('display-message', '-p', '-t', '%7', '#{session_name}')
+    interactive.assert_called_with(['work'], 'other')
+
+    with patch('sys.argv', ['broadcast', '--session', 'intmux']):
+        broadcast.main()
+    interactive.assert_called_with([None], 'intmux')
@@ -0,0 +1,93 @@
+import os
+import time
+
+import pytest
+from mock import MagicMock, patch
+from scripts import cache, connections
+
+
+class FakeConnection(connections.Connection):
+    found = ['containerid1', 'containerid2']
+    calls = 0
+
+    @classmethod
+    def discovery_key(cls, parsed_args):
+        return ['FakeConnection', parsed_args.hosts]
+
+    @classmethod
+    def hosts(cls, parsed_args):
+        cls.calls += 1
+        return list(cls.found)
+
+
+@pytest.fixture(autouse=True)
+def cache_home(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    FakeConnection.calls = 0
+    return tmp_path
+
+
+def _args(ttl=60, refresh=False):
+    args = MagicMock()
+    args.hosts = ['one']
+    args.cache_ttl = ttl
+    args.refresh = refresh
+    return args
+
+
+@patch('scripts.cache.revalidate_in_background')
+def test_cached(background_mock, cache_home):
+    assert cache.hosts(FakeConnection, _args()) == ['containerid1', 'containerid2']
+    assert FakeConnection.calls == 1
+    assert not background_mock.called
+
+    # The second time the cached hosts are used, and refreshed in the background:
+    FakeConnection.found = ['containerid3']
+    assert cache.hosts(FakeConnection, _args()) == ['containerid1', 'containerid2']
+    assert FakeConnection.calls == 1
+    assert background_mock.called
+
+    # Only the entry itself is left in the cache directory:
+    assert len(os.listdir(cache.cache_directory())) == 1
+
+
+@patch('scripts.cache.revalidate_in_background')
+def test_not_cached(background_mock):
+    FakeConnection.found = ['containerid1']
+    cache.hosts(FakeConnection, _args())
+
+    # --refresh:
+    cache.hosts(FakeConnection, _args(refresh=True))
+    assert FakeConnection.calls == 2
+
+    # No TTL:
+    cache.hosts(FakeConnection, _args(ttl=0))
+    assert FakeConnection.calls == 3
+
+    # Expired:
+    with patch('scripts.cache.time.time', return_value=time.time() + 120):
+        cache.hosts(FakeConnection, _args())
+    assert FakeConnection.calls == 4
+
+    # A different key:
+    args = _args()
+    args.hosts = ['two']
+    cache.hosts(FakeConnection, args)
+    assert FakeConnection.calls == 5
+    assert not background_mock.called
+
+
+def test_revalidate():
+    FakeConnection.found = ['containerid1']
+    key = FakeConnection.discovery_key(_args())
+    cache.revalidate(FakeConnection, _args(), key)
+    assert cache.read(key)[1] == ['containerid1']
+
+    # Failures leave the cached hosts alone:
+    with patch.object(FakeConnection, 'hosts', side_effect=ValueError('no containers')):
+        cache.revalidate(FakeConnection, _args(), key)
+    assert cache.read(key)[1] == ['containerid1']
+
+
+def test_ssh_is_not_cached():
+    assert connections.SSHConnection.discovery_key(_args()) is None
@@ -0,0 +1,84 @@
+import io
+import os
+import subprocess
+
+import pytest
+from mock import patch
+from scripts import completion
+
+
+@pytest.fixture
+def done(tmp_path, monkeypatch):
+    """ A Completion, with a stub tmux that logs the channels it is asked to signal """
+    stub = tmp_path / 'tmux'
+    stub.write_text('#!/bin/sh\necho "$*" >> "{}"\n'.format(tmp_path / 'log'))
+    stub.chmod(0o755)
+    monkeypatch.setenv('PATH', '{}:{}'.format(tmp_path, os.environ['PATH']))
+    waiting = completion.Completion('intmux')
+    yield waiting
+    waiting.close()
+
+
+def _report(done, pane, status, started=100, retry='0'):
+    command = '{} {} {}'.format(done.report_command(), status, started)
+    return subprocess.call([command], shell=True, env=dict(os.environ, TMUX_PANE=pane, INTMUX_RETRY=retry))
+
+
+def test_report(done, tmp_path):
+    assert _report(done, '%3', 0) == 0
+    assert _report(done, '%12', 2) == 2
+    reports = done.reports()
+    assert sorted(reports) == ['%12', '%3']
+    assert reports['%12'][:2] == (2, 100)
+    assert (tmp_path / 'log').read_text().split('\n')[:2] == ['wait-for -S ' + done.channel] * 2
+
+
+def test_report_retried(done):
+    # the connection failed, and the pane will try again (see launch.py):
+    assert _report(done, '%3', 255, retry='1') == 255
+    assert done.reports() == {}
+    assert _report(done, '%3', 0, retry='1') == 0
+    assert list(done.reports()) == ['%3']
+
+
+def test_wait(done):
+    _report(done, '%1', 0)
+    _report(done, '%2', 1)
+    with patch.object(done, '_sleep') as sleep:
+        results = done.wait({'%1': 'web1', '%2': 'web2'})
+    sleep.assert_not_called()
+    assert [(r.host, r.status) for r in results] == [('web1', 0), ('web2', 1)]
+
+
+def test_wait_timeout(done):
+    _report(done, '%1', 0)
+
+    def sleep(timeout):
+        # a report arrives, but not the other one:
+        _report(done, '%2', 0)
+    with patch.object(done, '_sleep', side_effect=sleep) as sleeper, \
+            patch.object(completion.time, 'time', side_effect=[done.started + 1, done.started + 3, done.started + 3]):
+        results = done.wait({'%1': 'web1', '%2': 'web2', '%3': 'web3'}, timeout=2)
+    sleeper.assert_called_once_with(1)
+    assert [(r.host, r.status) for r in results] == [('web1', 0), ('web2', 0), ('web3', None)]
+    assert results[2].seconds == 3
+
+
+def test_wait_closed(done):
+    with patch.object(done, '_sleep') as sleep:
+        results = done.wait({'%1': 'web1'}, list_panes=lambda: {'%4': 'other'})
+    sleep.assert_not_called()
+    assert results[0].status is None
+
+
+def test_summarize():
+    out = io.StringIO()
+    status = completion.summarize([
+        completion.Result('web1', 0, 2), completion.Result('db1', 3, 1.5), completion.Result('web10', None, 30.2)], out)
+    assert status == 255
+    assert out.getvalue() == (
+        '1 succeeded, 1 failed, 1 still running\n'
+        '  failed     db1    exit 3, 1s\n'
+        '  running    web10  30s\n'
+        '  succeeded  web1   2s\n')
+    assert completion.summarize([completion.Result('a', 0, 1), completion.Result('b', 2, 1)], io.StringIO()) == 2
@@ -1,8 +1,68 @@
+import json
+import subprocess
+
 import pytest
 from mock import MagicMock, patch
 from scripts import connections
 
 
+# sha256 of 'echo hi\n':
+SCRIPT_PATH = '/tmp/intmux-ab08508fdf5ca4da5c4995987bc41c56c048aaa5eeb046417ae4049b7d40286e'
+
+
+@pytest.fixture
+def script(tmp_path):
+    script = tmp_path / 'test.sh'
+    script.write_text('echo hi\n')
+    return str(script)
+
+
+def test_staged_path(script, tmp_path, monkeypatch):
+    assert connections.staged_path(script) == SCRIPT_PATH
+    # the same name in another directory (intmuxd runs commands from many):
+    other = tmp_path / 'other'
+    other.mkdir()
+    (other / 'test.sh').write_text('echo bye\n')
+    monkeypatch.chdir(str(other))
+    assert connections.staged_path('test.sh') != SCRIPT_PATH
+    # and the script once it is edited:
+    with open(script, 'a') as f:
+        f.write('echo again\n')
+    assert connections.staged_path(script) not in (SCRIPT_PATH, connections.staged_path('test.sh'))
+
+
+class TestSSHConnection:
+    def test_copy(self, script):
+        args = MagicMock()
+        args.report_status = None
+        args.ssh_command = 'ssh'
+        args.ssh_options = '-p 2222'
+        args.script = script
+
+        assert ('ssh -p 2222 host1 test -O {staged} -a -x {staged} || ('
+                'scp -p 2222 {script} host1:{staged} && ssh -p 2222 host1 chmod u+x {staged}) && '
+                'ssh -p 2222 host1 {staged} && ssh -p 2222 host1').format(staged=SCRIPT_PATH, script=script) == \
+            connections.SSHConnection.copy('host1', args)
+
+    def test_execute(self):
+        args = MagicMock()
+        args.report_status = None
+        args.ssh_command = 'ssh'
+        args.ssh_options = '-p 2222'
+        args.command = 'uptime'
+        assert 'ssh -p 2222 host1 uptime' == connections.SSHConnection.execute('host1', args)
+
+    def test_command_reports_status(self):
+        """ With --wait the command's exit status is reported, and the pane's shell is left """
+        args = MagicMock()
+        args.report_status = 'sh report.sh'
+        args.ssh_command = 'ssh'
+        args.ssh_options = ''
+        args.command = 'uptime'
+        assert 'intmux_started=$(date +%s); ssh  host1 uptime; sh report.sh $? "$intmux_started"' == \
+            connections.SSHConnection.command('host1', args)
+
+
 @patch('scripts.connections.check_output_as_list')
 class TestDockerConnection:
     docker_containers = ['one,containerid1', 'two,containerid2']
@@ -13,20 +73,27 @@ class TestDockerConnection:
                 return self.docker_containers
         output_mock.side_effect = side_effect
 
+    def _args(self):
+        args = MagicMock()
+        args.report_status = None
+        args.docker_filters = None
+        args.docker_group_by = None
+        return args
+
     def test_hosts_no_containers(self, output_mock):
         """ When there are no containers or process response, well, no hosts!  """
         with pytest.raises(ValueError):
-            connections.DockerConnection.hosts(MagicMock())
+            connections.DockerConnection.hosts(self._args())
 
     def test_no_hosts(self, output_mock):
         """ When no args.hosts are passed, return all running containers """
         self._setup_sife_effect(output_mock)
 
-        hosts = connections.DockerConnection.hosts(MagicMock())
+        hosts = connections.DockerConnection.hosts(self._args())
         assert hosts == ['containerid1', 'containerid2']
 
     def test_hosts(self, output_mock):
-        args = MagicMock()
+        args = self._args()
         args.hosts = ['ahost']
 
         self._setup_sife_effect(output_mock)
@@ -48,7 +115,7 @@ class TestDockerConnection:
         assert ['containerid1'] == connections.DockerConnection.hosts(args)
 
     def test_hosts_approximate(self, output_mock):
-        args = MagicMock()
+        args = self._args()
         args.hosts = ['wo']
         args.approximate = True
 
@@ -65,8 +132,52 @@ class TestDockerConnection:
         args.hosts = ['wo', 'blah']
         assert ['containerid2'] == connections.DockerConnection.hosts(args)
 
+    def test_hosts_patterns(self, output_mock):
+        args = self._args()
+        args.approximate = False
+        self._setup_sife_effect(output_mock)
+
+        args.hosts = ['t*']
+        assert ['containerid2'] == connections.DockerConnection.hosts(args)
+
+        args.hosts = ['re:^o', 'containerid2']
+        assert ['containerid1', 'containerid2'] == connections.DockerConnection.hosts(args)
+
+        args.hosts = ['one', 'x*']
+        with pytest.raises(ValueError, match="No container named 'x\\*' found!"):
+            connections.DockerConnection.hosts(args)
+
+        args.hosts = ['re:(']
+        with pytest.raises(ValueError, match='Invalid pattern'):
+            connections.DockerConnection.hosts(args)
+
+    def test_hosts_filters(self, output_mock):
+        """ --filter is passed on to docker ps """
+        args = self._args()
+        args.hosts = []
+        args.docker_filters = ['label=role=web', 'status=running', 'label=tier']
+        output_mock.return_value = self.docker_containers
+        assert ['containerid1', 'containerid2'] == connections.DockerConnection.hosts(args)
+        output_mock.assert_called_once_with(
+            "docker ps --filter label=role=web --filter label=tier --filter status=running "
+            "--format '{{.Names}},{{.ID}}'", timeout=None)
+
+    def test_hosts_group_by(self, output_mock):
+        args = self._args()
+        args.hosts = []
+        args.approximate = False
+        args.docker_group_by = 'image'
+        output_mock.return_value = ['one\tid1\tredis', 'two\tid2\tnginx', 'three\tid3\tredis']
+        assert ['id2', '\n', 'id1', 'id3'] == connections.DockerConnection.hosts(args)
+        assert output_mock.call_args[0][0] == "docker ps --format '{{.Names}}\\t{{.ID}}\\t{{.Image}}'"
+
+        args.docker_group_by = 'label=role'
+        output_mock.return_value = ['one\tid1\tdb', 'two\tid2\t', 'three\tid3\tdb']
+        assert ['id2', '\n', 'id1', 'id3'] == connections.DockerConnection.hosts(args)
+        assert output_mock.call_args[0][0] == "docker ps --format '{{.Names}}\\t{{.ID}}\\t{{.Label \"role\"}}'"
+
     def test_connect(self, output_mock):
-        args = MagicMock()
+        args = self._args()
         args.hosts = ['containerid1']
         args.approximate = False
         args.docker_command = ''
@@ -76,7 +187,7 @@ class TestDockerConnection:
             connections.DockerConnection.connect('containerid1', args)
 
     def test_command(self, output_mock):
-        args = MagicMock()
+        args = self._args()
         args.hosts = ['host1']
         args.approximate = False
         args.docker_command = ''
@@ -86,35 +197,93 @@ class TestDockerConnection:
         assert 'docker exec -it containerid1 pwd && docker exec -it containerid1 bash' == \
             connections.DockerConnection.command('containerid1', args)
 
-    def test_copy(self, output_mock):
-        args = MagicMock()
+        # with --wait, the status of pwd is reported before connecting (when it succeeded):
+        args.report_status = 'sh report.sh'
+        assert ('intmux_started=$(date +%s); docker exec -it containerid1 pwd; sh report.sh $? "$intmux_started" && '
+                'docker exec -it containerid1 bash') == connections.DockerConnection.command('containerid1', args)
+
+    def test_execute(self, output_mock):
+        args = self._args()
+        args.docker_command = 'exec -it {} bash'
+        args.command = 'pwd'
+        assert 'docker exec containerid1 pwd' == connections.DockerConnection.execute('containerid1', args)
+
+    def test_copy(self, output_mock, script):
+        args = self._args()
         args.hosts = ['host1']
         args.approximate = False
         args.docker_command = ''
-        args.script = 'test.sh'
+        args.script = script
 
         self._setup_sife_effect(output_mock)
-        assert ('docker cp test.sh containerid1:/tmp && '
-                'docker exec -it containerid1 chmod u+x /tmp/test.sh && '
-                'docker exec -it containerid1 /tmp/test.sh && '
-                'docker exec -it containerid1 bash') == \
+        assert ('docker exec containerid1 test -O {staged} -a -x {staged} || ('
+                'docker cp {script} containerid1:{staged} && '
+                'docker exec -it containerid1 chmod u+x {staged}) && '
+                'docker exec -it containerid1 {staged} && '
+                'docker exec -it containerid1 bash').format(staged=SCRIPT_PATH, script=script) == \
             connections.DockerConnection.copy('containerid1', args)
 
 
 @patch('scripts.connections.check_output_as_list')
 class TestDockerComposeConnection:
-    compose_containers = ['one', 'two']
+    compose_containers = ['p_two_1\tcontainerid2\ttwo\t1', 'p_one_1\tcontainerid1\tone\t1']
 
     def _setup_sife_effect(self, output_mock):
         def side_effect(*args, **kwargs):
-            if args[0] == 'docker-compose ps --filter="status=running" --services':
+            if args[0] == (
+                    "docker ps --filter label=com.docker.compose.project=project --filter status=running "
+                    "--format '{{.Names}}\\t{{.ID}}\\t{{.Label \"com.docker.compose.service\"}}\\t"
+                    "{{.Label \"com.docker.compose.container-number\"}}'"):
                 return self.compose_containers
-            if args[0] == 'docker-compose ps -q one':
-                return ['containerid1']
-            if args[0] == 'docker-compose ps -q two':
-                return ['containerid2']
         output_mock.side_effect = side_effect
 
+    @pytest.fixture(autouse=True)
+    def project(self, monkeypatch):
+        monkeypatch.setenv('COMPOSE_PROJECT_NAME', 'project')
+
+    def test_project(self, output_mock, monkeypatch, tmp_path):
+        monkeypatch.delenv('COMPOSE_PROJECT_NAME')
+        monkeypatch.delenv('COMPOSE_FILE', raising=False)
+        directory = tmp_path / 'My App.1'
+        directory.mkdir()
+        monkeypatch.chdir(directory)
+        assert 'myapp1' == connections.DockerComposeConnection.project()
+
+        # the compose file may be in a parent directory:
+        (directory / 'docker-compose.yml').write_text('services: {}\n')
+        subdirectory = directory / 'src' / 'lib'
+        subdirectory.mkdir(parents=True)
+        monkeypatch.chdir(subdirectory)
+        assert 'myapp1' == connections.DockerComposeConnection.project()
+
+        # and the project may be named in the .env file beside it:
+        (directory / '.env').write_text('# settings\nCOMPOSE_PROJECT_NAME="shop"\nOTHER=1\n')
+        assert 'shop' == connections.DockerComposeConnection.project()
+
+    def test_hosts(self, output_mock):
+        args = MagicMock()
+        args.hosts = []
+        args.approximate = False
+
+        self._setup_sife_effect(output_mock)
+        assert ['containerid1', 'containerid2'] == connections.DockerComposeConnection.hosts(args)
+
+        args.hosts = ['two']
+        assert ['containerid2'] == connections.DockerComposeConnection.hosts(args)
+
+        # Discovery is one docker call, however many services there are:
+        assert output_mock.call_count == 2
+
+    def test_hosts_scaled(self, output_mock):
+        args = MagicMock()
+        args.hosts = ['web']
+        args.approximate = False
+
+        self.compose_containers = [
+            'p_web_2\tcontainerid2\tweb\t2', 'p_db_1\tcontainerid3\tdb\t1', 'p_web_1\tcontainerid1\tweb\t1']
+        self._setup_sife_effect(output_mock)
+        assert ['containerid1', 'containerid2'] == connections.DockerComposeConnection.hosts(args)
+
     def test_hosts_approximate(self, output_mock):
         args = MagicMock()
         args.hosts = ['ne']
@@ -147,6 +316,16 @@ class TestSSHDockerConnection:
                 return self.host2_docker_containers
         output_mock.side_effect = side_effect
 
+    def _args(self):
+        args = MagicMock()
+        args.report_status = None
+        args.discovery_workers = 4
+        args.discovery_timeout = None
+        args.ssh_options = ''
+        args.docker_filters = None
+        args.docker_group_by = None
+        return args
+
     def test_no_hosts(self, output_mock):
         """ When there are no hosts, there is an error """
         with pytest.raises(ValueError):
@@ -154,7 +333,7 @@ class TestSSHDockerConnection:
 
     def test_no_docker_containers(self, output_mock):
         """ When no args.docker_containers are passed, return all running containers """
-        args = MagicMock()
+        args = self._args()
         args.hosts = ['host1']
         self._setup_sife_effect(output_mock)
 
@@ -170,7 +349,7 @@ class TestSSHDockerConnection:
             'host2,containerid12', 'host2,containerid22']
 
     def test_hosts(self, output_mock):
-        args = MagicMock()
+        args = self._args()
         args.hosts = ['host1']
         args.docker_containers = 'one'
         args.approximate = False
@@ -194,11 +373,49 @@ class TestSSHDockerConnection:
             'host1,containerid1', '\n',
             'host2,containerid12', 'host2,containerid22']
 
+    def test_hosts_failures(self, output_mock, capsys):
+        """ Hosts that fail discovery are summarized, without losing the others """
+        args = self._args()
+        args.hosts = ['host1', 'host3', 'host2']
+        args.docker_containers = ''
+        args.approximate = True
+
+        def side_effect(command, timeout=None):
+            if command.startswith('ssh host3 '):
+                raise subprocess.TimeoutExpired(command, 30)
+            return self.host1_docker_containers if 'host1' in command else self.host2_docker_containers
+        output_mock.side_effect = side_effect
+
+        hosts = connections.SSHDockerConnection.hosts(args)
+        assert hosts == [
+            'host1,containerid1', 'host1,containerid2', '\n',
+            'host2,containerid12', 'host2,containerid22']
+        assert 'host3: timed out after 30s' in capsys.readouterr().err
+
+        # When every host fails, there is an error:
+        args.hosts = ['host3']
+        with pytest.raises(ValueError):
+            connections.SSHDockerConnection.hosts(args)
+
+    def test_hosts_group_by(self, output_mock):
+        """ Groups (--group-by) get windows of their own within each SSH host's """
+        args = self._args()
+        args.hosts = ['host1', 'host2']
+        args.docker_containers = ''
+        args.docker_filters = ['ancestor=nginx']
+        args.docker_group_by = 'label=role'
+        output_mock.side_effect = lambda command, timeout=None: ['one\tid1\ta', 'two\tid2\tb']
+
+        assert connections.SSHDockerConnection.hosts(args) == [
+            'host1,id1', '\n', 'host1,id2', '\n', 'host2,id1', '\n', 'host2,id2']
+        assert output_mock.call_args[0][0].startswith('ssh host2 docker ps --filter ancestor=nginx --format')
+
     def test_connect(self, output_mock):
         args = MagicMock()
         args.hosts = ['host1']
         args.docker_containers = 'one'
         args.approximate = False
+        args.ssh_command = 'ssh'
         args.ssh_options = ''
         args.docker_command = ''
 
@@ -208,9 +425,11 @@ class TestSSHDockerConnection:
 
     def test_command(self, output_mock):
         args = MagicMock()
+        args.report_status = None
         args.hosts = ['host1']
         args.docker_containers = 'one'
         args.approximate = False
+        args.ssh_command = 'ssh'
         args.ssh_options = ''
         args.docker_command = ''
         args.command = 'pwd'
@@ -219,20 +438,122 @@ class TestSSHDockerConnection:
         assert 'ssh -t  host1 docker exec -it containerid1 pwd && ssh -t  host1 docker exec -it containerid1 bash' == \
             connections.SSHDockerConnection.command('host1,containerid1', args)
 
-    def test_copy(self, output_mock):
+    def test_execute(self, output_mock):
+        args = MagicMock()
+        args.ssh_command = 'ssh'
+        args.ssh_options = ''
+        args.docker_command = ''
+        args.command = 'pwd'
+        assert 'ssh  host1 docker exec containerid1 pwd' == \
+            connections.SSHDockerConnection.execute('host1,containerid1', args)
+
+    def test_copy(self, output_mock, script):
         args = MagicMock()
+        args.report_status = None
         args.hosts = ['host1']
         args.docker_containers = 'one'
         args.approximate = False
+        args.ssh_command = 'ssh'
         args.ssh_options = ''
         args.docker_command = ''
-        args.script = 'test.sh'
+        args.script = script
 
         self._setup_sife_effect(output_mock)
 
-        assert ('scp  test.sh host1:/tmp && ssh  host1 chmod u+x /tmp/test.sh && '
-                'ssh -t  host1 docker cp /tmp/test.sh containerid1:/tmp && '
-                'ssh -t  host1 docker exec -it containerid1 chmod u+x /tmp/test.sh && '
-                'ssh -t  host1 docker exec -it containerid1 /tmp/test.sh && '
-                'ssh -t  host1 docker exec -it containerid1 bash') == \
+        assert ('ssh -t  host1 docker exec containerid1 test -O {staged} -a -x {staged} || ('
+                'ssh -t  host1 docker cp {staged} containerid1:{staged} && '
+                'ssh -t  host1 docker exec -it containerid1 chmod u+x {staged}) && '
+                'ssh -t  host1 docker exec -it containerid1 {staged} && '
+                'ssh -t  host1 docker exec -it containerid1 bash').format(staged=SCRIPT_PATH) == \
             connections.SSHDockerConnection.copy('host1,containerid1', args)
+
+    def test_stage(self, output_mock, script):
+        """ The script is copied to each SSH host once """
+        args = self._args()
+        args.ssh_command = 'ssh'
+        args.script = script
+
+        connections.SSHDockerConnection.stage(
+            ['host1,containerid1', 'host1,containerid2', 'host2,containerid12'], args)
+        assert sorted(call[0][0] for call in output_mock.call_args_list) == [
+            'ssh  {host} test -O {staged} -a -x {staged} || (scp  {script} {host}:{staged} && '
+            'ssh  {host} chmod u+x {staged})'.format(host=host, staged=SCRIPT_PATH, script=script)
+            for host in ['host1', 'host2']]
+
+
+PODS = {'items': [
+    {'metadata': {'name': 'web-1', 'namespace': 'prod'}, 'spec': {'nodeName': 'node-b'}},
+    {'metadata': {'name': 'web-2', 'namespace': 'prod'}, 'spec': {'nodeName': 'node-a'}},
+    {'metadata': {'name': 'db-1', 'namespace': 'data'}, 'spec': {'nodeName': 'node-a'}},
+]}
+
+
+@patch('scripts.connections.check_output_as_list')
+class TestKubeConnection:
+
+    def _args(self, hosts=()):
+        args = MagicMock()
+        args.report_status = None
+        args.hosts = list(hosts)
+        args.approximate = False
+        args.kubectl_command = 'kubectl'
+        args.kube_context = None
+        args.namespace = None
+        args.all_namespaces = True
+        args.selector = 'tier=backend'
+        args.field_selector = 'status.phase=Running'
+        args.kube_container = None
+        args.kube_shell = 'sh'
+        args.group_by = None
+        args.script = ''
+        args.command = 'pwd'
+        return args
+
+    def test_hosts(self, output_mock):
+        output_mock.return_value = json.dumps(PODS, indent=2).split('\n')
+        args = self._args()
+        assert connections.KubeConnection.hosts(args) == ['data/db-1', 'prod/web-1', 'prod/web-2']
+        # one query for every pod:
+        output_mock.assert_called_once_with(
+            "kubectl get pods --output json --all-namespaces --selector tier=backend "
+            "--field-selector status.phase=Running", timeout=None)
+
+        args.hosts = ['web-*', 'data/db-1']
+        assert connections.KubeConnection.hosts(args) == ['data/db-1', 'prod/web-1', 'prod/web-2']
+
+        args.hosts = ['web-1', 'cache']
+        with pytest.raises(ValueError, match="No pod named 'cache' found!"):
+            connections.KubeConnection.hosts(args)
+
+        args.approximate = True
+        args.hosts = ['eb']
+        assert connections.KubeConnection.hosts(args) == ['prod/web-1', 'prod/web-2']
+
+    def test_hosts_group_by(self, output_mock):
+        output_mock.return_value = [json.dumps(PODS)]
+        args = self._args()
+        args.group_by = 'namespace'
+        assert connections.KubeConnection.hosts(args) == ['data/db-1', '\n', 'prod/web-1', 'prod/web-2']
+        args.group_by = 'node'
+        assert connections.KubeConnection.hosts(args) == ['data/db-1', 'prod/web-2', '\n', 'prod/web-1']
+
+    def test_no_pods(self, output_mock):
+        output_mock.return_value = ['{"items": []}']
+        with pytest.raises(ValueError, match='No pods'):
+            connections.KubeConnection.hosts(self._args())
+
+    def test_commands(self, output_mock, script):
+        args = self._args()
+        args.kube_container = 'app'
+        exec_it = 'kubectl exec -it --namespace prod web-1 --container app --'
+        assert connections.KubeConnection.connect('prod/web-1', args) == exec_it + ' sh'
+        assert connections.KubeConnection.command('prod/web-1', args) == \
+            '{0} pwd && {0} sh'.format(exec_it)
+        assert connections.KubeConnection.execute('prod/web-1', args) == \
+            'kubectl exec --namespace prod web-1 --container app -- pwd'
+
+        args.script = script
+        assert connections.KubeConnection.copy('prod/web-1', args) == (
+            'kubectl exec --namespace prod web-1 --container app -- test -O {staged} -a -x {staged} || '
+            '(kubectl cp {script} prod/web-1:{staged} --container app && {exec_it} chmod u+x {staged}) && '
+            '{exec_it} {staged} && {exec_it} sh').format(staged=SCRIPT_PATH, script=script, exec_it=exec_it)
@@ -0,0 +1,114 @@
+import io
+import threading
+
+import pytest
+from mock import MagicMock, patch
+from scripts import client, daemon, terminal
+
+
+@pytest.fixture
+def served(tmp_path):
+    """ A Daemon serving at a socket in tmp_path, with its sessions mocked """
+    path = str(tmp_path / 'intmuxd.sock')
+    server = daemon.Daemon(path)
+    ready = threading.Event()
+    listen = server._listen
+
+    def _listen():
+        listener = listen()
+        ready.set()
+        return listener
+
+    with patch.object(server, '_listen', _listen), patch.object(daemon, 'DaemonSession') as session:
+        session.return_value.attached = None
+        threading.Thread(target=server.serve, daemon=True).start()
+        ready.wait(5)
+        yield path, session
+
+
+def _request(path, arguments, hosts=None):
+    stdin = io.StringIO(hosts or '')
+    stdin.isatty = lambda: hosts is None
+    with patch.object(client.sys, 'stdin', stdin):
+        return client.request(arguments, path)
+
+
+def test_no_daemon(tmp_path):
+    assert _request(str(tmp_path / 'missing.sock'), ['ssh', 'a']) is None
+
+
+@pytest.mark.parametrize('owner', ['socket', 'daemon'])
+def test_other_user(served, owner, capsys):
+    path, session = served
+    uid = client.os.getuid()
+    if owner == 'socket':
+        stat = patch.object(client.os, 'stat', return_value=MagicMock(st_uid=uid + 1))
+    else:
+        stat = patch.object(client, '_owner', return_value=uid + 1)
+    with stat:
+        assert _request(path, ['ssh', 'a']) is None
+    assert 'another user' in capsys.readouterr().err
+    session.assert_not_called()
+
+
+def test_round_trip(served):
+    path, session = served
+    received = []
+
+    def connect():
+        received.append(daemon.sys.stdin.read())
+        print('built')
+
+    session.return_value.connect.side_effect = connect
+    session.return_value.attached = ['sock', 'intmux:0']
+    reply = _request(path, ['-L', 'sock', 'ssh'], 'a\nb\n')
+    assert reply == {'status': 0, 'stdout': 'built\n', 'stderr': '', 'attach': ['sock', 'intmux:0']}
+    assert received == ['a\nb\n']
+    args = session.call_args[0][0]
+    assert args.cache_ttl == daemon.CACHE_TTL
+
+    # caching can still be turned off:
+    _request(path, ['--cache-ttl', '0', 'ssh'], 'a\n')
+    assert session.call_args[0][0].cache_ttl == 0
+
+
+def test_exit_status(served):
+    path, session = served
+
+    def connect():
+        print('At least one host must be specified!')
+        daemon.sys.exit(64)
+
+    session.return_value.connect.side_effect = connect
+    reply = _request(path, ['ssh'])
+    assert reply['status'] == 64
+    assert reply['stdout'] == 'At least one host must be specified!\n'
+
+
+@pytest.mark.parametrize('arguments', [
+    ['send', 'ls'], ['restore', 'plan.json'], ['--stream', 'ssh'], ['ssh', '--exec', 'a'], ['--wait', '-c', 'uptime', 'ssh', 'a'],
+    ['--bogus']])
+def test_fallback(served, arguments):
+    path, session = served
+    assert _request(path, arguments) is None
+    session.assert_not_called()
+
+
+def test_warm_client_reopens():
+    warm = daemon.WarmClient('sock')
+    warm.process = MagicMock()
+    warm.process.poll.return_value = 0
+    with patch('scripts.tmux.connections.check_output_as_list', return_value=[]) as output:
+        assert not warm.has_session('intmux')
+    assert warm.process is None
+    output.assert_called_once_with("tmux -L sock list-sessions -F '#S'")
+
+
+@pytest.mark.parametrize('socket, environment, expected', [
+    (None, {}, ([['attach-session', '-t', 't']], False)),
+    ('s', {'TMUX': '/tmp/tmux-0/s,1,0'}, (
+        [['set-option', '-g', 'detach-on-destroy', 'off'], ['switch-client', '-t', 't']], False)),
+    ('s', {'TMUX': '/tmp/tmux-0/default,1,0'}, ([['attach-session', '-t', 't']], True)),
+])
+def test_attach_commands(socket, environment, expected):
+    assert terminal.attach_commands(socket, 't', environment) == expected
@@ -0,0 +1,90 @@
+import json
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+from mock import MagicMock
+from scripts import connections, docker_api
+
+CONTAINERS = [
+    {'Id': 'containerid1' + 'a' * 52, 'Names': ['/one'], 'Image': 'nginx',
+     'Labels': {'com.docker.compose.service': 'web', 'com.docker.compose.container-number': '1'},
+     'State': 'running'},
+    {'Id': 'containerid2' + 'b' * 52, 'Names': ['/two,2'], 'Image': 'redis', 'Labels': None,
+     'State': 'running'},
+]
+
+
+class DockerHandler(BaseHTTPRequestHandler):
+    """ Answers /containers/json like the Docker Engine """
+    requests = []
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self.requests.append(url)
+        if url.path == '/containers/json':
+            status, body = 200, CONTAINERS
+        else:
+            status, body = 404, {'message': 'page not found'}
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        return 'docker.sock'
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def docker_host(tmp_path, monkeypatch):
+    """ A stand-in docker daemon on a UNIX socket, set as $DOCKER_HOST """
+    DockerHandler.requests = []
+    socket_path = str(tmp_path / 'docker.sock')
+    server = socketserver.UnixStreamServer(socket_path, DockerHandler)
+    thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05})
+    thread.start()
+    monkeypatch.setenv('DOCKER_HOST', 'unix://' + socket_path)
+    yield socket_path
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def test_containers(docker_host):
+    containers = docker_api.DockerClient().containers({'status': ['running']})
+    assert containers == [
+        docker_api.Container('one', 'containerid1', 'nginx', CONTAINERS[0]['Labels'], 'running'),
+        docker_api.Container('two,2', 'containerid2', 'redis', {}, 'running'),
+    ]
+    query = parse_qs(DockerHandler.requests[0].query)
+    assert json.loads(query['filters'][0]) == {'status': ['running']}
+
+
+def test_errors(docker_host, tmp_path):
+    with pytest.raises(ValueError, match='page not found'):
+        docker_api.DockerClient().get('/nothing')
+
+    with pytest.raises(ValueError, match='Could not connect'):
+        docker_api.DockerClient('unix://' + str(tmp_path / 'missing.sock')).containers()
+
+    with pytest.raises(ValueError, match='Unsupported'):
+        docker_api.DockerClient('ssh://host').containers()
+
+
+def test_connection_hosts(docker_host):
+    args = MagicMock()
+    args.hosts = ['two,2']
+    args.approximate = False
+    assert ['containerid2'] == connections.DockerAPIConnection.hosts(args)
+
+    args.hosts = ['web']
+    assert ['containerid1'] == connections.DockerComposeAPIConnection.hosts(args)
+    query = parse_qs(DockerHandler.requests[-1].query)
+    assert 'com.docker.compose.project' in query['filters'][0]
@@ -0,0 +1,48 @@
+import io
+
+from scripts import execute
+
+
+def test_run():
+    result = execute.run('host1', 'echo out; echo err >&2; exit 3')
+    assert result == execute.Result('host1', 3, b'out\n', b'err\n')
+
+
+def test_run_limit():
+    result = execute.run('host1', 'seq 100000', limit=10)
+    assert result.status == 0
+    assert result.stdout == b'1\n2\n3\n4\n5\n'
+
+
+def test_run_timeout():
+    result = execute.run('host1', 'echo started; sleep 10', timeout=0.5)
+    assert result.status is None
+    assert result.stdout == b'started\n'
+
+
+def test_run_all():
+    commands = [
+        ('host1', 'echo same'),
+        ('host2', 'echo different'),
+        ('host3', 'echo same'),
+        ('host4', 'exit 1'),
+    ]
+    groups = execute.run_all(iter(commands), workers=2)
+    assert len(groups) == 3
+    assert sorted(groups[(0, b'same\n', b'')]) == ['host1', 'host3']
+    assert groups[(0, b'different\n', b'')] == ['host2']
+    assert groups[(1, b'', b'')] == ['host4']
+
+
+def test_report():
+    groups = {
+        (0, b'same\n', b''): ['host1', 'host3'],
+        (2, b'', b'no such file'): ['host2'],
+    }
+    out = io.StringIO()
+    assert execute.report(groups, out) == 2
+    assert out.getvalue() == (
+        '{0}\nhost1,host3 (2)\n{0}\n'
+        'same\n'
+        '{1}\nhost2 (1) - exit status 2\n{1}\n'
+        'no such file\n').format('-' * 15, '-' * 25)
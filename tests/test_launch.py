@@ -0,0 +1,165 @@
+import os
+import shlex
+import shutil
+import signal
+import subprocess
+import sys
+import time
+
+import pytest
+from scripts import launch
+
+# A stub tmux that logs its arguments, and keeps options in LAUNCH_STATE:
+STUB = """#!{python}
+import os, re, sys
+with open(os.environ['LAUNCH_LOG'], 'a') as f:
+    f.write(' '.join(sys.argv[1:]) + '\\n')
+state = os.environ['LAUNCH_STATE']
+options = {{}}
+if os.path.exists(state):
+    options = dict(line.rstrip('\\n').split('=', 1) for line in open(state))
+commands = [[]]
+for argument in sys.argv[1:]:
+    if argument == ';':
+        commands.append([])
+    else:
+        commands[-1].append(argument)
+for command in commands:
+    flags = [a for a in command[1:] if a.startswith('-')]
+    values = [a for i, a in enumerate(command[1:]) if not a.startswith('-') and command[i] != '-t']
+    if command[0] == 'set-option' and '-u' in flags:
+        options.pop(values[0], None)
+    elif command[0] == 'set-option':
+        options[values[0]] = values[1]
+    elif command[0] == 'display-message':
+        print(re.sub('#{{([^}}]*)}}', lambda m: options.get(m.group(1), ''), values[0]))
+with open(state, 'w') as f:
+    f.writelines('{{}}={{}}\\n'.format(k, v) for k, v in options.items())
+"""
+
+
+@pytest.fixture
+def pane(tmp_path, monkeypatch):
+    """ Run shell commands as if in a tmux pane, with a stub tmux """
+    monkeypatch.setattr(launch, 'MAX_BACKOFF', 0)
+    stub = tmp_path / 'tmux'
+    stub.write_text(STUB.format(python=sys.executable))
+    stub.chmod(0o755)
+    environment = dict(
+        os.environ, PATH='{}:{}'.format(tmp_path, os.environ['PATH']), TMUX_PANE='%1',
+        LAUNCH_LOG=str(tmp_path / 'log'), LAUNCH_STATE=str(tmp_path / 'state'))
+
+    def run(command):
+        status = subprocess.call([command], shell=True, env=environment, stderr=subprocess.DEVNULL)
+        log = tmp_path / 'log'
+        return status, log.read_text().splitlines() if log.exists() else []
+    run.marker = str(tmp_path / 'marker')
+    run.environment = environment
+
+    def options():
+        state = tmp_path / 'state'
+        return dict(line.split('=', 1) for line in state.read_text().splitlines()) if state.exists() else {}
+    run.options = options
+    return run
+
+
+def _taken(log, launcher):
+    """ How many times a slot was taken """
+    return len([line for line in log if line.startswith('set-option -t  @{} '.format(launcher.channel))])
+
+
+def test_wrap():
+    launcher = launch.Launcher(parallel=2, rate=4)
+    commands = [launcher.wrap('ssh host{}'.format(i)) for i in range(3)]
+    assert 'INTMUX_CHANNEL={};'.format(launcher.channel) in commands[0]
+    assert 'sleep' not in commands[0].split('while')[0]
+    assert 'sleep 0.500;' in commands[2]
+    # a run doesn't wait for the locks of an earlier one (they outlive their panes):
+    assert launch.Launcher(parallel=2).channel != launcher.channel
+
+
+def test_retry(pane):
+    launcher = launch.Launcher(parallel=1, retries=3)
+    local = shlex.split(launcher.ssh_options())[3][len('LocalCommand='):]
+    # fails before it is connected once, then connects (running ssh's LocalCommand):
+    connect = 'sh -c {}'.format(shlex.quote(
+        'test -e {0} || {{ touch {0}; exit 255; }}; {1}'.format(pane.marker, local)))
+    status, log = pane(launcher.wrap(connect))
+    assert status == 0
+    assert _taken(log, launcher) == 2
+    # the slot was freed after the failure, and by the connection itself:
+    assert len([line for line in log if 'wait-for -S {}-free'.format(launcher.channel) in line]) == 2
+    assert pane.options() == {'@intmux_up': '1', '@' + launcher.channel: '0'}
+
+
+def test_retries_run_out(pane):
+    launcher = launch.Launcher(parallel=1, retries=2)
+    status, log = pane(launcher.wrap('sh -c "exit 3"'))
+    assert status == 3
+    assert _taken(log, launcher) == 3
+    assert pane.options() == {'@' + launcher.channel: '0'}
+
+
+def test_settle(pane, monkeypatch):
+    monkeypatch.setattr(launch, 'SETTLE', 0.1)
+    launcher = launch.Launcher(parallel=1)
+    # a command that can't report that it is connected is after SETTLE seconds:
+    status, log = pane(launcher.wrap('sleep 0.5; sh -c "exit 1"', reports=False))
+    assert status == 1
+    assert _taken(log, launcher) == 1
+    assert pane.options() == {'@intmux_up': '1', '@' + launcher.channel: '0'}
+
+
+def test_closed(pane):
+    launcher = launch.Launcher(parallel=1)
+    connecting = subprocess.Popen(
+        [launcher.wrap('sleep 30')], shell=True, env=pane.environment, start_new_session=True)
+    for _ in range(50):
+        if pane.options().get('@' + launcher.channel) == '1':
+            break
+        time.sleep(0.1)
+    # the pane is closed while it connects, which frees its slot:
+    os.killpg(connecting.pid, signal.SIGHUP)
+    connecting.wait(10)
+    for _ in range(50):
+        if pane.options().get('@' + launcher.channel) == '0':
+            break
+        time.sleep(0.1)
+    assert pane.options() == {'@' + launcher.channel: '0'}
+
+
+@pytest.mark.skipif(shutil.which('tmux') is None, reason='needs tmux')
+def test_slow_host(tmp_path):
+    """ A host that never connects holds one slot, and the others carry on with the rest """
+    socket = 'intmux-test-{}'.format(os.getpid())
+    launcher = launch.Launcher(parallel=2)
+    local = shlex.split(launcher.ssh_options())[3][len('LocalCommand='):]
+    commands = [launcher.wrap('sleep 30')] + [launcher.wrap('{}; sleep 30'.format(local)) for _ in range(5)]
+    environment = {k: v for k, v in os.environ.items() if k != 'TMUX'}
+    tmux = ['tmux', '-L', socket, '-f', '/dev/null']
+    subprocess.check_call(tmux + ['new-session', '-d', '-s', 'launch', commands[0]], env=environment)
+    try:
+        for command in commands[1:]:
+            subprocess.check_call(tmux + ['new-window', '-d', '-t', 'launch', command], env=environment)
+        for _ in range(100):
+            up = subprocess.check_output(
+                tmux + ['list-panes', '-s', '-t', 'launch', '-F', '#{@intmux_up}'], env=environment).split()
+            if len(up) == 5:
+                break
+            time.sleep(0.1)
+        # every other pane connected, through the one slot that is left:
+        assert len(up) == 5
+    finally:
+        subprocess.call(tmux + ['kill-server'], env=environment)
+
+
+def test_ssh_options(pane):
+    options = launch.Launcher().ssh_options('-A')
+    assert options.startswith('-o PermitLocalCommand=yes -o ') and options.endswith(' -A')
+    local = shlex.split(options)[3][len('LocalCommand='):]
+
+    # outside of a launched pane it does nothing:
+    assert pane('unset INTMUX_CHANNEL; ' + local) == (0, [])
+    status, log = pane('INTMUX_CHANNEL=c; export INTMUX_CHANNEL; ' + local + '; ' + local)
+    # it frees the slot when the pane first connects:
+    assert log.count('set-option -p -t %1 @intmux_up 1') == 1
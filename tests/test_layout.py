@@ -0,0 +1,63 @@
+import pytest
+from scripts import layout
+
+
+def _windows(plan):
+    windows = {}
+    for pane in plan:
+        windows.setdefault(pane.window, []).append(pane.host)
+    return windows
+
+
+def test_plan():
+    hosts = ['host{}'.format(i) for i in range(7)]
+    assert _windows(layout.Plan(hosts, 3, (80, 23))) == {
+        0: ['host0', 'host1', 'host2'],
+        1: ['host3', 'host4', 'host5'],
+        2: ['host6'],
+    }
+    assert _windows(layout.Plan(hosts, 0, (80, 23))) == {0: hosts}
+
+
+def test_plan_separator():
+    hosts = ['\n', 'host1', 'host2', '\n', 'host3']
+    assert _windows(layout.Plan(hosts, 6, (80, 23))) == {0: ['host1', 'host2'], 1: ['host3']}
+
+
+def test_plan_splits():
+    plan = list(layout.Plan(['host{}'.format(i) for i in range(4)], 0, (200, 50)))
+    # the last pane is split each time, across its longest side:
+    assert [(p.split, p.direction, p.tile) for p in plan] == [
+        (None, None, False), (0, '-h', False), (1, '-v', False), (2, '-h', False)]
+
+
+def test_plan_order():
+    hosts = ['host{}'.format(i) for i in range(40)]
+    plan = list(layout.Plan(hosts, 0, (80, 23)))
+    # the window is tiled when the last pane is too small to split:
+    assert any(p.tile for p in plan)
+    # tmux numbers a new pane after the one that was split:
+    order = []
+    for pane in plan:
+        order.insert(0 if pane.split is None else pane.split + 1, pane.host)
+    assert order == hosts
+
+
+def test_tiled():
+    assert layout.tiled(1, (80, 23)) == [(80, 23)]
+    # 2 columns of 3 rows, the last cell taking the rest of its row:
+    assert layout.tiled(5, (80, 23)) == [(39, 7), (40, 7), (39, 7), (40, 7), (80, 7)]
+
+
+def test_plan_capacity():
+    hosts = ['host{}'.format(i) for i in range(600)]
+    with pytest.raises(layout.LayoutError, match='do not fit in a 80x23 window'):
+        list(layout.Plan(hosts, 0, (80, 23)))
+    assert len(list(layout.Plan(hosts, 0, (400, 100)))) == 600
+
+
+def test_plan_stream():
+    def hosts():
+        yield 'host1'
+        raise AssertionError('read too far')
+    assert next(iter(layout.Plan(hosts(), 6, (80, 23)))).host == 'host1'
@@ -0,0 +1,59 @@
+import pytest
+from scripts import matching
+
+
+def test_expression():
+    assert matching.expression('web') is None
+    assert matching.expression('web', approximate=True) == 'web'
+    assert matching.expression('a.b', approximate=True) == r'a\.b'
+    assert matching.expression('re:^web[0-9]+$') == '^web[0-9]+$'
+    assert matching.expression('web-*').startswith(r'\A')
+
+
+def test_automaton():
+    automaton = matching.Automaton(['he', 'she', 'his', 'hers'])
+    assert automaton.search('ushers') == 'she'
+    assert automaton.search('ahis') == 'his'
+    assert automaton.search('xyz') is None
+    assert matching.Automaton(['abcd', 'bc']).search('abce') == 'bc'
+
+
+def test_match():
+    matcher = matching.Matcher(['db', 'web-*', 're:^cache[0-9]$', 're:worker'])
+    assert matcher.match('db') == 'db'
+    assert matcher.match('db2') is None
+    assert matcher.match('web-1') == 'web-*'
+    assert matcher.match('aweb-1') is None
+    assert matcher.match('cache1') == 're:^cache[0-9]$'
+    assert matcher.match('cache10') is None
+    assert matcher.match('queue-worker-2') == 're:worker'
+    # any of the names can match (a container's name or ID):
+    assert matcher.match('nomatch', 'db') == 'db'
+
+
+def test_match_approximate():
+    matcher = matching.Matcher(['eb', 'a.c'], approximate=True)
+    assert matcher.match('web') == 'eb'
+    assert matcher.match('a.c1') == 'a.c'
+    assert matcher.match('abc') is None
+
+
+def test_unmatched():
+    matcher = matching.Matcher(['w*', 'we*', 'db', 'missing'])
+    names = ['web', 'db']
+    for name in names:
+        matcher.match(name)
+    # 'we*' was never the first match, but does match a name:
+    assert matcher.unmatched(names) == ['missing']
+
+
+def test_uncombinable():
+    # numbered backreferences only work in their own expression:
+    matcher = matching.Matcher(['re:(a)\\1', 're:(b)\\1'])
+    assert matcher.regex is None
+    assert matcher.match('xbb') == 're:(b)\\1'
+
+
+def test_invalid():
+    with pytest.raises(ValueError, match="Invalid pattern 're:\\['"):
+        matching.Matcher(['re:['])
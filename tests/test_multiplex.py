@@ -0,0 +1,49 @@
+import os
+import subprocess
+
+import pytest
+from mock import patch
+from scripts import multiplex
+
+
+@pytest.fixture
+def multiplexer():
+    multiplexer = multiplex.Multiplexer('intmux', persist=60)
+    yield multiplexer
+    multiplexer.stop()
+
+
+def test_options(multiplexer):
+    control_path = os.path.join(multiplexer.directory, '%C')
+    assert multiplexer.options() == (
+        '-o ControlMaster=auto -o ControlPath={} -o ControlPersist=60'.format(control_path))
+    assert multiplexer.options('-p 2222').endswith('ControlPersist=60 -p 2222')
+
+
+@patch('scripts.multiplex.subprocess.run')
+def test_start(run_mock, multiplexer):
+    multiplexer.start(['host1', 'host2', 'host1'], '-p 2222')
+    multiplexer.start(['host2', 'host3'])
+    assert multiplexer.hosts == ['host1', 'host2', 'host3']
+    commands = sorted(call[0][0][0] for call in run_mock.call_args_list)
+    assert len(commands) == 3
+    assert commands[0] == 'ssh {} host1 true'.format(multiplexer.options('-p 2222'))
+
+
+@patch('scripts.multiplex.subprocess.run')
+def test_cleanup_script(run_mock, multiplexer, tmp_path):
+    multiplexer.ssh_command = 'echo'
+    multiplexer.start(['host1'])
+    script = multiplexer.cleanup_script()
+
+    # Only the session the hook was added for is cleaned up:
+    subprocess.check_call(['sh', script, 'other', 'socket'])
+    assert os.path.exists(multiplexer.directory)
+
+    hook = multiplexer.cleanup_hook()
+    assert hook[:3] == ('set-hook', '-g', multiplexer.hook_name)
+    # another session's hook (intmuxd builds several) doesn't replace it:
+    other = multiplex.Multiplexer('other')
+    other.stop()
+    assert other.hook_name != multiplexer.hook_name
+    assert script in hook[3]
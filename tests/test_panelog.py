@@ -0,0 +1,96 @@
+import gzip
+import os
+import subprocess
+import time
+
+import pytest
+from mock import MagicMock
+from scripts import panelog
+
+
+def _record(log, host, output, expected):
+    """ Pipe 'output' through the script that pipe-pane runs, and wait for its logs to be 'expected' """
+    subprocess.run(log.command(host), shell=True, input=output, check=True)
+    directory = os.path.join(log.directory, panelog.host_directory(host))
+    # segments are compressed (and old ones removed) in the background:
+    for _ in range(50):
+        if sorted(os.listdir(directory)) == expected:
+            break
+        time.sleep(0.1)
+    assert sorted(os.listdir(directory)) == expected
+
+
+def test_rotation(tmp_path):
+    log = panelog.PaneLog(str(tmp_path), size=10, keep=2)
+    _record(log, 'host1', b'0123456789abcdefghij0123456789XYZ', ['2.log.gz', '3.log.gz', 'current.log'])
+    assert (tmp_path / 'host1' / 'current.log').read_bytes() == b'XYZ'
+    with gzip.open(str(tmp_path / 'host1' / '3.log.gz')) as f:
+        assert f.read() == b'0123456789'
+
+    # a pane that is connected again carries on where the last one stopped:
+    _record(log, 'host1', b'0123', ['2.log.gz', '3.log.gz', 'current.log'])
+    assert (tmp_path / 'host1' / 'current.log').read_bytes() == b'XYZ0123'
+    _record(log, 'host1', b'456', ['3.log.gz', '4.log.gz', 'current.log'])
+    with gzip.open(str(tmp_path / 'host1' / '4.log.gz')) as f:
+        assert f.read() == b'XYZ0123456'
+
+
+def test_host_directory():
+    assert panelog.host_directory('user@host.example.com') == 'user@host.example.com'
+    assert panelog.host_directory('ns/pod-0') == 'ns_pod-0'
+    assert panelog.host_directory('..') == '_..'
+
+
+def test_segments(tmp_path):
+    for name in ['10.log.gz', '2.log.gz', '3.log', '3.log.gz', 'current.log', 'other.txt']:
+        (tmp_path / name).write_text('')
+    assert panelog.segments(str(tmp_path)) == [
+        str(tmp_path / n) for n in ['2.log.gz', '3.log', '10.log.gz', 'current.log']]
+
+
+def _grep_args(directory, pattern):
+    args = MagicMock()
+    args.pane_logs = str(directory)
+    args.tmux_session = 'intmux'
+    args.pattern = pattern
+    args.hosts = None
+    args.approximate = False
+    args.ignore_case = False
+    args.fixed_strings = False
+    args.workers = 2
+    return args
+
+
+@pytest.fixture
+def logs(tmp_path):
+    for host, segments in [('web1', [b'boot\r\n', b'\x1b[31mERROR\x1b[0m disk full\r\n']), ('db1', [b'ok\n'])]:
+        directory = tmp_path / 'intmux' / host
+        directory.mkdir(parents=True)
+        with gzip.open(str(directory / '1.log.gz'), 'wb') as f:
+            f.write(segments[0])
+        if len(segments) > 1:
+            (directory / 'current.log').write_bytes(segments[1])
+    return tmp_path
+
+
+def test_grep(logs, capsys):
+    assert panelog.run(_grep_args(logs, 'ERROR d')) == 0
+    assert capsys.readouterr().out == 'web1: ERROR disk full\n'
+
+    args = _grep_args(logs, 'OK|BOOT')
+    args.ignore_case = True
+    assert panelog.run(args) == 0
+    assert sorted(capsys.readouterr().out.splitlines()) == ['db1: ok', 'web1: boot']
+
+    args.hosts = 'db*'
+    assert panelog.run(args) == 0
+    assert capsys.readouterr().out == 'db1: ok\n'
+
+
+def test_grep_no_match(logs, capsys):
+    assert panelog.run(_grep_args(logs, 'panic')) == 1
+    args = _grep_args(logs, '(')
+    assert panelog.run(args) == 64
+    args = _grep_args(logs, 'x')
+    args.tmux_session = 'other'
+    assert panelog.run(args) == 64
@@ -0,0 +1,89 @@
+import shutil
+import socket
+import time
+
+import pytest
+from mock import patch
+from scripts import preflight
+
+
+@pytest.fixture(autouse=True)
+def cache_home(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+
+
+def test_option_address():
+    assert preflight.option_address('host1') == ('host1', 22)
+    assert preflight.option_address('user@host1', '-p 2222') == ('host1', 2222)
+    assert preflight.option_address('host1', '-p2222 -A') == ('host1', 2222)
+    assert preflight.option_address('host1', '-o Port=2200') == ('host1', 2200)
+
+
+@pytest.mark.skipif(shutil.which('ssh') is None, reason='needs ssh')
+def test_address(tmp_path):
+    config = tmp_path / 'config'
+    config.write_text(
+        'Host alias\n  HostName 127.0.0.1\n  Port 2200\n'
+        'Host jumped\n  HostName 10.0.0.5\n  ProxyJump bastion\n'
+        'Host proxied\n  ProxyCommand nc %h %p\n')
+    options = '-F {}'.format(config)
+    # ~/.ssh/config decides where SSH connects to:
+    assert preflight.address('user@alias', options) == ('127.0.0.1', 2200)
+    assert preflight.address('alias', options + ' -p 2222') == ('127.0.0.1', 2222)
+    assert preflight.address('host1', options) == ('host1', 22)
+    # and whether it connects through a proxy:
+    assert preflight.address('jumped', options) is None
+    assert preflight.address('proxied', options) is None
+
+    # without 'ssh -G' the options are read instead:
+    assert preflight.address('host1', '-p 2222', 'false') == ('host1', 2222)
+
+
+def test_tcp_probe_proxy():
+    with patch('scripts.preflight.address', return_value=None), \
+            patch('scripts.preflight.socket.create_connection') as connect:
+        assert preflight.tcp_probe('jumped', '', 1) is None
+    assert not connect.called
+
+
+def test_tcp_probe():
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    port = listener.getsockname()[1]
+    try:
+        assert preflight.tcp_probe('127.0.0.1', '-p {}'.format(port), 1) is None
+    finally:
+        listener.close()
+    assert preflight.tcp_probe('127.0.0.1', '-p {}'.format(port), 1) is not None
+
+
+def test_unreachable_in_parallel():
+    def probe(host, ssh_options, timeout, ssh_command):
+        time.sleep(0.3)
+        return 'timed out' if host.startswith('down') else None
+
+    hosts = ['up{}'.format(i) for i in range(10)] + ['down{}'.format(i) for i in range(10)]
+    start = time.time()
+    with patch.dict(preflight.PROBES, {'tcp': probe}):
+        failures = preflight.unreachable(hosts, 'tcp', 'ssh', '', 0.3)
+    assert time.time() - start < 1.5
+    assert sorted(failures) == ['down{}'.format(i) for i in range(10)]
+
+
+def test_unreachable_cached():
+    calls = []
+
+    def probe(host, ssh_options, timeout, ssh_command):
+        calls.append(host)
+        return 'refused' if host == 'host2' else None
+
+    with patch.dict(preflight.PROBES, {'ssh': probe}):
+        assert preflight.unreachable(['host1', 'host2'], 'ssh', 'ssh', '', 1, ttl=60) == {'host2': 'refused'}
+        assert preflight.unreachable(['host1', 'host2', 'host3'], 'ssh', 'ssh', '', 1, ttl=60) == \
+            {'host2': 'refused'}
+        assert calls == ['host1', 'host2', 'host3']
+
+        # without a TTL every host is probed again:
+        preflight.unreachable(['host1'], 'ssh', 'ssh', '', 1)
+        assert calls[-1] == 'host1'
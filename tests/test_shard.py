@@ -0,0 +1,36 @@
+import os
+
+from scripts import shard
+
+
+def test_split():
+    hosts = ['host{}'.format(i) for i in range(7)]
+    assert shard.split(hosts, 3) == [['host0', 'host1', 'host2'], ['host3', 'host4'], ['host5', 'host6']]
+    # more shards than hosts:
+    assert shard.split(['host0', 'host1'], 4) == [['host0'], ['host1']]
+    assert shard.split(hosts, 1) == [hosts]
+
+
+def test_split_windows():
+    hosts = ['a', '\n', 'b', 'c', '\n', 'd', '\n']
+    # the break between the shards is dropped, the one within a shard kept:
+    assert shard.split(hosts, 2) == [['a', '\n', 'b'], ['c', '\n', 'd']]
+
+
+def test_sockets():
+    assert shard.sockets(None, 'web', 2) == ['intmux-web-0', 'intmux-web-1']
+    assert shard.sockets('ops', 'web', 1) == ['ops-web-0']
+
+
+def test_cleanup_hook():
+    hook = shard.cleanup_hook('web', ['intmux-web-0', 'intmux-web-1'])
+    assert hook[:2] == ('set-hook', '-g')
+    other = shard.cleanup_hook('other', [])
+    os.remove(other[3].split()[3])
+    assert other[2] != hook[2]
+    script = hook[3].split()[3]
+    with open(script) as f:
+        lines = f.read().split('\n')
+    os.remove(script)
+    assert lines[0] == '[ "$1" = web ] || exit 0'
+    assert 'tmux -L intmux-web-1 kill-session -t =web 2>/dev/null' in lines
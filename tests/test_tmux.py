@@ -0,0 +1,384 @@
+import os
+import shutil
+import threading
+import uuid
+
+import pytest
+from mock import MagicMock, patch
+from scripts import tmux
+
+
+def _ssh_args(hosts):
+    args = MagicMock()
+    args.subcommand = 'ssh'
+    args.hosts = hosts
+    args.input = None
+    args.script = ''
+    args.command = ''
+    args.ssh_command = 'ssh'
+    args.ssh_options = ''
+    args.tmux_session = 'intmux'
+    args.tmux_panes = 2
+    args.tmux_no_sync = False
+    args.tmux_socket = None
+    args.tmux_control = False
+    args.ssh_multiplex = False
+    args.stream = False
+    args.reconcile = False
+    args.prune = False
+    args.preflight = None
+    args.save_plan = None
+    args.tmux_shards = 1
+    args.broadcast_key = None
+    args.max_parallel_connects = 0
+    args.connect_rate = 0
+    args.pane_logs = None
+    args.wait = False
+    return args
+
+
+def test_quote():
+    assert "'tiled'" == tmux.quote('tiled')
+    assert "'echo '\\''hi'\\'' $HOME;'" == tmux.quote("echo 'hi' $HOME;")
+
+
+def test_quote_newlines():
+    assert '"a\\nb \\$HOME \\"q\\""' == tmux.quote('a\nb $HOME "q"')
+
+
+def test_batch_render():
+    batch = tmux.TmuxBatch()
+    batch.add('split-window', '-t', 'intmux:0')
+    batch.add('send-keys', '-t', 'intmux:0', 'ssh host1', 'C-m')
+    assert len(batch) == 2
+    assert batch.render() == (
+        "'split-window' '-t' 'intmux:0'\n"
+        "'send-keys' '-t' 'intmux:0' 'ssh host1' 'C-m'\n")
+
+
+@patch('scripts.tmux.shutil.get_terminal_size', MagicMock(return_value=(80, 24)))
+@patch('scripts.tmux.sys.stdin')
+@patch('scripts.tmux.subprocess')
+@patch('scripts.connections.check_output_as_list')
+class TestTmuxSession:
+
+    def _connect(self, hosts, output_mock, subprocess_mock):
+        spawns = []
+        output_mock.side_effect = lambda command: spawns.append(command) or []
+        subprocess_mock.check_call.side_effect = lambda command, **kwargs: spawns.append(
+            open(command[0].split()[-1]).read() if 'source-file' in command[0] else command[0])
+        tmux.TmuxSession(_ssh_args(hosts)).connect()
+        return spawns
+
+    def test_spawn_count_is_constant(self, output_mock, subprocess_mock, stdin_mock):
+        stdin_mock.isatty.return_value = True
+        few = self._connect(['host{}'.format(i) for i in range(3)], output_mock, subprocess_mock)
+        subprocess_mock.reset_mock()
+        many = self._connect(['host{}'.format(i) for i in range(300)], output_mock, subprocess_mock)
+        assert len(few) == len(many)
+
+    def test_windows(self, output_mock, subprocess_mock, stdin_mock):
+        stdin_mock.isatty.return_value = True
+        spawns = self._connect(['host1', 'host2', 'host3', '\n', 'host4'], output_mock, subprocess_mock)
+        source = [s for s in spawns if isinstance(s, str) and 'send-keys' in s][0]
+        assert source.count("'split-window'") == 1
+        assert "'split-window' '-h' '-t' 'intmux:0.0'" in source
+        # each window is laid out once:
+        assert source.count("'select-layout'") == 3
+        assert source.count("'new-window'") == 2
+        assert "'rename-window' '-t' 'intmux:1' 'host3'" in source
+        assert "'rename-window' '-t' 'intmux:2' 'host4'" in source
+        assert "'set-option' '-p' '-t' 'intmux:2' '@intmux_host' 'host4'" in source
+        assert "'send-keys' '-t' 'intmux:2' 'ssh  host4' 'C-m'" in source
+
+    @patch('scripts.preflight.unreachable', return_value={'host2': 'timed out'})
+    def test_preflight(self, unreachable_mock, output_mock, subprocess_mock, stdin_mock, capsys):
+        stdin_mock.isatty.return_value = True
+        args = _ssh_args(['host1', 'host2', 'host3'])
+        args.preflight = 'tcp'
+        args.unreachable = 'drop'
+        session = tmux.TmuxSession(args)
+        assert session.hosts == ['host1', 'host3']
+        assert 'host2: timed out' in capsys.readouterr().err
+
+        args = _ssh_args(['host1', 'host2', 'host3'])
+        args.preflight = 'tcp'
+        args.unreachable = 'window'
+        assert tmux.TmuxSession(args).hosts == ['host1', 'host3', '\n', 'host2']
+
+    def test_reconcile(self, output_mock, subprocess_mock, stdin_mock):
+        stdin_mock.isatty.return_value = True
+        panes = ['0\t%0\thost1', '0\t%1\told', '0\t%2\t', '2\t%3\thost2']
+
+        def output(command):
+            if 'list-sessions' in command:
+                return ['intmux']
+            if 'list-panes' in command:
+                return panes
+            return []
+        output_mock.side_effect = output
+        sources = []
+        subprocess_mock.check_call.side_effect = lambda command, **kwargs: sources.append(
+            open(command[0].split()[-1]).read()) if 'source-file' in command[0] else None
+
+        args = _ssh_args(['host1', 'host2', 'host3'])
+        args.reconcile = True
+        tmux.TmuxSession(args).connect()
+        # only host3 is added, in a new window after the others:
+        assert len(sources) == 1
+        assert "'new-window' '-t' 'intmux:3'" in sources[0]
+        assert "'set-option' '-p' '-t' 'intmux:3' '@intmux_host' 'host3'" in sources[0]
+        assert 'host1' not in sources[0] and 'host2' not in sources[0]
+        assert 'kill-pane' not in sources[0]
+
+        # --prune closes the pane of 'old', but not the one intmux didn't make:
+        sources.clear()
+        args = _ssh_args(['host1', 'host2'])
+        args.reconcile = True
+        args.prune = True
+        tmux.TmuxSession(args).connect()
+        assert sources == ["'kill-pane' '-t' '%1'\n'select-layout' '-t' 'intmux:0' 'tiled'\n"]
+
+    def test_save_plan(self, output_mock, subprocess_mock, stdin_mock, tmp_path):
+        stdin_mock.isatty.return_value = True
+        plan = str(tmp_path / 'plan.json')
+        args = _ssh_args(['host1', 'host2', 'host3'])
+        args.save_plan = plan
+        spawns = []
+        output_mock.side_effect = lambda command: spawns.append(command) or []
+        subprocess_mock.check_call.side_effect = lambda command, **kwargs: spawns.append(
+            open(command[0].split()[-1]).read() if 'source-file' in command[0] else command[0])
+        tmux.TmuxSession(args).connect()
+        built = [s for s in spawns if 'send-keys' in s]
+
+        saved = tmux.snapshot.load(plan)
+        assert saved['windows'] == [{'index': 0, 'hosts': ['host1', 'host2']}, {'index': 1, 'hosts': ['host3']}]
+        assert saved['size'] == [80, 23]
+
+        # restoring applies the same commands, without discovering the hosts:
+        spawns.clear()
+        restore_args = _ssh_args([])
+        restore_args.plan = plan
+        tmux.restore(restore_args)
+        assert [s for s in spawns if 'send-keys' in s] == built
+        assert not any('ssh' in s for s in spawns if 'send-keys' not in s)
+        assert spawns[-1].endswith(' -t intmux:1')
+
+    def test_restore_stages_script(self, output_mock, subprocess_mock, stdin_mock, tmp_path):
+        stdin_mock.isatty.return_value = True
+        plan = str(tmp_path / 'plan.json')
+        script = tmp_path / 'script.sh'
+        script.write_text('uptime\n')
+        args = _ssh_args(['host1', 'host2'])
+        args.save_plan = plan
+        args.script = str(script)
+        args.ssh_options = '-p 2222'
+        args.discovery_workers = 4
+        output_mock.side_effect = lambda command: []
+        tmux.TmuxSession(args).connect()
+
+        # ssh-docker copies the script to each SSH host before the panes use it
+        # (see stage), and /tmp may have been cleaned since:
+        restore_args = _ssh_args([])
+        restore_args.plan = plan
+        with patch.object(tmux.connections.SSHConnection, 'stage') as stage:
+            tmux.restore(restore_args)
+        hosts, staged_args = stage.call_args[0]
+        assert hosts == ['host1', 'host2']
+        assert (staged_args.script, staged_args.ssh_options) == (str(script), '-p 2222')
+
+    def test_shards(self, output_mock, subprocess_mock, stdin_mock):
+        stdin_mock.isatty.return_value = True
+        args = _ssh_args(['host{}'.format(i) for i in range(6)])
+        args.tmux_shards = 3
+        sources = {}
+
+        def check_call(command, **kwargs):
+            if 'source-file' in command[0]:
+                socket = command[0].split()[2] if ' -L ' in command[0] else None
+                sources[socket] = open(command[0].split()[-1]).read()
+        subprocess_mock.check_call.side_effect = check_call
+        output_mock.side_effect = lambda command: []
+        built = []
+        map_in_parallel = tmux.connections.map_in_parallel
+
+        def build(function, parts, workers):
+            built.extend(parts)
+            return map_in_parallel(function, parts, workers)
+        with patch('scripts.shard.cleanup_hook', return_value=('set-hook', '-g', 'session-closed[1]', 'x')), \
+                patch.object(tmux.connections, 'map_in_parallel', side_effect=build):
+            tmux.TmuxSession(args).connect()
+
+        # the shards are built in parallel, so each has arguments of its own:
+        assert len(set(id(part.args) for part in built)) == 3
+        assert all(part.args is not args for part in built)
+
+        # each shard has a session with two of the hosts:
+        assert sorted(s for s in sources if s is not None) == ['intmux-intmux-0', 'intmux-intmux-1', 'intmux-intmux-2']
+        assert "'host2'" in sources['intmux-intmux-1'] and "'host3'" in sources['intmux-intmux-1']
+        assert 'host4' not in sources['intmux-intmux-1']
+        # and the console shows the shards, with a pane that types into all of them:
+        console = sources[None]
+        assert "'rename-window' '-t' 'intmux:2' 'shard-2'" in console
+        assert 'attach-session -t =intmux' in console
+        assert ('scripts.broadcast --session intmux --socket intmux-intmux-0 --socket intmux-intmux-1 '
+                '--socket intmux-intmux-2') in console
+        assert 'host' not in console
+
+    def test_staggered_connects(self, output_mock, subprocess_mock, stdin_mock):
+        stdin_mock.isatty.return_value = True
+        args = _ssh_args(['host1', 'host2', 'host3'])
+        args.max_parallel_connects = 2
+        args.connect_retries = 3
+        sources = []
+        subprocess_mock.check_call.side_effect = lambda command, **kwargs: sources.append(
+            open(command[0].split()[-1]).read()) if 'source-file' in command[0] else None
+        output_mock.side_effect = lambda command: []
+        tmux.TmuxSession(args).connect()
+
+        send_keys = [line for line in sources[0].split('\n') if line.startswith("'send-keys'")]
+        assert len(send_keys) == 3
+        # each pane waits for one of the two slots, and ssh frees it once connected:
+        assert all('wait-for -L' in line and 'LocalCommand=' in line for line in send_keys)
+        assert '[ \"${used:-0}\" -lt 2 ]' in send_keys[2]
+
+    def test_pane_logs(self, output_mock, subprocess_mock, stdin_mock, tmp_path):
+        stdin_mock.isatty.return_value = True
+        args = _ssh_args(['host1', 'ns/pod'])
+        args.pane_logs = str(tmp_path)
+        args.pane_log_size = 1000
+        args.pane_log_keep = 3
+        sources = []
+        subprocess_mock.check_call.side_effect = lambda command, **kwargs: sources.append(
+            open(command[0].split()[-1]).read()) if 'source-file' in command[0] else None
+        output_mock.side_effect = lambda command: []
+        tmux.TmuxSession(args).connect()
+
+        pipes = [line for line in sources[0].split('\n') if line.startswith("'pipe-pane'")]
+        assert len(pipes) == 2
+        assert "{}/intmux/ns_pod 1000 3".format(tmp_path) in pipes[1]
+        assert (tmp_path / 'intmux' / '.rotate.sh').exists()
+
+    def test_wait(self, output_mock, subprocess_mock, stdin_mock, capsys):
+        stdin_mock.isatty.return_value = True
+        args = _ssh_args(['host1', 'host2'])
+        args.wait = True
+        args.ssh_multiplex = True
+        with patch.object(tmux.TmuxSession, 'make_multiplexer') as make_multiplexer, pytest.raises(SystemExit):
+            tmux.TmuxSession(args)
+        assert '--wait waits for the --command or --script' in capsys.readouterr().out
+        # the arguments are checked before anything is left in /tmp:
+        make_multiplexer.assert_not_called()
+        args.ssh_multiplex = False
+
+        args.command = 'uptime'
+        args.execute = False
+        # a restored session would report to this run:
+        args.save_plan = 'plan.json'
+        with pytest.raises(SystemExit):
+            tmux.TmuxSession(args)
+        assert '--wait cannot be used with --save-plan' in capsys.readouterr().out
+        args.save_plan = None
+
+        args.wait_timeout = 0
+        spawns = []
+
+        def output(command):
+            spawns.append(command)
+            if 'list-panes' in command:
+                return ['%0\thost1', '%1\thost2', '%2\t']
+            return []
+        output_mock.side_effect = output
+        session = tmux.TmuxSession(args)
+        assert args.report_status == session.completion.report_command()
+        results = [tmux.completion.Result('host1', 0, 1), tmux.completion.Result('host2', 2, 1)]
+        with patch.object(session.completion, 'wait', return_value=results) as wait, pytest.raises(SystemExit) as e:
+            session.connect()
+        assert e.value.code == 2
+        assert wait.call_args[0][0] == {'%0': 'host1', '%1': 'host2'}
+        assert '1 succeeded, 1 failed, 0 still running' in capsys.readouterr().out
+        # the panes are left for later, rather than attached to:
+        assert not any('attach-session' in c[0][0] for c in subprocess_mock.check_call.call_args_list)
+        session.completion.close()
+
+    def test_restore_invalid_plan(self, output_mock, subprocess_mock, stdin_mock, tmp_path, capsys):
+        plan = tmp_path / 'plan.json'
+        plan.write_text('{"version": 1, "session": "intmux"}')
+        args = _ssh_args([])
+        args.plan = str(plan)
+        with pytest.raises(SystemExit):
+            tmux.restore(args)
+        assert 'missing size' in capsys.readouterr().out
+
+    def test_stream(self, output_mock, subprocess_mock, stdin_mock):
+        stdin_mock.isatty.return_value = True
+        reader, writer = os.pipe()
+        os.write(writer, b'host1\n')
+
+        def more_hosts():
+            os.write(writer, b'host2\nhost3\n')
+            os.close(writer)
+        threading.Timer(0.2, more_hosts).start()
+
+        args = _ssh_args([])
+        args.stream = True
+        with open(reader) as args.input:
+            spawns = []
+            output_mock.side_effect = lambda command: spawns.append(command) or []
+            subprocess_mock.check_call.side_effect = lambda command, **kwargs: spawns.append(
+                open(command[0].split()[-1]).read() if 'source-file' in command[0] else command[0])
+            tmux.TmuxSession(args).connect()
+
+        # host1 is shown before the others arrive:
+        sources = [s for s in spawns if isinstance(s, str) and 'send-keys' in s]
+        assert len(sources) == 2
+        assert 'host1' in sources[0] and 'host2' not in sources[0]
+        assert 'host3' in sources[1]
+
+    def test_stream_without_hosts(self, output_mock, subprocess_mock, stdin_mock):
+        stdin_mock.isatty.return_value = True
+        args = _ssh_args([])
+        args.stream = True
+        reader, writer = os.pipe()
+        os.close(writer)
+        with open(reader) as args.input:
+            with pytest.raises(SystemExit):
+                tmux.TmuxSession(args)
+
+
+@pytest.fixture
+def socket():
+    """ A private tmux server """
+    if shutil.which('tmux') is None:
+        pytest.skip('tmux is not installed')
+    name = 'intmux-test-{}'.format(uuid.uuid4().hex)
+    yield name
+    tmux.TmuxClient(name).run('kill-server')
+    directory = os.path.join(os.environ.get('TMUX_TMPDIR', '/tmp'), 'tmux-{}'.format(os.getuid()))
+    if os.path.exists(os.path.join(directory, name)):
+        os.remove(os.path.join(directory, name))
+
+
+def test_control_client(socket):
+    client = tmux.ControlClient(socket)
+    assert not client.has_session('test')
+    client.new_session('test', (100, 30))
+    try:
+        batch = tmux.TmuxBatch()
+        batch.add('new-window', '-t', 'test')
+        batch.add('rename-window', '-t', 'test:1', "it's")
+        client.apply(batch)
+        assert client.run('list-windows', '-t', 'test', '-F', '#{window_index}') == ['0', '1']
+        assert client.run('display-message', '-p', '-t', 'test:1', '#{window_name}') == ["it's"]
+        assert client.run('display-message', '-p', '-t', 'test:0', '#{window_width}x#{window_height}') == ['100x30']
+
+        with pytest.raises(tmux.TmuxError) as e:
+            client.run('rename-window', '-t', 'test:9', 'missing')
+        assert e.value.command == ['rename-window', '-t', 'test:9', 'missing']
+        assert e.value.output != []
+
+        # Replies are still matched up with their commands after an error:
+        assert client.run('display-message', '-p', 'ok') == ['ok']
+    finally:
+        client.close()
+    assert tmux.ControlClient(socket).has_session('test')
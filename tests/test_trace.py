@@ -0,0 +1,39 @@
+import io
+import json
+
+from scripts import connections, trace
+
+
+def test_disabled():
+    assert not trace.enabled()
+    assert trace.span('phase') is trace.NO_SPAN
+    with trace.command('true'):
+        pass
+    trace.finish()
+
+
+def test_trace(tmp_path):
+    path = str(tmp_path / 'trace.json')
+    trace.enable(path)
+    try:
+        with trace.span('discover hosts', connection='SSHConnection'):
+            connections.check_output_as_list('echo host1')
+        trace.record('parse arguments', 1.0, 1.5)
+    finally:
+        out = io.StringIO()
+        trace.finish(out)
+    assert not trace.enabled()
+
+    events = json.load(open(path))['traceEvents']
+    assert [(e['name'], e['cat'], e['ph']) for e in events] == [
+        ('echo host1', 'command', 'X'),
+        ('discover hosts', 'phase', 'X'),
+        ('parse arguments', 'phase', 'X'),
+    ]
+    assert events[1]['args'] == {'connection': 'SSHConnection'}
+    assert events[2]['dur'] == 500000
+
+    summary = out.getvalue()
+    assert 'parse arguments' in summary
+    assert '1 commands run' in summary
+    assert 'echo host1' in summary